@@ -1,12 +1,28 @@
 # database.py
+import hashlib
+import math
+import re
 import sqlite3
+import unicodedata
 import pandas as pd
 import os
+import calendar
+import threading
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Union, Set
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple, Union, Set
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from formatting import month_label
+
+try:
+    import numpy as np
+except ImportError:  # columnar reads fall back to the array module
+    np = None
+from helpers import passwords
 
 # --- Database Configuration ---
 DATABASE_PATH_ENV = os.environ.get("DATABASE_PATH")
@@ -16,12 +32,245 @@ else:
     BASE = Path(__file__).parent
     DB = BASE / "finance.db"
 
-def get_conn() -> sqlite3.Connection:
-    """Returns a sqlite3 connection with Row factory enabled."""
-    conn = sqlite3.connect(DB)
+# --- Sharding ---
+# DATABASE_SHARDS=N spreads users over N files. Shard 0 is DB itself, which also holds
+# the global directory (`users` and `user_shards`); shards 1..N-1 live in SHARD_DIR.
+SHARD_COUNT = max(1, int(os.environ.get("DATABASE_SHARDS", "1")))
+SHARD_DIR = Path(os.environ.get("DATABASE_SHARD_DIR", DB.parent / "shards"))
+
+# Per-user tables in dependency order, with the columns referencing another per-user
+# table's id. Moving a user between shards copies them in this order, remapping ids.
+USER_TABLES = [
+    ("categories", {}),
+    ("recurring_expenses", {"category_id": "categories"}),
+    ("recurring_receivables", {}),
+    ("transactions", {"category_id": "categories", "recurring_id": "recurring_expenses"}),
+    ("budgets", {"category_id": "categories"}),
+    ("receivables", {"recurring_id": "recurring_receivables"}),
+    ("savings", {}),
+    ("salary_info", {}),
+    ("user_settings", {}),
+    ("notifications", {"category_id": "categories"}),
+    ("category_rules", {"category_id": "categories"}),
+]
+# Per-user tables derived from the ones above; a move drops them and they are rebuilt.
+DERIVED_USER_TABLES = ["monthly_rollups", "user_versions", "budget_usage", "balance_checkpoints", "change_log", "sync_horizons", "rule_versions"]
+
+# Tables whose row changes go to the change log served by /api/changes
+SYNC_TABLES = ("transactions", "receivables", "budgets", "savings")
+
+# Share of a budget whose crossing writes a notification
+BUDGET_ALERT_THRESHOLDS = (0.8, 1.0)
+
+# Base currency of users who never chose one, and the currency fx_rates are quoted in
+DEFAULT_CURRENCY = os.environ.get("DEFAULT_CURRENCY", "BRL")
+
+# Milliseconds since the epoch, in SQL. Data versions start from the clock, so a user
+# moved to another shard or restored from a backup never reuses a version still cached.
+_NOW_MS = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+_local = threading.local()
+
+def shard_path(shard: int) -> Path:
+    """Returns the database file of a shard."""
+    return DB if shard == 0 else SHARD_DIR / f"{DB.stem}-{shard}{DB.suffix}"
+
+def database_files() -> List[Path]:
+    """Returns every live database file: the directory/shard 0, the other shards and their archives."""
+    files = [shard_path(shard) for shard in range(SHARD_COUNT)]
+    for shard_file in list(files):
+        if shard_file.exists():
+            with _connect(shard_file) as conn:
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'archives'").fetchone():
+                    files += [Path(r['path']) for r in conn.execute("SELECT path FROM archives ORDER BY year")]
+    return files
+
+def shard_for_user(user_id: int) -> int:
+    """Looks up a user's shard in the directory. Users without an entry live in shard 0."""
+    if SHARD_COUNT == 1:
+        return 0
+    directory = getattr(_local, "directory", None)
+    if directory is None:
+        # Kept open per thread in autocommit mode: every lookup sees the latest move.
+        directory = _local.directory = sqlite3.connect(DB, isolation_level=None)
+    row = directory.execute("SELECT shard FROM user_shards WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+class _Connection(sqlite3.Connection):
+    """Connection that closes itself at the end of its `with` block.
+
+    Closing runs `PRAGMA optimize`, which refreshes planner statistics for the tables this
+    connection queried when they are missing or stale (bounded by `analysis_limit`).
+    """
+    def __exit__(self, *exc):
+        try:
+            return super().__exit__(*exc)
+        finally:
+            self.close()
+
+    def close(self):
+        try:
+            self.execute("PRAGMA analysis_limit = 400")
+            self.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
+        super().close()
+
+def _connect(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, factory=_Connection)
     conn.row_factory = sqlite3.Row
     return conn
 
+def get_conn(user_id: int = None) -> sqlite3.Connection:
+    """Returns a sqlite3 connection with Row factory enabled.
+
+    Without `user_id` the connection goes to the directory database; with it, to the
+    user's shard. Inside a `read_snapshot()` block the thread's snapshot connection for
+    that file is returned instead.
+    """
+    path = DB if user_id is None else shard_path(shard_for_user(user_id))
+    snapshots = getattr(_local, "snapshots", None)
+    if snapshots is not None:
+        if path not in snapshots:
+            snapshots[path] = _open_snapshot(path, _local.snapshot_copy)
+        return snapshots[path]
+    return _connect(path)
+
+# --- Read Snapshots ---
+class _SnapshotConnection(sqlite3.Connection):
+    """Read-only connection pinned to a single read transaction.
+
+    `with conn:` normally commits on exit, which would end the read transaction and
+    drop the snapshot, so entering/exiting and committing are no-ops here.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+def _open_snapshot(path: Path, copy: bool) -> sqlite3.Connection:
+    if copy:
+        source = sqlite3.connect(path)
+        conn = sqlite3.connect(":memory:", factory=_SnapshotConnection, isolation_level=None)
+        try:
+            source.backup(conn)
+        finally:
+            source.close()
+    else:
+        conn = sqlite3.connect(path, factory=_SnapshotConnection, isolation_level=None)
+    # ATTACH is not allowed inside a transaction, so archives are attached up front.
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'archives'").fetchone():
+        for year, archive_path in conn.execute("SELECT year, path FROM archives").fetchall():
+            _attach_archive(conn, year, archive_path)
+    if not copy:
+        conn.execute("BEGIN")
+        # A deferred transaction only takes its snapshot on the first read.
+        conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+@contextmanager
+def read_snapshot(copy: bool = False):
+    """Runs every database read of the current thread against one point-in-time view.
+
+    By default the view is a WAL read transaction, which never blocks writers. With
+    `copy=True` the database is first copied into memory through the online backup API,
+    for heavy jobs that should not keep the WAL pinned while they run. Each database
+    file (directory or shard) is snapshotted the first time it is read inside the block.
+    Writes inside the block fail, since snapshot connections are query-only.
+    """
+    if getattr(_local, "snapshots", None) is not None:
+        yield
+        return
+    _local.snapshots, _local.snapshot_copy = {}, copy
+    try:
+        yield
+    finally:
+        snapshots, _local.snapshots = _local.snapshots, None
+        for conn in snapshots.values():
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            sqlite3.Connection.close(conn)
+
+def snapshot_reads(view):
+    """Decorator running a read-only view or report inside `read_snapshot()`."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with read_snapshot():
+            return view(*args, **kwargs)
+    return wrapper
+
+# --- Fetch Modes ---
+# Readers taking `mode` return their rows as:
+#   "dicts"   - one dict per row (the default)
+#   "records" - compact read-only tuples with attribute and by-name access (r.amount,
+#               r['amount'], dict(r)); one class per column set. For templates.
+#   "columns" - {column: values}: NumPy arrays for numbers (int64 when every value is
+#               an integer, float64 with NaN for NULL when there are reals), lists for
+#               anything else, including integer columns with NULLs (nullable ids).
+#               For analytics and to_df, without a Python object per row.
+FETCH_MODES = ("dicts", "records", "columns")
+
+@lru_cache(maxsize=256)
+def record_type(columns: Tuple[str, ...]) -> type:
+    """The record class for a column set (names that are not identifiers are still
+    reachable by name through r['...'])."""
+    index = {c: i for i, c in enumerate(columns)}
+    getitem = tuple.__getitem__
+
+    def __getitem__(self, key):
+        return getitem(self, index[key] if isinstance(key, str) else key)
+
+    def get(self, key, default=None):
+        i = index.get(key)
+        return default if i is None else getitem(self, i)
+
+    return type("Record", (namedtuple("Record", columns, rename=True),),
+                {"__slots__": (), "__getitem__": __getitem__, "get": get, "keys": lambda self: columns})
+
+def _column(values) -> Any:
+    kinds = set(map(type, values))
+    if not kinds or not kinds <= {int, float, type(None)} or kinds == {int, type(None)} or kinds == {type(None)}:
+        return list(values)
+    if kinds == {int}:
+        return np.array(values, dtype=np.int64) if np is not None else array("q", values)
+    if np is not None:
+        return np.array(values, dtype=np.float64)
+    return array("d", (math.nan if v is None else v for v in values))
+
+def _fetch(conn: sqlite3.Connection, q: str, params=(), mode: str = "dicts") -> Union[List[Any], Dict[str, Any]]:
+    """Runs a query and returns its rows in one of the FETCH_MODES."""
+    if mode not in FETCH_MODES:
+        raise ValueError(f"Modo de leitura inválido: {mode}")
+    cur = conn.cursor()
+    if mode == "dicts":
+        return [dict(r) for r in cur.execute(q, params)]
+    cur.row_factory = None
+    rows = cur.execute(q, params).fetchall()
+    columns = tuple(d[0] for d in cur.description)
+    if mode == "records":
+        return list(map(record_type(columns)._make, rows))
+    return {c: _column(values) for c, values in zip(columns, zip(*rows) if rows else [()] * len(columns))}
+
+def _with_column(rows, mode: str, name: str, values: List[Any]):
+    """Adds a computed column to rows fetched in `mode`."""
+    if mode == "columns":
+        rows[name] = _column(values)
+        return rows
+    if mode == "records":
+        if not rows:
+            return rows
+        make = record_type(rows[0].keys() + (name,))._make
+        return [make((*r, v)) for r, v in zip(rows, values)]
+    for r, v in zip(rows, values):
+        r[name] = v
+    return rows
+
 # --- User Model ---
 class User(UserMixin):
     def __init__(self, id: int, email: str, password_hash: str):
@@ -35,71 +284,325 @@ class User(UserMixin):
 
     @password.setter
     def password(self, password: str):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def verify_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        """Checks the password in the hashing pool (may raise passwords.PasswordBusyError).
+        A hash made with outdated parameters is replaced on success."""
+        ok, new_hash = passwords.verify(self.password_hash, password)
+        if ok and new_hash:
+            replace_password_hash(self.id, self.password_hash, new_hash)
+            self.password_hash = new_hash
+        return ok
 
 # --- DB Initialization & Migrations ---
 def init_db():
-    """Initializes the database schema and applies necessary migrations."""
+    """Initializes the directory and every shard, applying necessary migrations."""
     with get_conn() as conn:
-        cur = conn.cursor()
-        # Core Tables
-        cur.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password_hash TEXT NOT NULL)")
-        cur.execute("CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, user_id INTEGER NOT NULL, FOREIGN KEY (user_id) REFERENCES users (id))")
-        cur.execute("""CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            date TEXT NOT NULL, 
-            description TEXT, 
-            amount REAL NOT NULL, 
-            type TEXT NOT NULL, 
-            category_id INTEGER, 
-            note TEXT, 
-            user_id INTEGER NOT NULL, 
-            status TEXT NOT NULL DEFAULT 'paid', 
-            recurring_id INTEGER, 
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP, 
-            FOREIGN KEY (user_id) REFERENCES users (id), 
-            FOREIGN KEY (category_id) REFERENCES categories (id)
-        )""")
-        cur.execute("CREATE TABLE IF NOT EXISTS recurring_expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, description TEXT NOT NULL, amount REAL NOT NULL, day_of_month INTEGER NOT NULL, category_id INTEGER, FOREIGN KEY (user_id) REFERENCES users (id), FOREIGN KEY (category_id) REFERENCES categories (id))")
-        cur.execute("CREATE TABLE IF NOT EXISTS budgets (id INTEGER PRIMARY KEY AUTOINCREMENT, category_id INTEGER NOT NULL, amount REAL NOT NULL, month TEXT NOT NULL, user_id INTEGER NOT NULL, UNIQUE(category_id, month, user_id), FOREIGN KEY (user_id) REFERENCES users (id), FOREIGN KEY (category_id) REFERENCES categories (id))")
-        cur.execute("CREATE TABLE IF NOT EXISTS salary_info (user_id INTEGER PRIMARY KEY, salary REAL NOT NULL DEFAULT 0, bonus REAL NOT NULL DEFAULT 0, FOREIGN KEY (user_id) REFERENCES users (id))")
-        cur.execute("CREATE TABLE IF NOT EXISTS savings (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, name TEXT NOT NULL, bank TEXT, bank_code TEXT, balance REAL NOT NULL DEFAULT 0, cdi_rate REAL DEFAULT NULL, last_rate_update TEXT, currency TEXT DEFAULT 'BRL', FOREIGN KEY (user_id) REFERENCES users (id))")
-        cur.execute("CREATE TABLE IF NOT EXISTS receivables (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, debtor_name TEXT NOT NULL, description TEXT, amount REAL NOT NULL, date TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', recurring_id INTEGER, reference_month TEXT, FOREIGN KEY (user_id) REFERENCES users (id))")
-        cur.execute("CREATE TABLE IF NOT EXISTS recurring_receivables (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, debtor_name TEXT NOT NULL, description TEXT, amount REAL NOT NULL, day_of_month INTEGER NOT NULL, FOREIGN KEY (user_id) REFERENCES users (id))")
-        
-        # Migrations
-        migrations = [
-            ("receivables", "ALTER TABLE receivables ADD COLUMN recurring_id INTEGER"),
-            ("receivables", "ALTER TABLE receivables ADD COLUMN reference_month TEXT"),
-            ("transactions", "ALTER TABLE transactions ADD COLUMN status TEXT NOT NULL DEFAULT 'paid'"),
-            ("transactions", "ALTER TABLE transactions ADD COLUMN recurring_id INTEGER"),
-            ("transactions", "ALTER TABLE transactions ADD COLUMN created_at TEXT DEFAULT CURRENT_TIMESTAMP")
-        ]
-        for table, sql in migrations:
-            try:
-                cur.execute(sql)
-            except sqlite3.OperationalError as e:
-                # Silenciosamente ignora se a coluna já existir
-                if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
-                    pass
-                else:
-                    print(f"Migration error on {table}: {e}")
+        # Only takes effect on a new file; existing ones are converted with
+        # "python -m helpers.maintenance convert".
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL lets report snapshots read while writers commit.
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password_hash TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS user_shards (user_id INTEGER PRIMARY KEY, shard INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, kind TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL, progress REAL NOT NULL DEFAULT 0, message TEXT, filename TEXT, mimetype TEXT, created_at TEXT NOT NULL, started_at TEXT, finished_at TEXT, expires_at TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user_status ON jobs (user_id, status)")
+        conn.execute("CREATE TABLE IF NOT EXISTS maintenance_runs (id INTEGER PRIMARY KEY AUTOINCREMENT, job TEXT NOT NULL, path TEXT NOT NULL, finished_at TEXT NOT NULL, seconds REAL NOT NULL, bytes_reclaimed INTEGER NOT NULL)")
         conn.commit()
+    if SHARD_COUNT > 1:
+        SHARD_DIR.mkdir(parents=True, exist_ok=True)
+    for shard in range(SHARD_COUNT):
+        with _connect(shard_path(shard)) as conn:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+            _init_shard(conn.cursor())
+            conn.commit()
+
+def _init_shard(cur: sqlite3.Cursor):
+    """Creates the per-user tables on one shard and applies column migrations."""
+    # Core Tables
+    cur.execute("CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, user_id INTEGER NOT NULL, FOREIGN KEY (user_id) REFERENCES users (id))")
+    cur.execute("""CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, 
+        date TEXT NOT NULL, 
+        description TEXT, 
+        amount REAL NOT NULL, 
+        type TEXT NOT NULL, 
+        category_id INTEGER, 
+        note TEXT, 
+        user_id INTEGER NOT NULL, 
+        status TEXT NOT NULL DEFAULT 'paid', 
+        recurring_id INTEGER, 
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP, 
+        currency TEXT, 
+        FOREIGN KEY (user_id) REFERENCES users (id), 
+        FOREIGN KEY (category_id) REFERENCES categories (id)
+    )""")
+    cur.execute("CREATE TABLE IF NOT EXISTS recurring_expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, description TEXT NOT NULL, amount REAL NOT NULL, day_of_month INTEGER NOT NULL, category_id INTEGER, FOREIGN KEY (user_id) REFERENCES users (id), FOREIGN KEY (category_id) REFERENCES categories (id))")
+    cur.execute("CREATE TABLE IF NOT EXISTS budgets (id INTEGER PRIMARY KEY AUTOINCREMENT, category_id INTEGER NOT NULL, amount REAL NOT NULL, month TEXT NOT NULL, user_id INTEGER NOT NULL, UNIQUE(category_id, month, user_id), FOREIGN KEY (user_id) REFERENCES users (id), FOREIGN KEY (category_id) REFERENCES categories (id))")
+    cur.execute("CREATE TABLE IF NOT EXISTS salary_info (user_id INTEGER PRIMARY KEY, salary REAL NOT NULL DEFAULT 0, bonus REAL NOT NULL DEFAULT 0, FOREIGN KEY (user_id) REFERENCES users (id))")
+    cur.execute("CREATE TABLE IF NOT EXISTS savings (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, name TEXT NOT NULL, bank TEXT, bank_code TEXT, balance REAL NOT NULL DEFAULT 0, cdi_rate REAL DEFAULT NULL, last_rate_update TEXT, currency TEXT DEFAULT 'BRL', FOREIGN KEY (user_id) REFERENCES users (id))")
+    cur.execute("CREATE TABLE IF NOT EXISTS receivables (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, debtor_name TEXT NOT NULL, description TEXT, amount REAL NOT NULL, date TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending', recurring_id INTEGER, reference_month TEXT, currency TEXT, FOREIGN KEY (user_id) REFERENCES users (id))")
+    cur.execute("CREATE TABLE IF NOT EXISTS recurring_receivables (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, debtor_name TEXT NOT NULL, description TEXT, amount REAL NOT NULL, day_of_month INTEGER NOT NULL, FOREIGN KEY (user_id) REFERENCES users (id))")
+    # Currencies (see Currencies below). The counters rebuilt further down already convert,
+    # so older databases get the currency columns here rather than with the migrations.
+    for table in ("transactions", "receivables"):
+        if "currency" not in {r[1] for r in cur.execute(f"PRAGMA table_info({table})")}:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN currency TEXT")
+    cur.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id INTEGER PRIMARY KEY, base_currency TEXT NOT NULL, FOREIGN KEY (user_id) REFERENCES users (id))")
+    cur.execute("CREATE TABLE IF NOT EXISTS fx_rates (currency TEXT NOT NULL, date TEXT NOT NULL, rate REAL NOT NULL, PRIMARY KEY (currency, date)) WITHOUT ROWID")
+    # Archived years (helpers/archive.py) and the monthly totals kept for them, in base currency
+    cur.execute("CREATE TABLE IF NOT EXISTS archives (year INTEGER PRIMARY KEY, path TEXT NOT NULL)")
+    cur.execute("CREATE TABLE IF NOT EXISTS monthly_rollups (user_id INTEGER NOT NULL, month TEXT NOT NULL, category_id INTEGER, type TEXT NOT NULL, status TEXT NOT NULL, total REAL NOT NULL, count INTEGER NOT NULL, UNIQUE(user_id, month, category_id, type, status))")
+    # Budget consumption counters, kept by _track_transaction_write, and the alerts they raise
+    new_usage = not cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'budget_usage'").fetchone()
+    cur.execute("CREATE TABLE IF NOT EXISTS budget_usage (user_id INTEGER NOT NULL, category_id INTEGER NOT NULL, month TEXT NOT NULL, spent REAL NOT NULL DEFAULT 0, PRIMARY KEY (user_id, category_id, month))")
+    cur.execute("CREATE TABLE IF NOT EXISTS notifications (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, kind TEXT NOT NULL, category_id INTEGER, month TEXT, threshold REAL, message TEXT NOT NULL, created_at TEXT DEFAULT CURRENT_TIMESTAMP, read_at TEXT, UNIQUE(user_id, category_id, month, threshold), FOREIGN KEY (user_id) REFERENCES users (id))")
+    if new_usage:
+        _rebuild_budget_usage(cur.connection)
+    # Running balance at the end of each month (income - expense, every status), kept on write
+    new_checkpoints = not cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'balance_checkpoints'").fetchone()
+    cur.execute("CREATE TABLE IF NOT EXISTS balance_checkpoints (user_id INTEGER NOT NULL, month TEXT NOT NULL, net REAL NOT NULL DEFAULT 0, balance REAL NOT NULL DEFAULT 0, PRIMARY KEY (user_id, month))")
+    if new_checkpoints:
+        _rebuild_balance_checkpoints(cur.connection)
+    # Auto-categorization rules (helpers/categorize.py); rule_versions changes on every rule edit
+    cur.execute("CREATE TABLE IF NOT EXISTS category_rules (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, category_id INTEGER NOT NULL, kind TEXT NOT NULL, pattern TEXT NOT NULL DEFAULT '', min_amount REAL, max_amount REAL, type TEXT, priority INTEGER NOT NULL DEFAULT 0, FOREIGN KEY (user_id) REFERENCES users (id), FOREIGN KEY (category_id) REFERENCES categories (id))")
+    cur.execute("CREATE TABLE IF NOT EXISTS rule_versions (user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)")
+    for op, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS category_rules_{op.lower()}_rule_version AFTER {op} ON category_rules BEGIN
+            INSERT INTO rule_versions (user_id, version) VALUES ({row}.user_id, {_NOW_MS})
+            ON CONFLICT(user_id) DO UPDATE SET version = MAX(version + 1, excluded.version);
+        END""")
+    # Indexes
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications (user_id, read_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_receivables_user_status_date ON receivables (user_id, status, date)")
+    # Data versions: any write to a user's rows bumps theirs (see get_data_version)
+    cur.execute("CREATE TABLE IF NOT EXISTS user_versions (user_id INTEGER PRIMARY KEY, version INTEGER NOT NULL)")
+    for table, _ in USER_TABLES:
+        for op, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_version AFTER {op} ON {table} BEGIN
+                INSERT INTO user_versions (user_id, version) VALUES ({row}.user_id, {_NOW_MS})
+                ON CONFLICT(user_id) DO UPDATE SET version = MAX(version + 1, excluded.version);
+            END""")
+    
+    # Change log for delta sync (see get_changes): one entry per row write, deletes included
+    cur.execute("CREATE TABLE IF NOT EXISTS change_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, tbl TEXT NOT NULL, row_id INTEGER NOT NULL, op TEXT NOT NULL, changed_at TEXT DEFAULT CURRENT_TIMESTAMP)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_change_log_user_seq ON change_log (user_id, seq)")
+    cur.execute("CREATE TABLE IF NOT EXISTS sync_horizons (user_id INTEGER PRIMARY KEY, seq INTEGER NOT NULL)")
+    for table in SYNC_TABLES:
+        for op, row, kind in (("INSERT", "NEW", "upsert"), ("UPDATE", "NEW", "upsert"), ("DELETE", "OLD", "delete")):
+            cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_changes AFTER {op} ON {table} BEGIN
+                INSERT INTO change_log (user_id, tbl, row_id, op) VALUES ({row}.user_id, '{table}', {row}.id, '{kind}');
+            END""")
+
+    # Migrations
+    migrations = [
+        ("receivables", "ALTER TABLE receivables ADD COLUMN recurring_id INTEGER"),
+        ("receivables", "ALTER TABLE receivables ADD COLUMN reference_month TEXT"),
+        ("transactions", "ALTER TABLE transactions ADD COLUMN status TEXT NOT NULL DEFAULT 'paid'"),
+        ("transactions", "ALTER TABLE transactions ADD COLUMN recurring_id INTEGER"),
+        ("transactions", "ALTER TABLE transactions ADD COLUMN created_at TEXT DEFAULT CURRENT_TIMESTAMP"),
+        ("transactions", "ALTER TABLE transactions ADD COLUMN source_ref TEXT"),
+        ("transactions", "ALTER TABLE transactions ADD COLUMN fingerprint TEXT")
+    ]
+    for table, sql in migrations:
+        try:
+            cur.execute(sql)
+        except sqlite3.OperationalError as e:
+            # Silenciosamente ignora se a coluna já existir
+            if "duplicate column name" in str(e).lower() or "already exists" in str(e).lower():
+                pass
+            else:
+                print(f"Migration error on {table}: {e}")
+
+    # Duplicate detection: existing rows get fingerprints, except later copies of a
+    # duplicate, which stay NULL so the unique index can be built
+    if not cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_transactions_fingerprint'").fetchone():
+        cur.connection.create_function("txn_fingerprint", 5, transaction_fingerprint, deterministic=True)
+        cur.execute("UPDATE transactions SET fingerprint = txn_fingerprint(user_id, date, amount, description, source_ref) WHERE fingerprint IS NULL")
+        cur.execute("UPDATE transactions SET fingerprint = NULL WHERE id NOT IN (SELECT MIN(id) FROM transactions GROUP BY user_id, fingerprint)")
+        cur.execute("CREATE UNIQUE INDEX idx_transactions_fingerprint ON transactions (user_id, fingerprint) WHERE fingerprint IS NOT NULL")
+
+# --- Currencies ---
+# Amounts stay in the currency they were entered in: `currency` on transactions and
+# receivables (and savings), NULL meaning the user's base currency (user_settings, else
+# DEFAULT_CURRENCY). fx_rates says how many DEFAULT_CURRENCY units one unit of a currency
+# was worth from a date on; it is copied on every shard so queries join it locally.
+#
+# Summaries convert inside their SQL through _in_base(): rows already in the base
+# currency are taken as they are, the others are multiplied by the rate in force on
+# their date (an index seek on fx_rates). No report converts row by row in Python.
+# Amounts in a currency without any rate come out NULL and drop out of the sums.
+_CURRENCY_RE = re.compile(r"^[A-Z]{3}$")
+
+def normalize_currency(code: Optional[str]) -> Optional[str]:
+    """' usd' -> 'USD', ''/None -> None. Raises ValueError for anything but three letters."""
+    if code is None or not str(code).strip():
+        return None
+    code = str(code).strip().upper()
+    if not _CURRENCY_RE.match(code):
+        raise ValueError(f"Moeda inválida: {code}")
+    return code
+
+def _base_sql(user: Union[int, str]) -> str:
+    """SQL for a user's base currency; `user` is an id or the SQL column holding one."""
+    user = str(int(user)) if isinstance(user, int) else user
+    return f"COALESCE((SELECT base_currency FROM main.user_settings WHERE user_id = {user}), '{DEFAULT_CURRENCY}')"
+
+def _rate_sql(currency: str, date: str) -> str:
+    """SQL for DEFAULT_CURRENCY units per unit of `currency` on `date` (the earliest rate
+    known for dates before it)."""
+    return f"""(CASE WHEN {currency} = '{DEFAULT_CURRENCY}' THEN 1.0 ELSE COALESCE(
+                 (SELECT rate FROM main.fx_rates WHERE currency = {currency} AND date <= {date} ORDER BY date DESC LIMIT 1),
+                 (SELECT rate FROM main.fx_rates WHERE currency = {currency} ORDER BY date LIMIT 1)) END)"""
+
+def _in_base(base: str, amount: str = "t.amount", currency: str = "t.currency", date: str = "t.date") -> str:
+    """SQL converting `amount`, in `currency` on `date`, into `base` (all SQL expressions)."""
+    return f"""(CASE WHEN {currency} IS NULL OR {currency} = {base} THEN {amount}
+                ELSE {amount} * {_rate_sql(currency, date)} / {_rate_sql(base, date)} END)"""
+
+def _amount_in_base(conn: sqlite3.Connection, user_id: int, row) -> float:
+    """One written row's amount in the user's base currency, for the incremental counters."""
+    currency = row['currency'] if 'currency' in row.keys() else None
+    if currency is None:
+        return float(row['amount'] or 0)
+    value = conn.execute(f"SELECT {_in_base(_base_sql(user_id), 'v.amount', 'v.currency', 'v.date')} FROM (SELECT ? AS amount, ? AS currency, ? AS date) v",
+                         (row['amount'], currency, str(row['date'])[:10])).fetchone()[0]
+    return float(value or 0)
+
+def get_base_currency(user_id: int) -> str:
+    with get_conn(user_id) as conn:
+        return conn.execute(f"SELECT {_base_sql(user_id)}").fetchone()[0]
+
+def _ensure_currency_column(conn: sqlite3.Connection, schema: str, table: str):
+    """Archive files written before currencies existed lack the column."""
+    if "currency" not in {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")}:
+        conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN currency TEXT")
+
+def _attach_all_archives(conn: sqlite3.Connection) -> List[str]:
+    # ATTACH is not allowed inside a transaction, so callers do this before writing
+    return [_attach_archive(conn, year, path) for year, path in conn.execute("SELECT year, path FROM archives").fetchall()]
+
+def _insert_rollups(conn: sqlite3.Connection, schema: str, user_id: int = None, start: str = None, end: str = None):
+    """Adds the monthly totals of the transactions archived in `schema` (optionally one
+    user, dates in [start, end)) to monthly_rollups, in each user's base currency."""
+    where, params = ["1 = 1"], []
+    if user_id is not None:
+        where.append("t.user_id = ?"); params.append(user_id)
+    if start:
+        where.append("t.date >= ? AND t.date < ?"); params.extend([start, end])
+    conn.execute(f"""INSERT INTO monthly_rollups (user_id, month, category_id, type, status, total, count)
+                     SELECT t.user_id, substr(t.date, 1, 7), t.category_id, t.type, t.status, COALESCE(SUM({_in_base(_base_sql('t.user_id'))}), 0), COUNT(*)
+                     FROM {schema}.transactions t WHERE {' AND '.join(where)}
+                     GROUP BY t.user_id, substr(t.date, 1, 7), t.category_id, t.type, t.status""", params)
+
+def _rebuild_rollups(conn: sqlite3.Connection, schemas: List[str], user_id: int = None):
+    """Recomputes monthly_rollups from the (already attached) archive `schemas`."""
+    where, params = ("AND user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    conn.execute(f"DELETE FROM monthly_rollups WHERE 1 = 1 {where}", params)
+    for schema in schemas:
+        _ensure_currency_column(conn, schema, "transactions")
+        _insert_rollups(conn, schema, user_id)
+
+# Tables whose amounts are always in the user's base currency, and those amount columns
+_BASE_AMOUNTS = {
+    "budgets": ("amount",),
+    "salary_info": ("salary", "bonus"),
+    "recurring_expenses": ("amount",),
+    "recurring_receivables": ("amount",),
+}
+
+def set_base_currency(user_id: int, currency: str):
+    """Switches the currency a user's summaries come out in.
+
+    Rows entered without a currency were in the old base, so they are stamped with it
+    first. Amounts that have no currency of their own (budgets, salary, recurring
+    expenses and receivables) are converted at today's rate; ValueError when there is
+    none and any of them is set. Then the budget counters, balance checkpoints and
+    archived rollups are recomputed in the new currency.
+    """
+    currency = normalize_currency(currency) or DEFAULT_CURRENCY
+    with get_conn(user_id) as conn:
+        schemas = _attach_all_archives(conn)
+        old = conn.execute(f"SELECT {_base_sql(user_id)}").fetchone()[0]
+        if old == currency:
+            return
+        # Both codes passed normalize_currency (three letters), so they can be inlined
+        today = "date('now')"
+        factor = conn.execute(f"SELECT {_rate_sql(repr(old), today)} / {_rate_sql(repr(currency), today)}").fetchone()[0]
+        in_base = [table for table in _BASE_AMOUNTS
+                   if conn.execute(f"SELECT 1 FROM {table} WHERE user_id = ? LIMIT 1", (user_id,)).fetchone()]
+        if factor is None and in_base:
+            raise ValueError(f"Sem cotação para converter {old} em {currency}; carregue as cotações antes")
+        for table in in_base:
+            conn.execute(f"UPDATE {table} SET {', '.join(f'{c} = {c} * ?' for c in _BASE_AMOUNTS[table])} WHERE user_id = ?",
+                         (*[factor] * len(_BASE_AMOUNTS[table]), user_id))
+        for schema in ["main", *schemas]:
+            for table in ("transactions", "receivables"):
+                _ensure_currency_column(conn, schema, table)
+                conn.execute(f"UPDATE {schema}.{table} SET currency = ? WHERE user_id = ? AND currency IS NULL", (old, user_id))
+        conn.execute("UPDATE savings SET currency = ? WHERE user_id = ? AND currency IS NULL", (old, user_id))
+        conn.execute("INSERT INTO user_settings (user_id, base_currency) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET base_currency = excluded.base_currency",
+                     (user_id, currency))
+        _rebuild_rollups(conn, schemas, user_id)
+        _rebuild_budget_usage(conn, user_id)
+        _rebuild_balance_checkpoints(conn, user_id)
+        conn.commit()
+
+def load_fx_rates(rows: Iterable[Tuple[str, str, float]]) -> int:
+    """Upserts (date, currency, rate) rows into fx_rates on every shard; returns how many.
+
+    Shards holding amounts in other currencies get their converted counters recomputed
+    (set-wise, in one statement per table), and every user's data version moves on so
+    cached summaries are redone with the new rates.
+    """
+    clean = []
+    for date, currency, rate in rows:
+        try:
+            date = datetime.strptime(str(date).strip()[:10], "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            raise ValueError(f"Data inválida: {date}")
+        rate = float(rate)
+        if rate <= 0:
+            raise ValueError(f"Cotação inválida para {currency} em {date}: {rate}")
+        clean.append((normalize_currency(currency), date, rate))
+    for shard in range(SHARD_COUNT):
+        with _connect(shard_path(shard)) as conn:
+            schemas = _attach_all_archives(conn)
+            conn.executemany("INSERT INTO fx_rates (currency, date, rate) VALUES (?, ?, ?) ON CONFLICT(currency, date) DO UPDATE SET rate = excluded.rate", clean)
+            if any(conn.execute(f"SELECT 1 FROM {schema}.transactions WHERE currency IS NOT NULL LIMIT 1").fetchone()
+                   for schema in ["main", *schemas] if "currency" in {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info(transactions)")}):
+                _rebuild_rollups(conn, schemas)
+                _rebuild_budget_usage(conn)
+                _rebuild_balance_checkpoints(conn)
+            conn.execute(f"UPDATE user_versions SET version = MAX(version + 1, {_NOW_MS})")
+            conn.commit()
+    return len(clean)
+
+def get_savings_total(user_id: int) -> float:
+    """The user's savings added up in their base currency, at today's rates."""
+    with get_conn(user_id) as conn:
+        converted = _in_base(_base_sql(user_id), "s.balance", "s.currency", "date('now')")
+        total = conn.execute(f"SELECT SUM({converted}) FROM savings s WHERE s.user_id = ?", (user_id,)).fetchone()[0]
+        return total or 0.0
 
 # --- User Management ---
 def create_user(email: str, password: str) -> int:
-    hashed_password = generate_password_hash(password)
+    hashed_password = passwords.hash_password(password)
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute("INSERT INTO users (email, password_hash) VALUES (?, ?)", (email, hashed_password))
         user_id = cur.lastrowid
+        if SHARD_COUNT > 1:
+            cur.execute("INSERT INTO user_shards (user_id, shard) VALUES (?, ?)", (user_id, user_id % SHARD_COUNT))
+        conn.commit()
+    with get_conn(user_id) as conn:
         default_categories = ["Salário", "Aluguel", "Mercado", "Transporte", "Lazer", "Contas", "Saúde", "Outros"]
-        cur.executemany("INSERT INTO categories (name, user_id) VALUES (?, ?)", [(n, user_id) for n in default_categories])
+        conn.executemany("INSERT INTO categories (name, user_id) VALUES (?, ?)", [(n, user_id) for n in default_categories])
         conn.commit()
-        return user_id
+    return user_id
 
 def get_user_by_email(email: str) -> Optional[User]:
     with get_conn() as conn:
@@ -112,25 +615,244 @@ def get_user_by_id(user_id: int) -> Optional[User]:
         return User(id=row['id'], email=row['email'], password_hash=row['password_hash']) if row else None
 
 def update_user_password(user_id: int, new_password: str):
-    hashed_password = generate_password_hash(new_password)
+    hashed_password = passwords.hash_password(new_password)
     with get_conn() as conn:
         conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (hashed_password, user_id))
         conn.commit()
 
-# --- Categories ---
-def fetch_categories(user_id: int) -> List[Dict[str, Any]]:
+def replace_password_hash(user_id: int, old_hash: str, new_hash: str) -> bool:
+    """Swaps in a rehashed password unless the password changed in the meantime."""
     with get_conn() as conn:
-        rows = conn.execute("SELECT id, name FROM categories WHERE user_id = ? ORDER BY name", (user_id,)).fetchall()
-        return [dict(r) for r in rows]
+        changed = conn.execute("UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?", (new_hash, user_id, old_hash)).rowcount
+        conn.commit()
+        return bool(changed)
+
+# --- Data Versions ---
+def get_data_version(user_id: int) -> int:
+    """Returns a number that changes whenever any of the user's rows is written."""
+    with get_conn(user_id) as conn:
+        row = conn.execute("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+# --- Change Feed ---
+def _change_seq(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row else 0
+
+def get_changes(user_id: int, since: int = 0, limit: int = 500) -> Dict[str, Any]:
+    """Rows of SYNC_TABLES written after change-log position `since`, for delta sync.
+
+    Returns {"cursor", "reset", "more", "changes": {table: {"upserts": [rows], "deletes": [ids]}}}.
+    Each changed row appears once, with its current contents or as a tombstone, and at
+    most `limit` rows per call; the client passes `cursor` back as `since` until `more`
+    is false. When the log can no longer say what changed since `since` (first sync, log
+    compacted past it, user moved to another shard), `reset` is true and `changes` holds
+    every row: the client replaces its copy. Archived rows leave the hot tables, so they
+    arrive as deletes.
+    """
+    changes = {table: {"upserts": [], "deletes": []} for table in SYNC_TABLES}
+    with get_conn(user_id) as conn:
+        horizon = conn.execute("SELECT seq FROM sync_horizons WHERE user_id = ?", (user_id,)).fetchone()
+        if since <= 0 or (horizon and since < horizon[0]):
+            for table in SYNC_TABLES:
+                changes[table]["upserts"] = [dict(r) for r in conn.execute(f"SELECT * FROM {table} WHERE user_id = ? ORDER BY id", (user_id,))]
+            return {"cursor": _change_seq(conn), "reset": True, "more": False, "changes": changes}
+
+        latest = conn.execute("""SELECT tbl, row_id, MAX(seq) AS seq FROM change_log WHERE user_id = ? AND seq > ?
+                                 GROUP BY tbl, row_id ORDER BY seq LIMIT ?""", (user_id, since, limit + 1)).fetchall()
+        more = len(latest) > limit
+        latest = latest[:limit]
+        for table in SYNC_TABLES:
+            ids = [r['row_id'] for r in latest if r['tbl'] == table]
+            found = set()
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                for r in conn.execute(f"SELECT * FROM {table} WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})", (user_id, *chunk)):
+                    changes[table]["upserts"].append(dict(r))
+                    found.add(r['id'])
+            changes[table]["deletes"] = [i for i in ids if i not in found]
+        return {"cursor": latest[-1]['seq'] if latest else since, "reset": False, "more": more, "changes": changes}
+
+def reset_change_log(user_id: int, after: int = 0):
+    """Drops the user's change log so sync clients start over with a full download.
+
+    Their cursors stop being valid: log positions on this shard are first moved past
+    `after` (the highest position on the shard the user came from, for shard moves).
+    """
+    with get_conn(user_id) as conn:
+        conn.execute("DELETE FROM change_log WHERE user_id = ?", (user_id,))
+        horizon = max(_change_seq(conn), after) + 1
+        if not conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'change_log'", (horizon,)).rowcount:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', ?)", (horizon,))
+        conn.execute("INSERT INTO sync_horizons (user_id, seq) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET seq = excluded.seq", (user_id, horizon))
+        conn.commit()
+
+def compact_change_log(conn: sqlite3.Connection, retention_days: int) -> int:
+    """Shrinks one shard's change log; returns the entries removed.
+
+    Entries superseded by a later one for the same row go, since only a row's latest
+    entry is ever served. Entries older than `retention_days` go too, and the user's
+    sync horizon moves past them: clients that have not synced since then reset.
+    """
+    removed = conn.execute("""DELETE FROM change_log WHERE seq NOT IN
+                              (SELECT MAX(seq) FROM change_log GROUP BY user_id, tbl, row_id)""").rowcount
+    cutoff = f"-{int(retention_days)} days"
+    conn.execute("""INSERT INTO sync_horizons (user_id, seq)
+                    SELECT user_id, MAX(seq) FROM change_log WHERE changed_at < datetime('now', ?) GROUP BY user_id
+                    ON CONFLICT(user_id) DO UPDATE SET seq = MAX(seq, excluded.seq)""", (cutoff,))
+    removed += conn.execute("DELETE FROM change_log WHERE changed_at < datetime('now', ?)", (cutoff,)).rowcount
+    conn.commit()
+    return removed
+
+# --- Categories ---
+def fetch_categories(user_id: int, mode: str = "dicts"):
+    with get_conn(user_id) as conn:
+        return _fetch(conn, "SELECT id, name FROM categories WHERE user_id = ? ORDER BY name", (user_id,), mode)
+
+def create_category(user_id: int, name: str) -> int:
+    """Returns the id of the user's category called `name`, creating it if needed."""
+    with get_conn(user_id) as conn:
+        row = conn.execute("SELECT id FROM categories WHERE name = ? AND user_id = ?", (name, user_id)).fetchone()
+        if row:
+            return row['id']
+        cur = conn.execute("INSERT INTO categories (name, user_id) VALUES (?, ?)", (name, user_id))
+        conn.commit()
+        return cur.lastrowid
+
+def delete_category_if_unused(user_id: int, category_id: int) -> bool:
+    """Deletes a category nothing refers to any more. Returns False while some month still
+    has a budget for it; raises ValueError when transactions or fixed bills use it."""
+    with get_conn(user_id) as conn:
+        in_use = conn.execute("SELECT EXISTS (SELECT 1 FROM transactions WHERE user_id = ? AND category_id = ?) OR EXISTS (SELECT 1 FROM recurring_expenses WHERE user_id = ? AND category_id = ?)",
+                              (user_id, category_id, user_id, category_id)).fetchone()[0]
+        if in_use:
+            raise ValueError("Categoria mantida pois possui transações ou contas fixas.")
+        if conn.execute("SELECT 1 FROM budgets WHERE user_id = ? AND category_id = ? LIMIT 1", (user_id, category_id)).fetchone():
+            return False
+        conn.execute("DELETE FROM category_rules WHERE category_id = ? AND user_id = ?", (category_id, user_id))
+        deleted = conn.execute("DELETE FROM categories WHERE id = ? AND user_id = ?", (category_id, user_id)).rowcount
+        conn.commit()
+        return deleted > 0
 
 def get_category_id(name: str, user_id: int) -> Optional[int]:
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         row = conn.execute("SELECT id FROM categories WHERE name = ? AND user_id = ?", (name, user_id)).fetchone()
         return row['id'] if row else None
 
+# --- Categorization Rules ---
+RULE_KINDS = ("keyword", "regex", "amount")
+# Transactions in this category (or in none) are the ones rules may categorize
+FALLBACK_CATEGORY = "Outros"
+
+def fetch_category_rules(user_id: int) -> List[Dict[str, Any]]:
+    """The user's rules in the order they are tried: by priority, then oldest first."""
+    with get_conn(user_id) as conn:
+        rows = conn.execute("""SELECT r.*, c.name AS category FROM category_rules r JOIN categories c ON c.id = r.category_id
+                               WHERE r.user_id = ? ORDER BY r.priority, r.id""", (user_id,)).fetchall()
+        return [dict(r) for r in rows]
+
+# Numbered backreferences (\1) and conditionals ((?(1)...)), outside escapes
+_NUMBERED_GROUP_REF = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\()")
+
+def validate_rule_pattern(pattern: str):
+    """Raises ValueError unless a "regex" rule can run inside the combined expression
+    helpers/categorize.py builds from all of a user's rules."""
+    try:
+        alone = re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Expressão regular inválida: {e}")
+    if alone.flags & ~re.UNICODE:
+        raise ValueError("Use flags com escopo, como (?i:...), em vez de (?i) no início da expressão")
+    if alone.groupindex:
+        raise ValueError("Expressões regulares com grupos nomeados não são aceitas")
+    if _NUMBERED_GROUP_REF.search(pattern):
+        raise ValueError("Expressões regulares com referências numeradas (\\1) não são aceitas")
+    try:
+        # The exact form each rule takes there
+        re.compile(f"(?is)^(?:(?P<r0>.*?(?:{pattern})))")
+    except re.error as e:
+        raise ValueError(f"Expressão regular inválida: {e}")
+
+def add_category_rule(user_id: int, category_id: int, kind: str, pattern: str = "", min_amount: float = None,
+                      max_amount: float = None, typ: str = None, priority: int = 0) -> int:
+    """Adds a rule sending matching transactions to `category_id`.
+
+    "keyword" matches descriptions containing `pattern` (ignoring case), "regex" ones
+    matching it anywhere, and "amount" only checks the amount range; `min_amount`,
+    `max_amount` (absolute values, inclusive) and `typ` narrow any kind.
+    """
+    pattern = (pattern or "").strip()
+    if kind not in RULE_KINDS:
+        raise ValueError("Tipo de regra deve ser keyword, regex ou amount")
+    if kind != "amount" and not pattern:
+        raise ValueError("Informe o texto da regra")
+    if kind == "amount" and min_amount is None and max_amount is None:
+        raise ValueError("Informe o valor mínimo ou máximo")
+    if kind == "regex":
+        validate_rule_pattern(pattern)
+    if typ not in (None, *TRANSACTION_TYPES):
+        raise ValueError("Tipo deve ser income ou expense")
+    with get_conn(user_id) as conn:
+        # The subquery keeps ids of other users' categories out
+        cur = conn.execute("""INSERT INTO category_rules (user_id, category_id, kind, pattern, min_amount, max_amount, type, priority)
+                              SELECT ?, id, ?, ?, ?, ?, ?, ? FROM categories WHERE id = ? AND user_id = ?""",
+                           (user_id, kind, pattern, min_amount, max_amount, typ, int(priority), category_id, user_id))
+        if not cur.rowcount:
+            raise ValueError("Categoria não encontrada")
+        conn.commit()
+        return cur.lastrowid
+
+def delete_category_rule(user_id: int, rule_id: int) -> bool:
+    with get_conn(user_id) as conn:
+        deleted = conn.execute("DELETE FROM category_rules WHERE id = ? AND user_id = ?", (rule_id, user_id)).rowcount
+        conn.commit()
+        return deleted > 0
+
+def get_rules_version(user_id: int) -> int:
+    """Like get_data_version, but only changes when the user's rules do."""
+    with get_conn(user_id) as conn:
+        row = conn.execute("SELECT version FROM rule_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+def iter_uncategorized_transactions(user_id: int, batch_size: int = 10000) -> Iterator[List[sqlite3.Row]]:
+    """Yields batches of (id, description, amount, type, category_id) of the transactions
+    without a category or in FALLBACK_CATEGORY."""
+    with get_conn(user_id) as conn:
+        cur = conn.execute("""SELECT t.id, t.description, t.amount, t.type, t.category_id FROM transactions t
+                              WHERE t.user_id = ? AND (t.category_id IS NULL OR t.category_id IN
+                                    (SELECT id FROM categories WHERE user_id = ? AND name = ?))""", (user_id, user_id, FALLBACK_CATEGORY))
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+
+def set_transaction_categories(user_id: int, assignments: List[Tuple[int, int, Optional[int]]]) -> int:
+    """Recategorizes many transactions at once; returns how many changed.
+
+    `assignments` holds (transaction id, new category id, category id it was read with);
+    rows edited since they were read are left alone. The assignments go through a temp
+    table and a single UPDATE, and budget counters are recomputed once at the end
+    instead of per row.
+    """
+    with get_conn(user_id) as conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS recategorized (id INTEGER PRIMARY KEY, category_id INTEGER, old INTEGER)")
+        conn.execute("DELETE FROM temp.recategorized")
+        conn.executemany("INSERT INTO temp.recategorized (id, category_id, old) VALUES (?, ?, ?)", assignments)
+        changed = conn.execute("""UPDATE transactions SET category_id = (SELECT r.category_id FROM temp.recategorized r WHERE r.id = transactions.id)
+                                  WHERE user_id = ? AND id IN (SELECT id FROM temp.recategorized)
+                                    AND category_id IS (SELECT r.old FROM temp.recategorized r WHERE r.id = transactions.id)""", (user_id,)).rowcount
+        conn.execute("DROP TABLE temp.recategorized")
+        _rebuild_budget_usage(conn, user_id)
+        conn.commit()
+        return changed
+
 # --- Transactions Core ---
-def fetch_transactions(user_id: int, filter_category: str = None, date_from: str = None, date_to: str = None, search: str = None, limit: int = None, offset: int = None, status: str = None) -> List[Dict[str, Any]]:
-    q = "SELECT t.*, c.name as category FROM transactions t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ?"
+def fetch_transactions(user_id: int, filter_category: str = None, date_from: str = None, date_to: str = None, search: str = None, limit: int = None, offset: int = None, status: str = None, with_balance: bool = False, mode: str = "dicts"):
+    """Returns the user's transactions, newest first, in one of the FETCH_MODES. With
+    `with_balance`, each row also gets the account's running balance after it
+    (meaningful for unfiltered listings)."""
+    q = "SELECT t.*, c.name as category FROM {transactions} t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ?"
     params = [user_id]
     if status: q += " AND t.status = ?"; params.append(status)
     if filter_category: q += " AND c.name = ?"; params.append(filter_category)
@@ -140,50 +862,296 @@ def fetch_transactions(user_id: int, filter_category: str = None, date_from: str
     q += " ORDER BY date(t.date) DESC, t.id DESC"
     if limit: q += " LIMIT ?"; params.append(limit)
     if offset: q += " OFFSET ?"; params.append(offset)
-    with get_conn() as conn:
-        rows = conn.execute(q, params).fetchall()
-        return [dict(r) for r in rows]
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", date_from, date_to))
+        rows = _fetch(conn, q, params, mode)
+        if with_balance:
+            rows = _with_column(rows, mode, "balance", _running_balances(conn, user_id, rows, mode))
+        return rows
 
 def count_transactions(user_id: int, filter_category: str = None, date_from: str = None, date_to: str = None, search: str = None) -> int:
-    q = "SELECT COUNT(*) FROM transactions t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ?"
+    q = "SELECT COUNT(*) FROM {transactions} t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ?"
     params = [user_id]
     if filter_category: q += " AND c.name = ?"; params.append(filter_category)
     if date_from: q += " AND date(t.date) >= date(?)"; params.append(date_from)
     if date_to: q += " AND date(t.date) <= date(?)"; params.append(date_to)
     if search: q += " AND (t.description LIKE ? OR c.name LIKE ? OR t.note LIKE ?)"; params.extend([f"%{search}%"] * 3)
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", date_from, date_to))
         return conn.execute(q, params).fetchone()[0]
 
 
-def add_transaction(user_id: int, date: str, desc: str, category_id: int, amount: float, typ: str, note: str = "", status: str = "paid", recurring_id: int = None):
-    with get_conn() as conn:
-        conn.execute("INSERT INTO transactions(user_id, date, description, category_id, amount, type, note, status, recurring_id) VALUES(?,?,?,?,?,?,?,?,?)", (user_id, date, desc, category_id, amount, typ, note, status, recurring_id))
+# --- Duplicate Detection ---
+# Transactions with the same amount this many days apart are reported as possible duplicates
+DUPLICATE_WINDOW_DAYS = int(os.environ.get("DUPLICATE_WINDOW_DAYS", "3"))
+
+class DuplicateTransactionError(ValueError):
+    """A transaction with the same fingerprint already exists (`existing_id`)."""
+    def __init__(self, existing_id: int):
+        super().__init__("Já existe uma transação com a mesma data, valor e descrição.")
+        self.existing_id = existing_id
+
+def _normalize_description(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode().lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+def transaction_fingerprint(user_id: int, date: str, amount: float, description: str, source_ref: str = None) -> str:
+    """Hash of what makes two transactions the same entry: user, day, amount in cents,
+    description without case/accents/punctuation, and the statement reference if any."""
+    key = f"{user_id}|{str(date)[:10]}|{round(float(amount or 0) * 100)}|{_normalize_description(description)}|{source_ref or ''}"
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+def _find_duplicates(conn: sqlite3.Connection, user_id: int, rows: List[Dict[str, Any]], window_days: int = None) -> List[Dict[str, Any]]:
+    """Matches `rows` (each with fingerprint, date and amount) against the stored
+    transactions with two set-wise queries through a temp table: one join on the
+    fingerprint index for exact duplicates and one on (user_id, date) for rows with the
+    same amount within ±`window_days` (CROSS JOIN keeps the incoming rows as the outer
+    loop, so each one is an index probe). Returns, per row, {"duplicate_of": id or None,
+    "similar": [ids]}."""
+    window = DUPLICATE_WINDOW_DAYS if window_days is None else int(window_days)
+    out = [{"duplicate_of": None, "similar": []} for _ in rows]
+    if not rows:
+        return out
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS incoming (idx INTEGER PRIMARY KEY, fingerprint TEXT, date TEXT, amount REAL)")
+    conn.execute("DELETE FROM temp.incoming")
+    conn.executemany("INSERT INTO temp.incoming (idx, fingerprint, date, amount) VALUES (?, ?, ?, ?)",
+                     [(i, r['fingerprint'], str(r['date'])[:10], r['amount']) for i, r in enumerate(rows)])
+    for idx, trans_id in conn.execute("""SELECT i.idx, t.id FROM temp.incoming i
+                                         CROSS JOIN transactions t ON t.user_id = ? AND t.fingerprint = i.fingerprint""", (user_id,)):
+        out[idx]["duplicate_of"] = trans_id
+    if window >= 0:
+        for idx, trans_id in conn.execute("""SELECT i.idx, t.id FROM temp.incoming i
+                                             CROSS JOIN transactions t ON t.user_id = ? AND t.date >= date(i.date, ?) AND t.date < date(i.date, ?) AND t.amount = i.amount
+                                             ORDER BY i.idx, t.date""", (user_id, f"-{window} days", f"+{window + 1} days")):
+            if trans_id != out[idx]["duplicate_of"]:
+                out[idx]["similar"].append(trans_id)
+    conn.execute("DROP TABLE temp.incoming")
+    return out
+
+def _refresh_fingerprint(conn: sqlite3.Connection, user_id: int, trans_id: int):
+    """Recomputes an edited row's fingerprint. Edits are never refused as duplicates: if
+    another row already has the new fingerprint, this one is left without."""
+    row = conn.execute("SELECT date, amount, description, source_ref FROM transactions WHERE id = ? AND user_id = ?", (trans_id, user_id)).fetchone()
+    if row is None:
+        return
+    fingerprint = transaction_fingerprint(user_id, row['date'], row['amount'], row['description'], row['source_ref'])
+    conn.execute("""UPDATE transactions SET fingerprint = CASE WHEN EXISTS
+                      (SELECT 1 FROM transactions WHERE user_id = ?1 AND fingerprint = ?2 AND id <> ?3) THEN NULL ELSE ?2 END
+                    WHERE id = ?3 AND user_id = ?1""", (user_id, fingerprint, trans_id))
+
+def find_duplicates(user_id: int, rows: List[Dict[str, Any]], window_days: int = None) -> List[Dict[str, Any]]:
+    """Checks candidate transactions (date, amount, description, optional source_ref)
+    against the stored ones without writing; see _find_duplicates for the result."""
+    rows = [dict(r, fingerprint=transaction_fingerprint(user_id, r['date'], r['amount'], r.get('description'), r.get('source_ref'))) for r in rows]
+    with get_conn(user_id) as conn:
+        return _find_duplicates(conn, user_id, rows, window_days)
+
+def add_transaction(user_id: int, date: str, desc: str, category_id: int, amount: float, typ: str, note: str = "", status: str = "paid",
+                    recurring_id: int = None, source_ref: str = None, allow_duplicate: bool = False, currency: str = None) -> int:
+    """Adds a transaction and returns its id.
+
+    `currency` defaults to the user's base currency. Raises DuplicateTransactionError
+    when an identical one (same fingerprint) exists, unless `allow_duplicate`, in which
+    case the new row is stored without a fingerprint.
+    """
+    currency = normalize_currency(currency)
+    fingerprint = None if allow_duplicate else transaction_fingerprint(user_id, date, amount, desc, source_ref)
+    with get_conn(user_id) as conn:
+        try:
+            cur = conn.execute("INSERT INTO transactions(user_id, date, description, category_id, amount, type, note, status, recurring_id, source_ref, fingerprint, currency) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",
+                               (user_id, date, desc, category_id, amount, typ, note, status, recurring_id, source_ref, fingerprint, currency))
+        except sqlite3.IntegrityError:
+            existing = conn.execute("SELECT id FROM transactions WHERE user_id = ? AND fingerprint = ?", (user_id, fingerprint)).fetchone()
+            if existing is None:
+                raise
+            raise DuplicateTransactionError(existing['id'])
+        _track_transaction_write(conn, user_id, new={"date": date, "category_id": category_id, "amount": amount, "type": typ, "currency": currency})
         conn.commit()
+        return cur.lastrowid
 
 def delete_transaction(trans_id: int, user_id: int):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
+        old = conn.execute("SELECT date, category_id, amount, type, currency FROM transactions WHERE id = ? AND user_id = ?", (trans_id, user_id)).fetchone()
         conn.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (trans_id, user_id))
+        _track_transaction_write(conn, user_id, old=old)
         conn.commit()
 
 def get_transaction_by_id(trans_id: int, user_id: int) -> Optional[Dict[str, Any]]:
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         row = conn.execute("SELECT t.*, c.name as category FROM transactions t LEFT JOIN categories c ON t.category_id = c.id WHERE t.id = ? AND t.user_id = ?", (trans_id, user_id)).fetchone()
         return dict(row) if row else None
 
-def update_transaction(trans_id: int, user_id: int, date: str, desc: str, category_id: int, amount: float, typ: str, note: str = "", status: str = "paid"):
-    with get_conn() as conn:
-        conn.execute("UPDATE transactions SET date = ?, description = ?, category_id = ?, amount = ?, type = ?, note = ?, status = ? WHERE id = ? AND user_id = ?", (date, desc, category_id, amount, typ, note, status, trans_id, user_id))
+def update_transaction(trans_id: int, user_id: int, date: str, desc: str, category_id: int, amount: float, typ: str, note: str = "", status: str = "paid",
+                       currency: str = None):
+    """Rewrites a transaction; `currency` None puts it in the user's base currency."""
+    currency = normalize_currency(currency)
+    with get_conn(user_id) as conn:
+        old = conn.execute("SELECT date, category_id, amount, type, currency FROM transactions WHERE id = ? AND user_id = ?", (trans_id, user_id)).fetchone()
+        conn.execute("UPDATE transactions SET date = ?, description = ?, category_id = ?, amount = ?, type = ?, note = ?, status = ?, currency = ? WHERE id = ? AND user_id = ?",
+                     (date, desc, category_id, amount, typ, note, status, currency, trans_id, user_id))
+        _refresh_fingerprint(conn, user_id, trans_id)
+        if old:
+            _track_transaction_write(conn, user_id, old=old, new={"date": date, "category_id": category_id, "amount": amount, "type": typ,
+                                                                  "currency": currency})
+        conn.commit()
+
+TRANSACTION_TYPES = ("income", "expense")
+TRANSACTION_STATUSES = ("paid", "pendente")
+_BATCH_FIELDS = ("date", "description", "category_id", "amount", "type", "note", "status", "source_ref", "currency")
+DUPLICATE_MODES = ("skip", "flag", "error")
+
+def parse_batch_amount(value: Any) -> float:
+    """A batch amount as a finite float: numbers or numeric text ("1234.56"), not bools."""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("Valor inválido")
+    try:
+        amount = float(value)
+    except (OverflowError, ValueError):
+        raise ValueError("Valor inválido")
+    if not math.isfinite(amount):
+        raise ValueError("Valor inválido")
+    return amount
+
+def _batch_id(op: Dict[str, Any]) -> Optional[int]:
+    value = op.get("id")
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+def _validate_batch_op(op: Dict[str, Any], current: Dict[int, Optional[Dict[str, Any]]], categories: Dict[str, int]) -> Dict[str, Any]:
+    """Resolves one batch operation into the row to write. Raises ValueError when invalid."""
+    kind = op.get("op")
+    if kind not in ("create", "update", "delete"):
+        raise ValueError("Operação deve ser create, update ou delete")
+    if kind != "create":
+        if _batch_id(op) is None or current.get(op["id"]) is None:
+            raise ValueError("Transação não encontrada")
+        if kind == "delete":
+            return {}
+    for field in ("description", "note", "source_ref", "category", "currency"):
+        if op.get(field) is not None and not isinstance(op[field], str):
+            raise ValueError(f"Campo {field} deve ser texto")
+    row = dict(current[op["id"]]) if kind == "update" else {"description": "", "category_id": None, "note": "", "status": "paid", "source_ref": None, "currency": None}
+    row.update({f: op[f] for f in _BATCH_FIELDS if f in op})
+    if "category" in op:
+        if op["category"] and op["category"] not in categories:
+            raise ValueError(f"Categoria não encontrada: {op['category']}")
+        row["category_id"] = categories.get(op["category"])
+    elif row["category_id"] is not None and row["category_id"] not in categories.values():
+        raise ValueError("Categoria não encontrada")
+    if kind == "create" or "date" in op:
+        # Exactly YYYY-MM-DD; stored rows keep whatever date they already had
+        date = row.get("date")
+        try:
+            if not isinstance(date, str) or len(date) != 10:
+                raise ValueError
+            row["date"] = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            raise ValueError("Data deve estar no formato AAAA-MM-DD")
+    row["amount"] = parse_batch_amount(row.get("amount"))
+    if row.get("type") not in TRANSACTION_TYPES:
+        raise ValueError("Tipo deve ser income ou expense")
+    if row["status"] not in TRANSACTION_STATUSES:
+        raise ValueError("Status deve ser paid ou pendente")
+    row["currency"] = normalize_currency(row.get("currency"))
+    return row
+
+def apply_transaction_batch(user_id: int, ops: List[Dict[str, Any]], duplicates: str = "skip") -> Dict[str, Any]:
+    """Creates, updates and deletes many transactions at once.
+
+    Each op is {"op": "create"|"update"|"delete", "id": ..., plus the fields to write:
+    date, description, amount, type, note, status, source_ref, currency and either
+    "category" (a name) or "category_id"}; an update only changes the fields it names. Every op is
+    checked first, against one lookup of the referenced rows and one of the categories,
+    and they are applied in one transaction only if all are valid. Returns {"applied",
+    "results"}, one result per op in order: {"index", "op", "ok": True, "id"} or
+    {..., "ok": False, "error"}.
+
+    Creates are matched against stored transactions (and each other) in one set-wise
+    pass. One with an identical fingerprint gets "duplicate_of" (an id, or the index of
+    an earlier op) and, by `duplicates`, is left out ("skip", with "skipped": true),
+    stored anyway ("flag") or fails the batch ("error"). Rows with the same amount within
+    DUPLICATE_WINDOW_DAYS are listed in "similar".
+    """
+    if duplicates not in DUPLICATE_MODES:
+        raise ValueError("duplicates deve ser skip, flag ou error")
+    ids = list({_batch_id(op) for op in ops if isinstance(op, dict) and _batch_id(op) is not None})
+    with get_conn(user_id) as conn:
+        # Ops run in order, so validation tracks the rows as the earlier ops leave them
+        current: Dict[int, Optional[Dict[str, Any]]] = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            q = f"SELECT id, {', '.join(_BATCH_FIELDS)} FROM transactions WHERE user_id = ? AND id IN ({', '.join('?' * len(chunk))})"
+            current.update((r['id'], {f: r[f] for f in _BATCH_FIELDS}) for r in conn.execute(q, (user_id, *chunk)))
+        categories = {r['name']: r['id'] for r in conn.execute("SELECT id, name FROM categories WHERE user_id = ?", (user_id,))}
+
+        writes, results = [], []
+        for index, op in enumerate(ops):
+            kind = op.get("op") if isinstance(op, dict) else None
+            try:
+                if kind is None:
+                    raise ValueError("Operação inválida")
+                row = _validate_batch_op(op, current, categories)
+            except ValueError as e:
+                results.append({"index": index, "op": kind, "ok": False, "error": str(e)})
+                continue
+            results.append({"index": index, "op": kind, "ok": True, "id": op.get("id")})
+            old = current.get(op.get("id")) if kind != "create" else None
+            if kind != "create":
+                current[op["id"]] = row or None
+            writes.append((kind, op.get("id"), old, row, results[-1]))
+        if not all(r["ok"] for r in results):
+            return {"applied": False, "results": results}
+
+        creates = [(row, result) for kind, _, _, row, result in writes if kind == "create"]
+        for row, _ in creates:
+            row["fingerprint"] = transaction_fingerprint(user_id, row["date"], row["amount"], row["description"], row["source_ref"])
+        first_index: Dict[str, int] = {}
+        for (row, result), check in zip(creates, _find_duplicates(conn, user_id, [row for row, _ in creates])):
+            if check["similar"]:
+                result["similar"] = check["similar"]
+            if check["duplicate_of"] in current and current[check["duplicate_of"]] is None:
+                check["duplicate_of"] = None  # deleted earlier in this batch
+            duplicate_of = check["duplicate_of"] if check["duplicate_of"] is not None else first_index.get(row["fingerprint"])
+            if duplicate_of is None:
+                first_index[row["fingerprint"]] = result["index"]
+                continue
+            result["duplicate_of"] = duplicate_of if check["duplicate_of"] is not None else {"index": duplicate_of}
+            if duplicates == "error":
+                result.update(ok=False, error="Transação duplicada")
+            elif duplicates == "skip":
+                result["skipped"] = True
+            else:
+                row["fingerprint"] = None
+        if not all(r["ok"] for r in results):
+            return {"applied": False, "results": results}
+
+        columns = ", ".join(("user_id", *_BATCH_FIELDS, "fingerprint"))
+        for kind, trans_id, old, row, result in writes:
+            if result.get("skipped"):
+                continue
+            if kind == "create":
+                cur = conn.execute(f"INSERT INTO transactions({columns}) VALUES({', '.join('?' * (len(_BATCH_FIELDS) + 2))})",
+                                   (user_id, *(row[f] for f in _BATCH_FIELDS), row["fingerprint"]))
+                result["id"] = cur.lastrowid
+            elif kind == "delete":
+                conn.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (trans_id, user_id))
+            else:
+                conn.execute(f"UPDATE transactions SET {', '.join(f + ' = ?' for f in _BATCH_FIELDS)} WHERE id = ? AND user_id = ?",
+                             (*(row[f] for f in _BATCH_FIELDS), trans_id, user_id))
+                _refresh_fingerprint(conn, user_id, trans_id)
+            _track_transaction_write(conn, user_id, old=old, new=row or None)
         conn.commit()
+        return {"applied": True, "results": results}
 
 def calculate_filtered_summary(user_id: int, filter_category: str = None, date_from: str = None, date_to: str = None, search: str = None) -> Dict[str, float]:
-    base_q = "SELECT SUM(t.amount) FROM transactions t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ?"
+    base_q = f"SELECT SUM({_in_base(_base_sql(user_id))}) FROM {{transactions}} t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ?"
     params = [user_id]
     if filter_category: base_q += " AND c.name = ?"; params.append(filter_category)
     if date_from: base_q += " AND date(t.date) >= date(?)"; params.append(date_from)
     if date_to: base_q += " AND date(t.date) <= date(?)"; params.append(date_to)
     if search: base_q += " AND (t.description LIKE ? OR c.name LIKE ? OR t.note LIKE ?)"; params.extend([f"%{search}%"] * 3)
     
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
+        base_q = base_q.format(transactions=_source(conn, "transactions", date_from, date_to))
         paid_inc = conn.execute(base_q + " AND t.status = 'paid' AND t.type = 'income'", params).fetchone()[0] or 0.0
         paid_exp = conn.execute(base_q + " AND t.status = 'paid' AND t.type = 'expense'", params).fetchone()[0] or 0.0
         total_inc = conn.execute(base_q + " AND t.type = 'income'", params).fetchone()[0] or 0.0
@@ -194,147 +1162,576 @@ def calculate_filtered_summary(user_id: int, filter_category: str = None, date_f
         "total_income": total_inc, "total_expense": total_exp, "total_bal": total_inc - total_exp
     }
 
+# --- Archives ---
+def _archives_in_range(conn: sqlite3.Connection, date_from: str = None, date_to: str = None) -> List[sqlite3.Row]:
+    try:
+        lo = int(date_from[:4]) if date_from else 0
+        hi = int(date_to[:4]) if date_to else 9999
+    except ValueError:
+        lo, hi = 0, 9999
+    return conn.execute("SELECT year, path FROM archives WHERE year BETWEEN ? AND ? ORDER BY year", (lo, hi)).fetchall()
+
+def _attach_archive(conn: sqlite3.Connection, year: int, path: str) -> str:
+    schema = f"archive_{year}"
+    if schema not in {r[1] for r in conn.execute("PRAGMA database_list")}:
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+    return schema
+
+def _source(conn: sqlite3.Connection, table: str, date_from: str = None, date_to: str = None) -> str:
+    """Returns what a reader should select `table` rows from.
+
+    That is the hot table itself, unless the date range reaches a year archived by
+    helpers/archive.py; then the archive files are attached and UNIONed in. Columns an
+    older archive lacks read as NULL.
+    """
+    archives = _archives_in_range(conn, date_from, date_to)
+    if not archives:
+        return table
+    cols = [r[1] for r in conn.execute(f"PRAGMA main.table_info({table})")]
+    parts = [f"SELECT {', '.join(cols)} FROM main.{table}"]
+    for a in archives:
+        schema = _attach_archive(conn, a['year'], a['path'])
+        present = {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+        parts.append("SELECT " + ", ".join(c if c in present else f"NULL AS {c}" for c in cols) + f" FROM {schema}.{table}")
+    return "(" + " UNION ALL ".join(parts) + ")"
+
+def get_monthly_rollups(user_id: int, date_from: str = None, date_to: str = None, mode: str = "dicts"):
+    """Returns the per-month, per-category totals kept for archived months."""
+    q = "SELECT r.month, r.category_id, c.name as category, r.type, r.status, r.total, r.count FROM monthly_rollups r LEFT JOIN categories c ON r.category_id = c.id WHERE r.user_id = ?"
+    params = [user_id]
+    if date_from: q += " AND r.month >= ?"; params.append(date_from[:7])
+    if date_to: q += " AND r.month <= ?"; params.append(date_to[:7])
+    q += " ORDER BY r.month, category"
+    with get_conn(user_id) as conn:
+        return _fetch(conn, q, params, mode)
+
 # --- Shared Data Handling ---
-def to_df(rows: List[Dict[str, Any]]) -> pd.DataFrame:
-    if not rows: return pd.DataFrame()
+def _next_month(month: str) -> str:
+    """'2026-12' -> '2027-01'."""
+    year, mon = int(month[:4]), int(month[5:7])
+    return f"{year + mon // 12}-{mon % 12 + 1:02d}"
+
+def to_df(rows) -> pd.DataFrame:
+    """DataFrame from rows in any of the FETCH_MODES; "columns" is the cheapest."""
+    if isinstance(rows, dict):
+        if not rows or not len(next(iter(rows.values()))): return pd.DataFrame()
+    elif not rows: return pd.DataFrame()
     df = pd.DataFrame(rows)
     if "amount" in df.columns: df["amount"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0.0)
     return df
 
 # --- Recurring Expenses ---
 def add_recurring_expense(user_id: int, description: str, amount: float, day_of_month: int, category_id: int):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("INSERT INTO recurring_expenses (user_id, description, amount, day_of_month, category_id) VALUES (?, ?, ?, ?, ?)", (user_id, description, amount, day_of_month, category_id))
         conn.commit()
 
 def delete_recurring_expense(rule_id: int, user_id: int):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("DELETE FROM recurring_expenses WHERE id = ? AND user_id = ?", (rule_id, user_id))
         conn.commit()
 
-def fetch_recurring_expenses(user_id: int) -> List[Dict[str, Any]]:
-    with get_conn() as conn:
-        rows = conn.execute("SELECT r.*, c.name as category FROM recurring_expenses r LEFT JOIN categories c ON r.category_id = c.id WHERE r.user_id = ? ORDER BY r.day_of_month", (user_id,)).fetchall()
-        return [dict(r) for r in rows]
+def fetch_recurring_expenses(user_id: int, mode: str = "dicts"):
+    with get_conn(user_id) as conn:
+        return _fetch(conn, "SELECT r.*, c.name as category FROM recurring_expenses r LEFT JOIN categories c ON r.category_id = c.id WHERE r.user_id = ? ORDER BY r.day_of_month", (user_id,), mode)
 
 # --- Savings ---
-def get_savings_for_user(user_id: int) -> List[Dict[str, Any]]:
-    with get_conn() as conn:
-        rows = conn.execute("SELECT * FROM savings WHERE user_id = ? ORDER BY name", (user_id,)).fetchall()
-        return [dict(r) for r in rows]
+def get_savings_for_user(user_id: int, mode: str = "dicts"):
+    with get_conn(user_id) as conn:
+        return _fetch(conn, "SELECT * FROM savings WHERE user_id = ? ORDER BY name", (user_id,), mode)
 
 # --- Salary & Bonus ---
 def get_salary_info(user_id: int) -> Dict[str, float]:
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         row = conn.execute("SELECT salary, bonus FROM salary_info WHERE user_id = ?", (user_id,)).fetchone()
         return {"salary": row['salary'], "bonus": row['bonus']} if row else {"salary": 0.0, "bonus": 0.0}
 
 def set_salary_info(user_id: int, salary: float, bonus: float):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("INSERT INTO salary_info (user_id, salary, bonus) VALUES (?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET salary = excluded.salary, bonus = excluded.bonus", (user_id, salary, bonus))
         conn.commit()
 
 # --- Receivables ---
-def add_receivable(user_id: int, debtor_name: str, description: str, amount: float, date: str, status: str = 'pending', recurring_id: int = None, reference_month: str = None):
-    with get_conn() as conn:
-        conn.execute("INSERT INTO receivables (user_id, debtor_name, description, amount, date, status, recurring_id, reference_month) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (user_id, debtor_name, description, amount, date, status, recurring_id, reference_month))
+def add_receivable(user_id: int, debtor_name: str, description: str, amount: float, date: str, status: str = 'pending', recurring_id: int = None, reference_month: str = None,
+                   currency: str = None):
+    currency = normalize_currency(currency)
+    with get_conn(user_id) as conn:
+        conn.execute("INSERT INTO receivables (user_id, debtor_name, description, amount, date, status, recurring_id, reference_month, currency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (user_id, debtor_name, description, amount, date, status, recurring_id, reference_month, currency))
         conn.commit()
 
 def get_receivable_by_id(receivable_id: int, user_id: int) -> Optional[Dict[str, Any]]:
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         row = conn.execute("SELECT * FROM receivables WHERE id = ? AND user_id = ?", (receivable_id, user_id)).fetchone()
         return dict(row) if row else None
 
-def get_receivables_by_user(user_id: int, status: str = None) -> List[Dict[str, Any]]:
+def get_receivables_by_user(user_id: int, status: str = None, mode: str = "dicts"):
     q = "SELECT * FROM receivables WHERE user_id = ? AND recurring_id IS NULL"
     params = [user_id]
     if status: q += " AND status = ?"; params.append(status)
     q += " ORDER BY date DESC"
-    with get_conn() as conn:
-        rows = conn.execute(q, params).fetchall()
-        return [dict(r) for r in rows]
+    with get_conn(user_id) as conn:
+        return _fetch(conn, q, params, mode)
 
-def get_paid_receivables_history(user_id: int) -> List[Dict[str, Any]]:
-    with get_conn() as conn:
-        rows = conn.execute("SELECT * FROM receivables WHERE user_id = ? AND status = 'paid' ORDER BY date DESC", (user_id,)).fetchall()
+def get_paid_receivables_page(user_id: int, limit: int = 30, before_date: str = None, before_id: int = None,
+                              before_src: int = None) -> List[Dict[str, Any]]:
+    """Returns up to `limit` paid receivables older than the (before_date, before_src,
+    before_id) cursor, newest first. Keyset pagination: each page is an index range scan
+    whatever its depth.
+
+    The hot table and the archived years are merged in one ordered query. Row ids are
+    only unique within a file, so each row carries `src` (0 for the hot table, the year
+    for an archive) and the cursor orders by (date, src, id).
+    """
+    with get_conn(user_id) as conn:
+        sources = [(0, "main")] + [(a['year'], _attach_archive(conn, a['year'], a['path']))
+                                   for a in _archives_in_range(conn, None, before_date)]
+        parts, params = [], []
+        for src, schema in sources:
+            q = f"SELECT {src} AS src, id, debtor_name, description, amount, date FROM {schema}.receivables WHERE user_id = ? AND status = 'paid'"
+            params.append(user_id)
+            if before_date:
+                # Rows of this source after the cursor, given that src is fixed here
+                if before_src is None or src == before_src:
+                    q += " AND (date, id) < (?, ?)"; params.extend([before_date, before_id if before_id is not None else -1])
+                elif src < before_src:
+                    q += " AND date <= ?"; params.append(before_date)
+                else:
+                    q += " AND date < ?"; params.append(before_date)
+            parts.append(f"SELECT * FROM ({q} ORDER BY date DESC, id DESC LIMIT ?)")
+            params.append(limit)
+        rows = conn.execute(" UNION ALL ".join(parts) + " ORDER BY date DESC, src DESC, id DESC LIMIT ?", params + [limit]).fetchall()
         return [dict(r) for r in rows]
 
+def get_receivables_totals(user_id: int, reference_month: str, payment_month: str) -> Dict[str, float]:
+    """Pending totals for the receivables page, in one query.
+
+    `cycle` is what comes in for `reference_month`: recurring rules not yet paid in
+    `payment_month`, plus manual receivables whose reference month is `reference_month`
+    or whose due date falls in `payment_month`. `all_time` adds every other pending
+    manual receivable (overdue and future). Amounts are in the user's base currency.
+    """
+    amount = _in_base(_base_sql(user_id), "r.amount", "r.currency", "r.date")
+    q = f"""SELECT
+             (SELECT COALESCE(SUM(rr.amount), 0) FROM recurring_receivables rr WHERE rr.user_id = :uid
+                AND NOT EXISTS (SELECT 1 FROM receivables p WHERE p.user_id = :uid AND p.recurring_id = rr.id AND p.status = 'paid'
+                                AND p.date >= :pay_from AND p.date < :pay_to)) AS recurring,
+             COALESCE(SUM(CASE WHEN COALESCE(r.reference_month, substr(r.date, 1, 7)) = :ref
+                                 OR (r.date >= :pay_from AND r.date < :pay_to) THEN {amount} END), 0) AS manual_cycle,
+             COALESCE(SUM({amount}), 0) AS manual_all
+           FROM receivables r WHERE r.user_id = :uid AND r.status = 'pending' AND r.recurring_id IS NULL"""
+    params = {"uid": user_id, "ref": reference_month, "pay_from": f"{payment_month}-01", "pay_to": _next_month(payment_month) + "-01"}
+    with get_conn(user_id) as conn:
+        row = conn.execute(q, params).fetchone()
+    return {"cycle": row['recurring'] + row['manual_cycle'], "all_time": row['recurring'] + row['manual_all']}
+
 def update_receivable_status(receivable_id: int, user_id: int, new_status: str):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("UPDATE receivables SET status = ? WHERE id = ? AND user_id = ? AND recurring_id IS NULL", (new_status, receivable_id, user_id))
         conn.commit()
 
 def delete_receivable(receivable_id: int, user_id: int):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("DELETE FROM receivables WHERE id = ? AND user_id = ?", (receivable_id, user_id))
         conn.commit()
 
+# Aging buckets, in order, with their labels
+AGING_BUCKETS = {"current": "A vencer", "1-30": "1–30 dias", "31-60": "31–60 dias", "61-90": "61–90 dias", "90+": "90+ dias"}
+
+def get_receivables_aging(user_id: int, as_of: str = None) -> Dict[str, Any]:
+    """Ages everything still owed to the user on `as_of` (default today).
+
+    That is every pending manual receivable, plus this month's occurrence of each
+    recurring rule not yet paid this month, bucketed by days past the due date. One
+    grouped query returns (debtor, due month, bucket) totals, in the user's base
+    currency, from which the totals per bucket, per debtor and per month are assembled.
+    """
+    as_of = as_of or datetime.now().strftime('%Y-%m-%d')
+    month = as_of[:7]
+    q = f"""WITH items AS (
+             SELECT r.debtor_name, {_in_base(_base_sql(user_id), "r.amount", "r.currency", "r.date")} AS amount, r.date AS due FROM receivables r
+              WHERE user_id = :uid AND status = 'pending' AND recurring_id IS NULL
+             UNION ALL
+             SELECT rr.debtor_name, rr.amount, date(:month_start, printf('+%d days', MIN(rr.day_of_month, :last_day) - 1))
+               FROM recurring_receivables rr
+              WHERE rr.user_id = :uid AND NOT EXISTS (
+                    SELECT 1 FROM receivables p WHERE p.user_id = :uid AND p.status = 'paid' AND p.date >= :month_start
+                       AND p.date < :next_start AND p.recurring_id = rr.id)
+           ), aged AS (
+             SELECT debtor_name, amount, substr(due, 1, 7) AS month, CAST(julianday(:as_of) - julianday(due) AS INTEGER) AS days FROM items
+           )
+           SELECT debtor_name, month,
+                  CASE WHEN days IS NULL OR days <= 0 THEN 'current' WHEN days <= 30 THEN '1-30' WHEN days <= 60 THEN '31-60'
+                       WHEN days <= 90 THEN '61-90' ELSE '90+' END AS bucket,
+                  COALESCE(SUM(amount), 0) AS total, COUNT(*) AS count
+           FROM aged GROUP BY debtor_name, month, bucket"""
+    params = {"uid": user_id, "as_of": as_of, "month_start": f"{month}-01", "next_start": _next_month(month) + "-01",
+              "last_day": calendar.monthrange(int(month[:4]), int(month[5:7]))[1]}
+    with get_conn(user_id) as conn:
+        rows = conn.execute(q, params).fetchall()
+
+    def empty(**key):
+        return dict(key, buckets=dict.fromkeys(AGING_BUCKETS, 0.0), total=0.0, count=0)
+    totals, by_debtor, by_month = empty(), {}, {}
+    for r in rows:
+        for group in (totals, by_debtor.setdefault(r['debtor_name'], empty(debtor=r['debtor_name'])),
+                      by_month.setdefault(r['month'], empty(month=r['month']))):
+            group['buckets'][r['bucket']] += r['total']
+            group['total'] += r['total']
+            group['count'] += r['count']
+    return {
+        "as_of": as_of,
+        "totals": totals,
+        "by_debtor": sorted(by_debtor.values(), key=lambda d: -d['total']),
+        "by_month": sorted(by_month.values(), key=lambda m: m['month'] or ""),
+    }
+
 # --- Recurring Receivables ---
 def add_recurring_receivable(user_id: int, debtor_name: str, description: str, amount: float, day_of_month: int):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("INSERT INTO recurring_receivables (user_id, debtor_name, description, amount, day_of_month) VALUES (?, ?, ?, ?, ?)", (user_id, debtor_name, description, amount, day_of_month))
         conn.commit()
 
-def get_recurring_receivables_by_user(user_id: int) -> List[Dict[str, Any]]:
-    with get_conn() as conn:
-        rows = conn.execute("SELECT * FROM recurring_receivables WHERE user_id = ? ORDER BY day_of_month", (user_id,)).fetchall()
-        return [dict(r) for r in rows]
+def get_recurring_receivables_by_user(user_id: int, mode: str = "dicts"):
+    with get_conn(user_id) as conn:
+        return _fetch(conn, "SELECT * FROM recurring_receivables WHERE user_id = ? ORDER BY day_of_month", (user_id,), mode)
 
 def get_recurring_receivable_by_id(rule_id: int, user_id: int) -> Optional[Dict[str, Any]]:
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         row = conn.execute("SELECT * FROM recurring_receivables WHERE id = ? AND user_id = ?", (rule_id, user_id)).fetchone()
         return dict(row) if row else None
 
 def delete_recurring_receivable(rule_id: int, user_id: int):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("DELETE FROM recurring_receivables WHERE id = ? AND user_id = ?", (rule_id, user_id))
         conn.commit()
 
 def get_paid_recurring_ids_for_month(user_id: int, month_str: str) -> Set[int]:
-    with get_conn() as conn:
-        rows = conn.execute("SELECT recurring_id FROM receivables WHERE user_id = ? AND recurring_id IS NOT NULL AND status = 'paid' AND strftime('%Y-%m', date) = ?", (user_id, month_str)).fetchall()
+    with get_conn(user_id) as conn:
+        rows = conn.execute("SELECT recurring_id FROM receivables WHERE user_id = ? AND status = 'paid' AND date >= ? AND date < ? AND recurring_id IS NOT NULL", (user_id, f"{month_str}-01", _next_month(month_str) + "-01")).fetchall()
         return {r[0] for r in rows}
 
+# --- Budgets ---
+def set_budgets(user_id: int, month: str, amounts: Dict[int, Optional[float]]):
+    """Saves a whole month of budgets in one transaction.
+
+    `amounts` maps category ids to the budgeted amount; None removes that budget.
+    Categories left out are not touched.
+    """
+    upserts = [(category_id, amount, month, user_id) for category_id, amount in amounts.items() if amount is not None]
+    removals = [(category_id, month, user_id) for category_id, amount in amounts.items() if amount is None]
+    with get_conn(user_id) as conn:
+        # The subquery keeps ids of other users' categories out
+        conn.executemany("""INSERT INTO budgets (category_id, amount, month, user_id)
+                            SELECT id, ?2, ?3, ?4 FROM categories WHERE id = ?1 AND user_id = ?4
+                            ON CONFLICT(category_id, month, user_id) DO UPDATE SET amount = excluded.amount""", upserts)
+        conn.executemany("DELETE FROM budgets WHERE category_id = ? AND month = ? AND user_id = ?", removals)
+        conn.commit()
+
+def set_budget(user_id: int, category_id: int, amount: float, month: str):
+    set_budgets(user_id, month, {category_id: amount})
+
+def delete_budget(user_id: int, category_id: int, month: str) -> bool:
+    with get_conn(user_id) as conn:
+        deleted = conn.execute("DELETE FROM budgets WHERE category_id = ? AND month = ? AND user_id = ?", (category_id, month, user_id)).rowcount
+        conn.commit()
+        return deleted > 0
+
+def copy_budgets(user_id: int, source_month: str, target_months: List[str], overwrite: bool = False) -> int:
+    """Copies a month's budgets into each of `target_months` in one statement and one
+    transaction. Budgets already set in a target month are kept unless `overwrite`.
+    Returns the number of budgets written."""
+    if not target_months:
+        return 0
+    targets = " UNION ALL ".join("SELECT ? AS month" for _ in target_months)
+    conflict = "DO UPDATE SET amount = excluded.amount" if overwrite else "DO NOTHING"
+    q = f"""INSERT INTO budgets (category_id, amount, month, user_id)
+            SELECT b.category_id, b.amount, t.month, b.user_id FROM budgets b, ({targets}) t
+            WHERE b.user_id = ? AND b.month = ? AND t.month <> b.month
+            ON CONFLICT(category_id, month, user_id) {conflict}"""
+    with get_conn(user_id) as conn:
+        written = conn.execute(q, [*target_months, user_id, source_month]).rowcount
+        conn.commit()
+        return written
+
+def get_budget_grid(user_id: int, first_month: str, months: int = 12) -> Dict[str, Any]:
+    """Budget vs. actual per category for `months` months starting at `first_month`.
+
+    Budgets and expenses are summed per (category, month) in one grouped query; the
+    expense side is a range scan on transactions (user_id, date), converted to the
+    user's base currency.
+    """
+    month_list = [first_month]
+    for _ in range(months - 1):
+        month_list.append(_next_month(month_list[-1]))
+    start, end = f"{first_month}-01", _next_month(month_list[-1]) + "-01"
+    q = f"""SELECT category_id, month, SUM(budgeted) AS budgeted, SUM(spent) AS spent FROM (
+             SELECT category_id, month, amount AS budgeted, 0 AS spent FROM budgets
+              WHERE user_id = ? AND month >= ? AND month <= ?
+             UNION ALL
+             SELECT t.category_id, substr(t.date, 1, 7), 0, {_in_base(_base_sql(user_id))} FROM {{transactions}} t
+              WHERE t.user_id = ? AND t.type = 'expense' AND t.date >= ? AND t.date < ?
+           ) GROUP BY category_id, month"""
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", start, end))
+        cells = {(r['category_id'], r['month']): r for r in conn.execute(q, (user_id, month_list[0], month_list[-1], user_id, start, end)).fetchall()}
+        categories = conn.execute("SELECT id, name FROM categories WHERE user_id = ? ORDER BY name", (user_id,)).fetchall()
+
+    rows = []
+    totals = [{"month": m, "budgeted": 0.0, "spent": 0.0} for m in month_list]
+    for c in categories:
+        row = {"category_id": c['id'], "category_name": c['name'], "cells": [], "budgeted": 0.0, "spent": 0.0}
+        for m, total in zip(month_list, totals):
+            cell = cells.get((c['id'], m))
+            budgeted, spent = (cell['budgeted'] or 0.0, cell['spent'] or 0.0) if cell else (0.0, 0.0)
+            row['cells'].append({"month": m, "budgeted": budgeted, "spent": spent, "remaining": budgeted - spent})
+            row['budgeted'] += budgeted
+            row['spent'] += spent
+            total['budgeted'] += budgeted
+            total['spent'] += spent
+        rows.append(row)
+    return {"months": month_list, "rows": rows, "totals": totals}
+
+# --- Budget Usage & Notifications ---
+def _track_transaction_write(conn: sqlite3.Connection, user_id: int, old=None, new=None):
+    """Applies one transaction write to the budget_usage counters and the balance
+    checkpoints, inside the caller's database transaction, and notifies budget
+    thresholds the write crosses.
+
+    `old`/`new` are the row before/after the write (None for an insert/delete), with at
+    least date, category_id, amount and type, and currency when not the base one. Costs
+    a few primary-key lookups, whatever the size of the month (plus one checkpoint per
+    later month for back-dated writes).
+    """
+    deltas, balance_deltas = {}, {}
+    for row, sign in ((old, -1), (new, 1)):
+        if not row:
+            continue
+        amount, month = sign * _amount_in_base(conn, user_id, row), row['date'][:7]
+        balance_deltas[month] = balance_deltas.get(month, 0.0) + (amount if row['type'] == 'income' else -amount)
+        if row['type'] == 'expense' and row['category_id'] is not None:
+            key = (row['category_id'], month)
+            deltas[key] = deltas.get(key, 0.0) + amount
+    for month, delta in balance_deltas.items():
+        if delta:
+            _shift_balance_checkpoints(conn, user_id, month, delta)
+    for (category_id, month), delta in deltas.items():
+        if not delta:
+            continue
+        conn.execute("""INSERT INTO budget_usage (user_id, category_id, month, spent) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(user_id, category_id, month) DO UPDATE SET spent = spent + excluded.spent""", (user_id, category_id, month, delta))
+        spent = conn.execute("SELECT spent FROM budget_usage WHERE user_id = ? AND category_id = ? AND month = ?", (user_id, category_id, month)).fetchone()[0]
+        if delta > 0:
+            _notify_budget_thresholds(conn, user_id, category_id, month, spent - delta, spent)
+
+def _notify_budget_thresholds(conn: sqlite3.Connection, user_id: int, category_id: int, month: str, before: float, after: float):
+    budget = conn.execute("SELECT b.amount, c.name FROM budgets b JOIN categories c ON c.id = b.category_id WHERE b.category_id = ? AND b.month = ? AND b.user_id = ?",
+                          (category_id, month, user_id)).fetchone()
+    if not budget or not budget[0] or budget[0] <= 0:
+        return
+    amount, name = budget
+    for threshold in BUDGET_ALERT_THRESHOLDS:
+        limit = amount * threshold
+        if before < limit <= after:
+            message = (f"Orçamento de {name} estourado em {month_label(month)}" if threshold >= 1
+                       else f"{threshold:.0%} do orçamento de {name} usados em {month_label(month)}")
+            # One alert per threshold and month, even if spending dips and crosses again
+            conn.execute("INSERT OR IGNORE INTO notifications (user_id, kind, category_id, month, threshold, message) VALUES (?, 'budget', ?, ?, ?, ?)",
+                         (user_id, category_id, month, threshold, message))
+
+def _rebuild_budget_usage(conn: sqlite3.Connection, user_id: int = None):
+    """Recomputes budget_usage from the hot transactions (archived years are closed)."""
+    where, params = ("AND user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    conn.execute(f"DELETE FROM budget_usage WHERE 1 = 1 {where}", params)
+    conn.execute(f"""INSERT INTO budget_usage (user_id, category_id, month, spent)
+                     SELECT t.user_id, t.category_id, substr(t.date, 1, 7), COALESCE(SUM({_in_base(_base_sql('t.user_id'))}), 0) FROM transactions t
+                     WHERE t.type = 'expense' AND t.category_id IS NOT NULL {where.replace('user_id', 't.user_id')}
+                     GROUP BY t.user_id, t.category_id, substr(t.date, 1, 7)""", params)
+
+def rebuild_budget_usage(user_id: int):
+    """Recomputes a user's budget counters, e.g. after moving them to another shard."""
+    with get_conn(user_id) as conn:
+        _rebuild_budget_usage(conn, user_id)
+        conn.commit()
+
+def _shift_balance_checkpoints(conn: sqlite3.Connection, user_id: int, month: str, delta: float):
+    """Adds `delta` to the net of `month` and to the balance of `month` and every later month."""
+    conn.execute("""INSERT INTO balance_checkpoints (user_id, month, net, balance)
+                    VALUES (?, ?, 0, COALESCE((SELECT balance FROM balance_checkpoints WHERE user_id = ? AND month < ? ORDER BY month DESC LIMIT 1), 0))
+                    ON CONFLICT(user_id, month) DO NOTHING""", (user_id, month, user_id, month))
+    conn.execute("UPDATE balance_checkpoints SET net = net + CASE WHEN month = ? THEN ? ELSE 0 END, balance = balance + ? WHERE user_id = ? AND month >= ?",
+                 (month, delta, delta, user_id, month))
+
+def _rebuild_balance_checkpoints(conn: sqlite3.Connection, user_id: int = None):
+    """Recomputes the checkpoints from the hot transactions plus the rollups of archived years."""
+    where, params = ("AND user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    conn.execute(f"DELETE FROM balance_checkpoints WHERE 1 = 1 {where}", params)
+    conn.execute(f"""INSERT INTO balance_checkpoints (user_id, month, net, balance)
+                     SELECT user_id, month, SUM(net), SUM(SUM(net)) OVER (PARTITION BY user_id ORDER BY month) FROM (
+                       SELECT t.user_id, substr(t.date, 1, 7) AS month, COALESCE(CASE WHEN t.type = 'income' THEN 1 ELSE -1 END * {_in_base(_base_sql('t.user_id'))}, 0) AS net
+                         FROM transactions t WHERE 1 = 1 {where.replace('user_id', 't.user_id')}
+                       UNION ALL
+                       SELECT user_id, month, CASE WHEN type = 'income' THEN total ELSE -total END FROM monthly_rollups WHERE 1 = 1 {where}
+                     ) GROUP BY user_id, month""", params * 2)
+
+def _running_balances(conn: sqlite3.Connection, user_id: int, rows, mode: str = "dicts") -> List[Optional[float]]:
+    """The running balance after each row of a page sorted newest first (fetched in `mode`).
+
+    Starts from the checkpoint before the oldest row's month and runs a window sum from
+    there to the newest row, so a page deep in the history scans at most its own span
+    plus one month.
+    """
+    ids, dates = (rows['id'], rows['date']) if mode == "columns" else ([r['id'] for r in rows], [r['date'] for r in rows])
+    if not len(ids):
+        return []
+    month, newest = dates[-1][:7], dates[0]
+    row = conn.execute("SELECT balance FROM balance_checkpoints WHERE user_id = ? AND month < ? ORDER BY month DESC LIMIT 1", (user_id, month)).fetchone()
+    q = f"""SELECT t.id, ? + SUM(COALESCE(CASE WHEN t.type = 'income' THEN 1 ELSE -1 END * {_in_base(_base_sql(user_id))}, 0)) OVER (ORDER BY t.date, t.id) AS balance
+            FROM {_source(conn, "transactions", f"{month}-01", newest)} t WHERE t.user_id = ? AND t.date >= ? AND t.date <= ?"""
+    balances = dict(conn.execute(q, (row[0] if row else 0.0, user_id, f"{month}-01", newest)).fetchall())
+    return [balances.get(int(i)) for i in ids]
+
+def rebuild_balance_checkpoints(user_id: int):
+    """Recomputes a user's balance checkpoints, e.g. after moving them to another shard."""
+    with get_conn(user_id) as conn:
+        _rebuild_balance_checkpoints(conn, user_id)
+        conn.commit()
+
+def get_notifications(user_id: int, unread_only: bool = True, limit: int = 20, mode: str = "dicts"):
+    q = "SELECT id, kind, category_id, month, threshold, message, created_at, read_at FROM notifications WHERE user_id = ?"
+    if unread_only: q += " AND read_at IS NULL"
+    q += " ORDER BY id DESC LIMIT ?"
+    with get_conn(user_id) as conn:
+        return _fetch(conn, q, (user_id, limit), mode)
+
+def count_unread_notifications(user_id: int) -> int:
+    with get_conn(user_id) as conn:
+        return conn.execute("SELECT COUNT(*) FROM notifications WHERE user_id = ? AND read_at IS NULL", (user_id,)).fetchone()[0]
+
+def mark_notifications_read(user_id: int, ids: List[int] = None):
+    """Marks the given notifications (or all of them) as read."""
+    q = "UPDATE notifications SET read_at = CURRENT_TIMESTAMP WHERE user_id = ? AND read_at IS NULL"
+    params = [user_id]
+    if ids is not None:
+        q += f" AND id IN ({', '.join('?' * len(ids))})"; params.extend(ids)
+    with get_conn(user_id) as conn:
+        conn.execute(q, params)
+        conn.commit()
+
 # --- Module Specific Helpers (Settlement / Dashboard) ---
 def settle_transactions_for_month(user_id: int, month_str: str):
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
         conn.execute("UPDATE transactions SET status = 'paid' WHERE user_id = ? AND status = 'pendente' AND strftime('%Y-%m', date) = ?", (user_id, month_str))
         rules = fetch_recurring_expenses(user_id)
         paid_ids = {r[0] for r in conn.execute("SELECT recurring_id FROM transactions WHERE user_id = ? AND recurring_id IS NOT NULL AND strftime('%Y-%m', date) = ?", (user_id, month_str)).fetchall()}
         for r in rules:
             if r['id'] not in paid_ids:
                 pay_date = f"{month_str}-{str(r['day_of_month']).zfill(2)}"
-                conn.execute("INSERT INTO transactions (user_id, date, description, amount, type, category_id, status, recurring_id) VALUES (?, ?, ?, ?, 'expense', ?, 'paid', ?)", (user_id, pay_date, r['description'], r['amount'], r['category_id'], r['id']))
+                # Like _refresh_fingerprint: a row already holding the fingerprint keeps it
+                fingerprint = transaction_fingerprint(user_id, pay_date, r['amount'], r['description'])
+                conn.execute("""INSERT INTO transactions (user_id, date, description, amount, type, category_id, status, recurring_id, fingerprint)
+                                SELECT ?1, ?2, ?3, ?4, 'expense', ?5, 'paid', ?6,
+                                       CASE WHEN EXISTS (SELECT 1 FROM transactions WHERE user_id = ?1 AND fingerprint = ?7) THEN NULL ELSE ?7 END""",
+                             (user_id, pay_date, r['description'], r['amount'], r['category_id'], r['id'], fingerprint))
+                _track_transaction_write(conn, user_id, new={"date": pay_date, "category_id": r['category_id'], "amount": r['amount'], "type": "expense"})
         conn.commit()
 
 def get_month_summary(user_id: int, month: str) -> Dict[str, float]:
-    base = "SELECT SUM(amount) FROM transactions WHERE user_id = ? AND strftime('%Y-%m', date) = ? AND status = 'paid'"
-    with get_conn() as conn:
-        inc = conn.execute(base + " AND type = 'income'", (user_id, month)).fetchone()[0] or 0.0
-        exp = conn.execute(base + " AND type = 'expense'", (user_id, month)).fetchone()[0] or 0.0
+    base = f"SELECT SUM({_in_base(_base_sql(user_id))}) FROM {{transactions}} t WHERE t.user_id = ? AND strftime('%Y-%m', t.date) = ? AND t.status = 'paid'"
+    with get_conn(user_id) as conn:
+        base = base.format(transactions=_source(conn, "transactions", f"{month}-01", f"{month}-31"))
+        inc = conn.execute(base + " AND t.type = 'income'", (user_id, month)).fetchone()[0] or 0.0
+        exp = conn.execute(base + " AND t.type = 'expense'", (user_id, month)).fetchone()[0] or 0.0
     return {"income": inc, "expenses": exp, "balance": inc - exp}
 
 def get_spending_by_category(user_id: int, date_from: str = None, date_to: str = None) -> List[Dict[str, Any]]:
-    q = "SELECT c.name, SUM(t.amount) as total FROM transactions t JOIN categories c ON t.category_id = c.id WHERE t.type = 'expense' AND t.user_id = ?"
+    q = f"SELECT c.name, SUM({_in_base(_base_sql(user_id))}) as total FROM {{transactions}} t JOIN categories c ON t.category_id = c.id WHERE t.type = 'expense' AND t.user_id = ?"
     params = [user_id]
     if date_from: q += " AND date(t.date) >= date(?)"; params.append(date_from)
     if date_to: q += " AND date(t.date) <= date(?)"; params.append(date_to)
     q += " GROUP BY c.name HAVING total > 0 ORDER BY total DESC"
-    with get_conn() as conn:
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", date_from, date_to))
         return [{"category": r['name'], "total": r['total']} for r in conn.execute(q, params).fetchall()]
 
-def get_daily_summary(user_id: int, days: int = 30) -> List[Dict[str, Any]]:
-    q = f"SELECT date(t.date) as day, SUM(CASE WHEN t.type = 'income' THEN t.amount ELSE 0 END) as income, SUM(CASE WHEN t.type = 'expense' THEN t.amount ELSE 0 END) as expense FROM transactions t WHERE date(t.date) >= date('now', '-{days} days') AND t.user_id = ? GROUP BY day ORDER BY day ASC"
-    with get_conn() as conn:
-        return [{"date": r['day'], "income": r['income'], "expense": r['expense']} for r in conn.execute(q, (user_id,)).fetchall()]
+# Start of the bucket a date falls in, for :bucket = 'day', 'week' (Monday) or 'month'
+_BUCKET_START = """CASE :bucket WHEN 'week' THEN date({0}, 'weekday 0', '-6 days')
+                                WHEN 'month' THEN date({0}, 'start of month') ELSE date({0}) END"""
+SERIES_BUCKETS = ("day", "week", "month")
+
+def get_series(user_id: int, date_from: str, date_to: str, bucket: str = "day") -> List[Dict[str, Any]]:
+    """Income/expense per day, week or month between two dates, every bucket present.
+
+    A recursive CTE lays out the buckets, so empty ones come back as zeros, and window
+    sums add cumulative income, expense and balance (from zero at `date_from`). Amounts
+    are in the user's base currency.
+    """
+    if bucket not in SERIES_BUCKETS:
+        raise ValueError(f"Agrupamento inválido: {bucket}")
+    amount = _in_base(_base_sql(user_id))
+    q = f"""WITH RECURSIVE cal(bucket) AS (
+              SELECT {_BUCKET_START.format(':date_from')}
+              UNION ALL
+              SELECT CASE :bucket WHEN 'week' THEN date(bucket, '+7 days') WHEN 'month' THEN date(bucket, '+1 month') ELSE date(bucket, '+1 day') END
+                FROM cal WHERE bucket < {_BUCKET_START.format(':date_to')}
+            ), totals AS (
+              SELECT {_BUCKET_START.format('t.date')} AS bucket,
+                     SUM(CASE WHEN t.type = 'income' THEN {amount} ELSE 0 END) AS income,
+                     SUM(CASE WHEN t.type = 'expense' THEN {amount} ELSE 0 END) AS expense
+                FROM {{transactions}} t WHERE t.user_id = :uid AND t.date >= :date_from AND t.date < date(:date_to, '+1 day')
+               GROUP BY 1
+            )
+            SELECT cal.bucket, COALESCE(t.income, 0.0) AS income, COALESCE(t.expense, 0.0) AS expense,
+                   SUM(COALESCE(t.income, 0.0)) OVER w AS cum_income,
+                   SUM(COALESCE(t.expense, 0.0)) OVER w AS cum_expense,
+                   SUM(COALESCE(t.income, 0.0) - COALESCE(t.expense, 0.0)) OVER w AS cum_balance
+              FROM cal LEFT JOIN totals t ON t.bucket = cal.bucket
+            WINDOW w AS (ORDER BY cal.bucket)
+             ORDER BY cal.bucket"""
+    params = {"uid": user_id, "date_from": date_from, "date_to": date_to, "bucket": bucket}
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", date_from, date_to))
+        return [{"date": r['bucket'], "income": r['income'], "expense": r['expense'], "balance": r['income'] - r['expense'],
+                 "cum_income": r['cum_income'], "cum_expense": r['cum_expense'], "cum_balance": r['cum_balance']}
+                for r in conn.execute(q, params).fetchall()]
+
+def get_monthly_category_totals(user_id: int, month_from: str, month_to: str, mode: str = "dicts"):
+    """Income/expense totals per (month, category) from `month_from` to `month_to` inclusive.
+
+    One grouped scan: the hot transactions over the (user_id, date) index, plus the
+    monthly_rollups kept for archived years, so archive files are never opened. Totals
+    are in the user's base currency, like the rollups.
+    """
+    q = f"""SELECT month, category_id, type, SUM(total) AS total FROM (
+             SELECT substr(t.date, 1, 7) AS month, t.category_id, t.type, {_in_base(_base_sql(user_id))} AS total FROM transactions t
+              WHERE t.user_id = ? AND t.date >= ? AND t.date < ?
+             UNION ALL
+             SELECT month, category_id, type, total FROM monthly_rollups
+              WHERE user_id = ? AND month >= ? AND month <= ?
+           ) GROUP BY month, category_id, type"""
+    params = (user_id, f"{month_from}-01", _next_month(month_to) + "-01", user_id, month_from, month_to)
+    with get_conn(user_id) as conn:
+        return _fetch(conn, q, params, mode)
 
 def get_budgets_with_spending(user_id: int, month: str) -> List[Dict[str, Any]]:
-    q = """SELECT c.id, c.name, b.amount as budgeted, COALESCE(SUM(t.amount), 0) as spent FROM categories c LEFT JOIN budgets b ON c.id = b.category_id AND b.month = ? AND b.user_id = ? LEFT JOIN transactions t ON c.id = t.category_id AND t.type = 'expense' AND strftime('%Y-%m', t.date) = ? AND t.user_id = ? WHERE c.user_id = ? GROUP BY c.id, c.name, b.amount ORDER BY c.name"""
-    with get_conn() as conn:
-        return [{"category_id": r[0], "category_name": r[1], "budgeted": r[2] or 0, "spent": r[3], "remaining": (r[2] or 0) - r[3]} for r in conn.execute(q, (month, user_id, month, user_id, user_id)).fetchall()]
+    q = f"""SELECT c.id, c.name, b.amount as budgeted, COALESCE(SUM({_in_base(_base_sql(user_id))}), 0) as spent FROM categories c LEFT JOIN budgets b ON c.id = b.category_id AND b.month = ? AND b.user_id = ? LEFT JOIN {{transactions}} t ON c.id = t.category_id AND t.type = 'expense' AND t.date >= ? AND t.date < ? AND t.user_id = ? WHERE c.user_id = ? GROUP BY c.id, c.name, b.amount ORDER BY c.name"""
+    start, end = f"{month}-01", _next_month(month) + "-01"
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", start, f"{month}-31"))
+        return [{"category_id": r[0], "category_name": r[1], "budgeted": r[2] or 0, "spent": r[3], "remaining": (r[2] or 0) - r[3]} for r in conn.execute(q, (month, user_id, start, end, user_id, user_id)).fetchall()]
 
-def get_month_transactions(user_id: int, month: str) -> List[Dict[str, Any]]:
-    q = "SELECT t.*, c.name as category FROM transactions t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ? AND strftime('%Y-%m', t.date) = ?"
-    with get_conn() as conn:
-        rows = conn.execute(q, (user_id, month)).fetchall()
-        return [{"id": r['id'], "title": r['description'], "start": r['date'], "category": r['category'], "amount": r['amount'], "type": r['type']} for r in rows]
\ No newline at end of file
+def get_calendar_events(user_id: int, date_from: str, date_to: str) -> List[Dict[str, Any]]:
+    """Transactions dated from `date_from` up to, but excluding, `date_to` (FullCalendar's range)."""
+    q = "SELECT t.id, t.description, t.date, t.amount, t.currency, t.type, c.name as category FROM {transactions} t LEFT JOIN categories c ON t.category_id = c.id WHERE t.user_id = ? AND t.date >= ? AND t.date < ? ORDER BY t.date, t.id"
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", date_from, date_to))
+        rows = conn.execute(q, (user_id, date_from, date_to)).fetchall()
+        return [{"id": r['id'], "title": r['description'], "start": r['date'], "category": r['category'], "amount": r['amount'],
+                 "currency": r['currency'], "type": r['type']} for r in rows]
+
+def get_calendar_days(user_id: int, date_from: str, date_to: str, mode: str = "dicts"):
+    """Per-day totals (in the base currency) and counts by type over the same half-open
+    range as get_calendar_events."""
+    q = f"SELECT date(t.date) AS day, t.type, SUM({_in_base(_base_sql(user_id))}) AS total, COUNT(*) AS count FROM {{transactions}} t WHERE t.user_id = ? AND t.date >= ? AND t.date < ? GROUP BY day, t.type ORDER BY day, t.type"
+    with get_conn(user_id) as conn:
+        q = q.format(transactions=_source(conn, "transactions", date_from, date_to))
+        return _fetch(conn, q, (user_id, date_from, date_to), mode)
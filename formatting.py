@@ -0,0 +1,71 @@
+"""
+Locale-free pt-BR formatting for currency, dates and month/weekday names.
+
+Everything is built from fixed tables, so nothing here calls locale.setlocale(): the
+process-wide locale is not thread-safe and flipping it per request broke formatting
+for concurrent requests.
+"""
+from datetime import date, datetime
+from typing import Union
+
+MONTHS = ("janeiro", "fevereiro", "março", "abril", "maio", "junho",
+          "julho", "agosto", "setembro", "outubro", "novembro", "dezembro")
+MONTHS_ABBR = tuple(m[:3] for m in MONTHS)
+# Indexed by date.weekday() (segunda = 0)
+WEEKDAYS = ("segunda-feira", "terça-feira", "quarta-feira", "quinta-feira", "sexta-feira", "sábado", "domingo")
+WEEKDAYS_ABBR = ("seg", "ter", "qua", "qui", "sex", "sáb", "dom")
+
+_SEPARATORS = str.maketrans(",.", ".,")
+
+DateLike = Union[date, datetime, str]
+
+
+def _to_date(value: DateLike) -> date:
+    if isinstance(value, str):
+        if len(value) == 7:
+            return datetime.strptime(value, "%Y-%m")
+        return datetime.strptime(value[:10], "%Y-%m-%d")
+    return value
+
+
+def format_currency(value: float, symbol: bool = True) -> str:
+    """Formats a number as BRL, e.g. 1234.5 -> 'R$ 1.234,50' (negatives as 'R$ -1.234,50')."""
+    try:
+        value = float(value or 0)
+    except (TypeError, ValueError):
+        value = 0.0
+    text = f"{abs(value):,.2f}".translate(_SEPARATORS)
+    if value < 0 and text != "0,00":
+        text = "-" + text
+    return f"R$ {text}" if symbol else text
+
+
+def month_label(value: DateLike, long: bool = False) -> str:
+    """'Out/2026', or 'Outubro de 2026' with `long=True`. Accepts dates and 'YYYY-MM[-DD]' strings."""
+    d = _to_date(value)
+    if long:
+        return f"{MONTHS[d.month - 1].capitalize()} de {d.year}"
+    return f"{MONTHS_ABBR[d.month - 1].capitalize()}/{d.year}"
+
+
+def format_date(value: DateLike, with_weekday: bool = False) -> str:
+    """'19/10/2026', or 'seg, 19/10/2026' with `with_weekday=True`. Unparseable strings pass through."""
+    try:
+        d = _to_date(value)
+    except (TypeError, ValueError):
+        return value
+    text = f"{d.day:02d}/{d.month:02d}/{d.year}"
+    return f"{WEEKDAYS_ABBR[d.weekday()]}, {text}" if with_weekday else text
+
+
+def weekday_name(value: DateLike, abbr: bool = False) -> str:
+    d = _to_date(value)
+    return (WEEKDAYS_ABBR if abbr else WEEKDAYS)[d.weekday()]
+
+
+def register_filters(app):
+    """Registers the formatters as Jinja filters: currency, month_label, date_br, weekday."""
+    app.add_template_filter(format_currency, "currency")
+    app.add_template_filter(month_label, "month_label")
+    app.add_template_filter(format_date, "date_br")
+    app.add_template_filter(weekday_name, "weekday")
@@ -0,0 +1,105 @@
+"""
+Month x category analytics for the dashboard trend charts.
+
+Totals come from one grouped query (database.get_monthly_category_totals) and are
+pivoted into dense matrices, one row per category and one column per month, with zeros
+where nothing was spent. Results are cached per user and data version.
+
+Day/week/month income and expense series (database.get_series) are cached the same way.
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import database as db
+from helpers.cache import LRUCache
+
+VARIANTS = ("raw", "yoy", "ma")
+MAX_MONTHS = 120
+
+_cache = LRUCache(int(os.environ.get("ANALYTICS_CACHE_SIZE", "256")))
+
+
+def month_range(month_from: str, month_to: str, limit: int = MAX_MONTHS) -> List[str]:
+    """['2026-11', '2026-12', '2027-01', ...] up to `month_to` inclusive (at most `limit` months)."""
+    months = [month_from]
+    while months[-1] < month_to and len(months) < limit:
+        months.append(db._next_month(months[-1]))
+    return months
+
+
+def _shift(month: str, months: int) -> str:
+    year, mon = divmod(int(month[:4]) * 12 + int(month[5:7]) - 1 + months, 12)
+    return f"{year}-{mon + 1:02d}"
+
+
+def _pivot(totals: Dict[str, Any], months: List[str], categories: List[Optional[int]]) -> Dict[str, List[List[float]]]:
+    """Dense matrices from the columnar totals (month, category_id, type, total)."""
+    col = {m: i for i, m in enumerate(months)}
+    row = {c: i for i, c in enumerate(categories)}
+    matrices = {typ: [[0.0] * len(months) for _ in categories] for typ in ("income", "expense")}
+    for month, category_id, typ, total in zip(totals['month'], totals['category_id'], totals['type'], totals['total']):
+        if typ in matrices and month in col and category_id in row and total == total:  # NaN for NULL
+            matrices[typ][row[category_id]][col[month]] += total
+    return matrices
+
+
+def _yoy(values: List[float], lag: int) -> List[Optional[float]]:
+    """Change against the same month a year earlier, as a fraction (None without a base)."""
+    return [(v - values[i - lag]) / values[i - lag] if values[i - lag] else None for i, v in enumerate(values)][lag:]
+
+
+def _moving_average(values: List[float], window: int) -> List[float]:
+    out, total = [], 0.0
+    for i, v in enumerate(values):
+        total += v - (values[i - window] if i >= window else 0.0)
+        out.append(total / window)
+    return out[window - 1:]
+
+
+def category_matrix(user_id: int, month_from: str, month_to: str, variant: str = "raw", window: int = 3) -> Dict[str, Any]:
+    """Income and expense per category and month between two 'YYYY-MM' months.
+
+    `variant` is "raw" (totals), "yoy" (change against the same month of the previous
+    year, as a fraction) or "ma" (trailing `window`-month moving average). The extra
+    months those variants need are read in the same query.
+    """
+    if variant not in VARIANTS:
+        raise ValueError(f"Variante inválida: {variant}")
+    window = max(1, min(int(window), 24))
+    key = (user_id, db.get_data_version(user_id), month_from, month_to, variant, window)
+    return _cache.get_or_set(key, lambda: _compute(user_id, month_from, month_to, variant, window))
+
+
+def _compute(user_id: int, month_from: str, month_to: str, variant: str, window: int) -> Dict[str, Any]:
+    months = month_range(month_from, month_to)
+    lead = {"raw": 0, "yoy": 12, "ma": window - 1}[variant]
+    scanned = month_range(_shift(months[0], -lead), months[-1], len(months) + lead) if lead else months
+    totals = db.get_monthly_category_totals(user_id, scanned[0], scanned[-1], mode="columns")
+
+    names = {c['id']: c['name'] for c in db.fetch_categories(user_id)}
+    ids = totals['category_id']
+    used = set(ids.tolist() if hasattr(ids, "tolist") else ids)
+    categories = sorted(used | set(names), key=lambda c: (c is None, names.get(c, "")))
+    matrices = _pivot(totals, scanned, categories)
+
+    if variant == "yoy":
+        transform = lambda values: _yoy(values, lead)
+    elif variant == "ma":
+        transform = lambda values: _moving_average(values, window)
+    else:
+        transform = lambda values: values
+    result = {
+        "months": months,
+        "variant": variant,
+        "categories": [{"id": c, "name": names.get(c) or ("Sem categoria" if c is None else "Categoria removida")} for c in categories],
+    }
+    for typ, matrix in matrices.items():
+        result[typ] = [transform(values) for values in matrix]
+        result[f"{typ}_total"] = transform([sum(column) for column in zip(*matrix)] if matrix else [0.0] * len(scanned))
+    return result
+
+
+def series(user_id: int, date_from: str, date_to: str, bucket: str = "day") -> List[Dict[str, Any]]:
+    """Zero-filled income/expense series with cumulative totals, cached per data version."""
+    key = (user_id, db.get_data_version(user_id), "series", date_from, date_to, bucket)
+    return _cache.get_or_set(key, lambda: db.get_series(user_id, date_from, date_to, bucket))
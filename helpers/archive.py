@@ -0,0 +1,113 @@
+"""
+Cold-data archiving: moves closed years of transactions and paid receivables out of the
+hot tables into one database file per year, next to each shard. Monthly totals of the
+archived transactions stay in the hot `monthly_rollups` table, in each user's base
+currency.
+
+    python -m helpers.archive [--keep-months 13] [--dry-run]
+"""
+import argparse
+import sqlite3
+from datetime import date
+from pathlib import Path
+from typing import Dict, List
+
+import database as db
+
+# Only rows that can no longer change are archived.
+ARCHIVED_ROWS = {
+    "transactions": "1 = 1",
+    "receivables": "status = 'paid'",
+}
+
+
+def archive_path(shard_file: Path, year: int) -> Path:
+    """Returns the archive file of a shard for one year."""
+    return shard_file.parent / "archive" / f"{shard_file.stem}-{year}{shard_file.suffix}"
+
+
+def closed_years(conn: sqlite3.Connection, keep_months: int) -> List[int]:
+    """Returns the years with hot rows that lie entirely before the last `keep_months` months."""
+    today = date.today()
+    first_hot_year = (today.year * 12 + today.month - 1 - keep_months) // 12
+    boundary = f"{first_hot_year}-01-01"
+    rows = conn.execute(
+        " UNION ".join(f"SELECT DISTINCT CAST(substr(date, 1, 4) AS INTEGER) FROM main.{table} WHERE date < ? AND {where}"
+                       for table, where in ARCHIVED_ROWS.items()),
+        [boundary] * len(ARCHIVED_ROWS)).fetchall()
+    return sorted(r[0] for r in rows if r[0])
+
+
+def _ensure_tables(conn: sqlite3.Connection, schema: str):
+    """Creates the archived tables in `schema` and adds columns added to the hot tables since."""
+    for table in ARCHIVED_ROWS:
+        sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+        conn.execute(sql.replace(f"CREATE TABLE {table}", f"CREATE TABLE IF NOT EXISTS {schema}.{table}", 1))
+        present = {r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+        for _, name, typ, _, default, _ in conn.execute(f"PRAGMA main.table_info({table})").fetchall():
+            if name not in present:
+                conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {name} {typ}" + (f" DEFAULT {default}" if default is not None else ""))
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_{table}_user_date ON {table} (user_id, date)")
+
+
+def archive_year(conn: sqlite3.Connection, shard_file: Path, year: int) -> Dict[str, int]:
+    """Moves one year into its archive file and rebuilds that year's rollups.
+
+    Re-running for an already archived year moves whatever has been added since. Returns
+    the number of rows moved per table.
+    """
+    path = archive_path(shard_file, year)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    schema = db._attach_archive(conn, year, str(path))
+    _ensure_tables(conn, schema)
+
+    start, end = f"{year}-01-01", f"{year + 1}-01-01"
+    moved = {}
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table, where in ARCHIVED_ROWS.items():
+            cols = ", ".join(r[1] for r in conn.execute(f"PRAGMA main.table_info({table})"))
+            pred = f"date >= ? AND date < ? AND {where}"
+            conn.execute(f"INSERT OR IGNORE INTO {schema}.{table} ({cols}) SELECT {cols} FROM main.{table} WHERE {pred}", (start, end))
+            moved[table] = conn.execute(f"DELETE FROM main.{table} WHERE {pred}", (start, end)).rowcount
+        conn.execute("DELETE FROM monthly_rollups WHERE month >= ? AND month < ?", (start[:7], end[:7]))
+        # Totals are in each user's base currency (see database.set_base_currency)
+        db._insert_rollups(conn, schema, start=start, end=end)
+        conn.execute("INSERT OR REPLACE INTO archives (year, path) VALUES (?, ?)", (year, str(path)))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return moved
+
+
+def archive_closed_years(keep_months: int = 13, dry_run: bool = False) -> Dict[Path, Dict[int, Dict[str, int]]]:
+    """Archives every closed year on every shard. Returns the rows moved per shard and year."""
+    report = {}
+    for shard in range(db.SHARD_COUNT):
+        shard_file = db.shard_path(shard)
+        conn = sqlite3.connect(shard_file, isolation_level=None, timeout=30)
+        try:
+            years = closed_years(conn, keep_months)
+            report[shard_file] = {year: ({} if dry_run else archive_year(conn, shard_file, year)) for year in years}
+        finally:
+            conn.close()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Arquiva anos fechados em bancos anuais.")
+    parser.add_argument("--keep-months", type=int, default=13, help="Meses mantidos nas tabelas principais (padrão: 13).")
+    parser.add_argument("--dry-run", action="store_true", help="Só lista os anos que seriam arquivados.")
+    args = parser.parse_args(argv)
+
+    for shard_file, years in archive_closed_years(args.keep_months, args.dry_run).items():
+        if not years:
+            print(f"{shard_file}: nada a arquivar")
+        for year, moved in years.items():
+            detail = ", ".join(f"{table}: {n}" for table, n in moved.items()) or "dry-run"
+            print(f"{shard_file}: {year} -> {archive_path(shard_file, year)} ({detail})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Online backups of the SQLite databases through the sqlite3 backup API.
+
+    python -m helpers.backup run [--dest DIR] [--keep N] [--compress]
+    python -m helpers.backup verify <arquivo>
+    python -m helpers.backup schedule [--interval SEGUNDOS]
+
+Each run copies every live database file (directory, shards and archives) into a
+timestamped folder, a few pages at a time with pauses in between, so request handlers
+keep getting the write lock. create_app() starts the in-process scheduler when
+BACKUP_INTERVAL is set.
+"""
+import argparse
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, runs may overlap
+    fcntl = None
+
+import database as db
+
+BACKUP_DIR = Path(os.environ.get("BACKUP_DIR", db.DB.parent / "backups"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", "256"))
+BACKUP_PAUSE = float(os.environ.get("BACKUP_PAUSE", "0.05"))
+STAMP_FORMAT = "%Y%m%d-%H%M%S"
+
+
+def backup_file(source: Path, dest: Path, pages: int = BACKUP_PAGES, pause: float = BACKUP_PAUSE) -> Path:
+    """Copies one database file to `dest`, `pages` pages per step with `pause` seconds between steps.
+
+    The source connection holds a read transaction for the whole copy, so the backup is a
+    point-in-time image and concurrent commits neither block on it nor restart it.
+    """
+    tmp = dest.with_name(dest.name + ".tmp")
+    src = sqlite3.connect(source, isolation_level=None)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+        src.execute("COMMIT")
+        # The copy inherits WAL mode from the header; a standalone file is easier to ship.
+        dst.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        src.close()
+        dst.close()
+    tmp.replace(dest)
+    return dest
+
+
+def verify_backup(path: Path) -> bool:
+    """Runs PRAGMA integrity_check on a backup file, decompressing .gz copies first."""
+    path = Path(path)
+    if path.suffix == ".gz":
+        with tempfile.TemporaryDirectory() as tmp:
+            plain = Path(tmp) / path.stem
+            with gzip.open(path, "rb") as f_in, open(plain, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            return verify_backup(plain)
+    conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    finally:
+        conn.close()
+
+
+def _compress(path: Path) -> Path:
+    gz = path.with_name(path.name + ".gz")
+    with open(path, "rb") as f_in, gzip.open(gz, "wb", compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    path.unlink()
+    return gz
+
+
+def _snapshots(dest_dir: Path) -> List[Path]:
+    """Returns the finished backup folders, oldest first."""
+    if not dest_dir.exists():
+        return []
+    return sorted(p for p in dest_dir.iterdir() if p.is_dir() and not p.name.endswith(".partial"))
+
+
+def _apply_retention(dest_dir: Path, keep: int) -> List[Path]:
+    removed = _snapshots(dest_dir)[:-keep] if keep > 0 else []
+    for folder in removed:
+        shutil.rmtree(folder)
+    return removed
+
+
+@contextmanager
+def _exclusive(dest_dir: Path):
+    """Yields False when another process is already backing up into `dest_dir`."""
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    if fcntl is None:
+        yield True
+        return
+    with open(dest_dir / ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def run_backup(dest_dir: Path = BACKUP_DIR, keep: int = BACKUP_KEEP, compress: bool = False,
+               pages: int = BACKUP_PAGES, pause: float = BACKUP_PAUSE) -> Optional[Path]:
+    """Backs up every database file into a new timestamped folder and applies retention.
+
+    Every copy is integrity-checked before it is (optionally) compressed; a failed check
+    raises and leaves the partial folder behind for inspection. Returns the folder, or
+    None when another process is already running a backup.
+    """
+    dest_dir = Path(dest_dir)
+    with _exclusive(dest_dir) as acquired:
+        if not acquired:
+            return None
+        folder = dest_dir / datetime.now().strftime(STAMP_FORMAT)
+        partial = folder.with_name(folder.name + ".partial")
+        partial.mkdir(parents=True)
+        base = db.DB.parent.resolve()
+        for source in db.database_files():
+            if not source.exists():
+                continue
+            source = source.resolve()
+            rel = source.relative_to(base) if source.is_relative_to(base) else Path(source.name)
+            dest = partial / rel
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            backup_file(source, dest, pages, pause)
+            if not verify_backup(dest):
+                raise RuntimeError(f"Backup corrompido: {dest}")
+            if compress:
+                _compress(dest)
+        partial.rename(folder)
+        _apply_retention(dest_dir, keep)
+        return folder
+
+
+def _latest_age(dest_dir: Path) -> Optional[float]:
+    snapshots = _snapshots(dest_dir)
+    if not snapshots:
+        return None
+    try:
+        taken = datetime.strptime(snapshots[-1].name, STAMP_FORMAT)
+    except ValueError:
+        return None
+    return (datetime.now() - taken).total_seconds()
+
+
+def _scheduled_run(interval: int, **kwargs):
+    # Every worker process runs a scheduler; only the first one due does the work.
+    age = _latest_age(Path(kwargs.get("dest_dir", BACKUP_DIR)))
+    if age is not None and age < interval:
+        return
+    started = time.monotonic()
+    folder = run_backup(**kwargs)
+    if folder:
+        print(f"Backup concluído em {time.monotonic() - started:.1f}s: {folder}")
+
+
+_scheduler: Optional[threading.Thread] = None
+
+
+def start_scheduler(interval: int, **kwargs) -> threading.Thread:
+    """Starts a daemon thread that backs up every `interval` seconds (once per process)."""
+    global _scheduler
+    if _scheduler is not None and _scheduler.is_alive():
+        return _scheduler
+
+    def loop():
+        while True:
+            try:
+                _scheduled_run(interval, **kwargs)
+            except Exception as e:
+                print(f"Erro no backup agendado: {e}")
+            time.sleep(min(interval, 60))
+
+    _scheduler = threading.Thread(target=loop, name="backup-scheduler", daemon=True)
+    _scheduler.start()
+    return _scheduler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backup online dos bancos SQLite.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("run", "schedule"):
+        cmd = sub.add_parser(name, help="Faz um backup agora." if name == "run" else "Faz backups periódicos (primeiro plano).")
+        cmd.add_argument("--dest", type=Path, default=BACKUP_DIR, help=f"Pasta de destino (padrão: {BACKUP_DIR}).")
+        cmd.add_argument("--keep", type=int, default=BACKUP_KEEP, help="Quantos backups manter (0 = todos).")
+        cmd.add_argument("--compress", action="store_true", help="Compacta as cópias com gzip.")
+        cmd.add_argument("--pages", type=int, default=BACKUP_PAGES, help="Páginas copiadas por etapa.")
+        cmd.add_argument("--pause", type=float, default=BACKUP_PAUSE, help="Pausa em segundos entre etapas.")
+        if name == "schedule":
+            cmd.add_argument("--interval", type=int, default=int(os.environ.get("BACKUP_INTERVAL", "86400")), help="Intervalo em segundos.")
+    verify = sub.add_parser("verify", help="Verifica a integridade de um arquivo de backup.")
+    verify.add_argument("path", type=Path)
+    args = parser.parse_args(argv)
+
+    if args.command == "verify":
+        ok = verify_backup(args.path)
+        print("ok" if ok else "CORROMPIDO")
+        raise SystemExit(0 if ok else 1)
+
+    options = dict(dest_dir=args.dest, keep=args.keep, compress=args.compress, pages=args.pages, pause=args.pause)
+    if args.command == "run":
+        folder = run_backup(**options)
+        print(f"Backup salvo em {folder}" if folder else "Outro backup já está em andamento.")
+    else:
+        start_scheduler(args.interval, **options).join()
+
+
+if __name__ == "__main__":
+    main()
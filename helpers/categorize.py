@@ -0,0 +1,152 @@
+"""
+Rule-based auto-categorization.
+
+A user's rules (database.fetch_category_rules) are compiled into one regular expression
+with an alternative per rule, in priority order, each a named group anchored at the
+start of the description:
+
+    ^(?:(?P<r0>.*?(?:uber|99))|(?P<r1>.*?mercado)|...)
+
+The regex engine tries the alternatives in order, so a single match() call finds the
+first rule whose pattern occurs anywhere in the description. Amount and type conditions
+are checked on the rule that matched; when they fail, matching resumes from the next
+rule. Matchers are cached per user and rules version, so they are rebuilt only after a
+rule edit.
+
+    python -m helpers.categorize <user_id>      # re-categorize the user's history
+"""
+import argparse
+import os
+import re
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+
+import database as db
+from helpers.cache import LRUCache
+
+_cache = LRUCache(int(os.environ.get("RULES_CACHE_SIZE", "256")))
+
+
+class RuleMatcher:
+    """Picks the category of the first rule matching a transaction."""
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.rules = rules
+        # Combined patterns of rules[start:], by start; all but the first are only built
+        # when a rule fails its amount/type condition.
+        self._patterns: Dict[int, Optional[Pattern]] = {}
+
+    @staticmethod
+    def _body(rule: Dict[str, Any]) -> str:
+        if rule['kind'] == "keyword":
+            return re.escape(rule['pattern'])
+        if rule['kind'] == "regex":
+            return rule['pattern']
+        return ""
+
+    def _pattern(self, start: int) -> Optional[Pattern]:
+        if start not in self._patterns:
+            alternatives = [f"(?P<r{i}>.*?(?:{self._body(self.rules[i])}))" for i in range(start, len(self.rules))]
+            self._patterns[start] = re.compile("(?is)^(?:" + "|".join(alternatives) + ")") if alternatives else None
+        return self._patterns[start]
+
+    def _accepts(self, rule: Dict[str, Any], amount: float, typ: str) -> bool:
+        if rule['type'] and rule['type'] != typ:
+            return False
+        amount = abs(amount or 0)
+        return ((rule['min_amount'] is None or amount >= rule['min_amount'])
+                and (rule['max_amount'] is None or amount <= rule['max_amount']))
+
+    def _candidates(self, description: str) -> Tuple[int, ...]:
+        """Indexes of the rules whose pattern matches, in order, up to the first one
+        without amount/type conditions (no later rule can win after it)."""
+        found, start = [], 0
+        while True:
+            pattern = self._pattern(start)
+            m = pattern.match(description or "") if pattern else None
+            if m is None:
+                return tuple(found)
+            index = int(m.lastgroup[1:])
+            found.append(index)
+            rule = self.rules[index]
+            if rule['min_amount'] is None and rule['max_amount'] is None and not rule['type']:
+                return tuple(found)
+            start = index + 1
+
+    def _pick(self, candidates: Tuple[int, ...], amount: float, typ: str) -> Optional[int]:
+        for index in candidates:
+            if self._accepts(self.rules[index], amount, typ):
+                return self.rules[index]['category_id']
+        return None
+
+    def match(self, description: str, amount: float = 0.0, typ: str = None) -> Optional[int]:
+        """The category id of the first matching rule, or None."""
+        return self._pick(self._candidates(description), amount, typ)
+
+    def classify(self, rows) -> List[Optional[int]]:
+        """match() over many (description, amount, type) rows. Each distinct description
+        goes through the regex once (they repeat a lot in real histories)."""
+        seen: Dict[str, Tuple[int, ...]] = {}
+        out = []
+        for description, amount, typ in rows:
+            candidates = seen.get(description)
+            if candidates is None:
+                candidates = seen[description] = self._candidates(description)
+            out.append(self._pick(candidates, amount, typ) if candidates else None)
+        return out
+
+
+def _valid(rule: Dict[str, Any]) -> bool:
+    if rule['kind'] != "regex":
+        return True
+    try:
+        db.validate_rule_pattern(rule['pattern'])
+        return True
+    except ValueError:
+        return False
+
+
+def _build(user_id: int) -> RuleMatcher:
+    rules = db.fetch_category_rules(user_id)
+    matcher = RuleMatcher(rules)
+    try:
+        matcher._pattern(0)
+    except re.error:
+        # A rule saved before database.validate_rule_pattern existed breaks the combined
+        # pattern; leave such rules out rather than failing every transaction write.
+        matcher = RuleMatcher([r for r in rules if _valid(r)])
+    return matcher
+
+
+def matcher_for(user_id: int) -> RuleMatcher:
+    """The user's compiled rules, rebuilt only after they changed."""
+    key = (user_id, db.get_rules_version(user_id))
+    return _cache.get_or_set(key, lambda: _build(user_id))
+
+
+def suggest_category(user_id: int, description: str, amount: float, typ: str) -> Optional[int]:
+    return matcher_for(user_id).match(description, amount, typ)
+
+
+def recategorize_history(user_id: int) -> int:
+    """Applies the rules to every transaction without a category or in "Outros";
+    returns how many were recategorized."""
+    matcher = matcher_for(user_id)
+    if not matcher.rules:
+        return 0
+    assignments = []
+    for rows in db.iter_uncategorized_transactions(user_id):
+        categories = matcher.classify((r['description'], r['amount'], r['type']) for r in rows)
+        assignments.extend((r['id'], category_id, r['category_id'])
+                           for r, category_id in zip(rows, categories) if category_id is not None and category_id != r['category_id'])
+    return db.set_transaction_categories(user_id, assignments) if assignments else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recategoriza o histórico de um usuário com as regras dele.")
+    parser.add_argument("user_id", type=int)
+    args = parser.parse_args(argv)
+    print(f"{recategorize_history(args.user_id)} transações recategorizadas")
+
+
+if __name__ == "__main__":
+    main()
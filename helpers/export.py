@@ -1,8 +1,14 @@
+import csv
+import io
 import pandas as pd
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from pathlib import Path
 from io import BytesIO
+from typing import Callable
+
+import database as db
+from formatting import format_currency
 
 
 def export_to_excel(rows, filename):
@@ -35,8 +41,18 @@ def dataframe_to_excel_bytes(df: pd.DataFrame) -> BytesIO:
     return buf
 
 
-def dataframe_to_pdf_bytes(df: pd.DataFrame) -> BytesIO:
-    """Return an in-memory PDF representing the DataFrame (simple table as text)."""
+def dataframe_to_parquet_bytes(df: pd.DataFrame) -> BytesIO:
+    """Return an in-memory Parquet file for a DataFrame (needs pyarrow)."""
+    buf = BytesIO()
+    df.to_parquet(buf, index=False, compression="zstd")
+    buf.seek(0)
+    return buf
+
+
+def dataframe_to_pdf_bytes(df: pd.DataFrame, progress: Callable[[float], None] = None) -> BytesIO:
+    """Return an in-memory PDF representing the DataFrame (simple table as text).
+
+    `progress`, if given, is called with the fraction of rows drawn so far."""
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
     w, h = A4
@@ -45,7 +61,9 @@ def dataframe_to_pdf_bytes(df: pd.DataFrame) -> BytesIO:
     c.setFont("Helvetica", 10)
     c.drawString(30, y, header)
     y -= 16
-    for _, row in df.iterrows():
+    for i, (_, row) in enumerate(df.iterrows()):
+        if progress and i % 500 == 0:
+            progress(i / len(df))
         line = " | ".join(str(row[col])[:60] for col in df.columns)
         c.drawString(30, y, line)
         y -= 14
@@ -54,4 +72,40 @@ def dataframe_to_pdf_bytes(df: pd.DataFrame) -> BytesIO:
             y = h - 40
     c.save()
     buf.seek(0)
-    return buf
\ No newline at end of file
+    return buf
+
+def export_transactions(user_id: int, fmt: str = "xlsx", progress: Callable[[float], None] = None, **filters) -> BytesIO:
+    """Return a user's filtered transactions as an in-memory .xlsx, .pdf or .parquet file.
+
+    Rows are read from a database snapshot, so a month being settled while the
+    export runs appears either fully settled or not at all. `progress` receives the
+    fraction done (helpers/jobs.py runs this in a worker process).
+    """
+    progress = progress or (lambda fraction: None)
+    with db.read_snapshot():
+        rows = db.fetch_transactions(user_id, mode="columns", **filters)
+    progress(0.2)
+    df = db.to_df(rows)
+    progress(0.3)
+    if fmt == "pdf":
+        return dataframe_to_pdf_bytes(df, lambda fraction: progress(0.3 + 0.7 * fraction))
+    if fmt == "parquet":
+        return dataframe_to_parquet_bytes(df)
+    return dataframe_to_excel_bytes(df)
+
+
+def export_aging_csv(user_id: int, as_of: str = None) -> BytesIO:
+    """Return the receivables aging report as CSV (';'-separated, pt-BR numbers, UTF-8 BOM
+    for Excel): one row per debtor, then one per due month."""
+    aging = db.get_receivables_aging(user_id, as_of)
+    text = io.StringIO()
+    writer = csv.writer(text, delimiter=";")
+    writer.writerow(["Agrupamento", "Devedor/Mês", *db.AGING_BUCKETS.values(), "Total", "Itens"])
+    for kind, key, groups in (("Devedor", "debtor", aging["by_debtor"]), ("Mês", "month", aging["by_month"])):
+        for g in groups:
+            writer.writerow([kind, g[key], *(format_currency(v, symbol=False) for v in g["buckets"].values()),
+                             format_currency(g["total"], symbol=False), g["count"]])
+    totals = aging["totals"]
+    writer.writerow(["Total", aging["as_of"], *(format_currency(v, symbol=False) for v in totals["buckets"].values()),
+                     format_currency(totals["total"], symbol=False), totals["count"]])
+    return BytesIO(text.getvalue().encode("utf-8-sig"))
@@ -0,0 +1,70 @@
+"""
+Exchange rates and base currencies.
+
+    python -m helpers.fx load rates.csv          # date,currency,rate (header optional, ',' or ';')
+    python -m helpers.fx base <user_id> <CUR>    # the currency a user's reports come out in
+
+A rate is how many DEFAULT_CURRENCY units one unit of the currency was worth from that
+date on ("2026-03-02,USD,5.12"). Rates are loaded into the fx_rates table of every
+shard in one batch, after which reports convert with them in SQL (see the Currencies
+section of database.py).
+"""
+import argparse
+import csv
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import database as db
+
+
+def _rate(value: str, line: int) -> float:
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # Brazilian notation: 1.234,5678
+        return float(value.replace(".", "").replace(",", "."))
+    except ValueError:
+        raise ValueError(f"Linha {line}: cotação inválida: {value!r}")
+
+
+def read_rates(path: Path) -> Iterator[Tuple[str, str, float]]:
+    """(date, currency, rate) rows of a CSV file, skipping blank lines and a header."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        delimiter = ";" if sample.count(";") > sample.count(",") else ","
+        for line, row in enumerate(csv.reader(f, delimiter=delimiter), 1):
+            if not row or not "".join(row).strip():
+                continue
+            if len(row) < 3:
+                raise ValueError(f"Linha {line}: esperado data, moeda e cotação")
+            if line == 1 and not row[0].strip()[:1].isdigit():
+                continue
+            yield row[0].strip(), row[1].strip(), _rate(row[2], line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cotações de moedas e moeda principal dos usuários.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    load = sub.add_parser("load", help=f"Carrega cotações (em {db.DEFAULT_CURRENCY}) de um CSV data,moeda,cotação.")
+    load.add_argument("file", type=Path)
+    base = sub.add_parser("base", help="Define a moeda principal de um usuário.")
+    base.add_argument("user_id", type=int)
+    base.add_argument("currency")
+    args = parser.parse_args(argv)
+
+    if args.command == "load":
+        print(f"{db.load_fx_rates(read_rates(args.file))} cotações carregadas")
+    else:
+        try:
+            db.set_base_currency(args.user_id, args.currency)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"Usuário {args.user_id}: moeda principal {db.get_base_currency(args.user_id)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Background jobs for exports and heavy reports.
+
+Jobs are rows of the directory's `jobs` table. submit() records one and hands it to this
+process's pool of worker processes, so rendering a large spreadsheet or PDF keeps a CPU
+busy in a worker instead of holding a web worker for the whole request. The job reports
+its progress in its row; the finished file is written under JOBS_DIR and served until
+it expires (JOB_TTL seconds). Each user may have JOB_USER_LIMIT jobs queued or running.
+
+Workers are spawned rather than forked: a forked child would inherit the parent's open
+SQLite connections.
+"""
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import database as db
+
+JOBS_DIR = Path(os.environ.get("JOBS_DIR", db.DB.parent / "jobs"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_USER_LIMIT = int(os.environ.get("JOB_USER_LIMIT", "2"))
+JOB_TTL = int(os.environ.get("JOB_TTL", "3600"))
+# Jobs queued or running for longer than this are given up (e.g. their process died)
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", "900"))
+
+ACTIVE = ("queued", "running")
+_ACTIVE_IN = f"({', '.join('?' * len(ACTIVE))})"
+
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+MIMETYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "pdf": "application/pdf",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+# --- Job kinds ---
+# Each takes (user_id, params, progress) and returns (file bytes, download name, mimetype).
+def _export_transactions(user_id: int, params: Dict[str, Any], progress: Callable[[float], None]) -> Tuple[bytes, str, str]:
+    from helpers.export import export_transactions
+    params = dict(params)
+    fmt = params.pop("fmt", "xlsx")
+    name = params.pop("name", "transacoes")
+    buf = export_transactions(user_id, fmt=fmt, progress=progress, **params)
+    mimetype = MIMETYPES.get(fmt, "application/octet-stream")
+    return buf.getvalue(), f"{name}.{fmt}", mimetype
+
+
+KINDS: Dict[str, Callable[[int, Dict[str, Any], Callable[[float], None]], Tuple[bytes, str, str]]] = {
+    "transactions": _export_transactions,
+}
+
+
+# --- Running ---
+def _set(job_id: str, **fields):
+    with db.get_conn() as conn:
+        conn.execute(f"UPDATE jobs SET {', '.join(f + ' = ?' for f in fields)} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+
+
+def _run(job_id: str):
+    """Runs one job; called in a worker process."""
+    with db.get_conn() as conn:
+        claimed = conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued'", (_now(), job_id)).rowcount
+        conn.commit()
+        job = conn.execute("SELECT user_id, kind, params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if not claimed or job is None:
+        return
+    last = [0.0]
+
+    def progress(fraction: float):
+        # Only steps of 5% reach the database
+        if fraction - last[0] >= 0.05:
+            last[0] = fraction
+            _set(job_id, progress=round(min(fraction, 1.0), 3))
+
+    try:
+        data, filename, mimetype = KINDS[job['kind']](job['user_id'], json.loads(job['params']), progress)
+        JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        (JOBS_DIR / job_id).write_bytes(data)
+        _set(job_id, status="done", progress=1.0, filename=filename, mimetype=mimetype, finished_at=_now(),
+             expires_at=(datetime.now() + timedelta(seconds=JOB_TTL)).isoformat(timespec="seconds"))
+    except Exception as e:
+        _set(job_id, status="failed", message=str(e) or type(e).__name__, finished_at=_now())
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def submit(user_id: int, kind: str, params: Dict[str, Any]) -> str:
+    """Queues a job and returns its id. Raises ValueError for unknown kinds and when the
+    user already has JOB_USER_LIMIT jobs queued or running."""
+    if kind not in KINDS:
+        raise ValueError(f"Tipo de tarefa desconhecido: {kind}")
+    cleanup()
+    job_id = uuid.uuid4().hex
+    conn = sqlite3.connect(db.DB, isolation_level=None, timeout=30)
+    try:
+        # The write lock makes counting and inserting one step across web workers
+        conn.execute("BEGIN IMMEDIATE")
+        active = conn.execute(f"SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN {_ACTIVE_IN}", (user_id, *ACTIVE)).fetchone()[0]
+        if active >= JOB_USER_LIMIT:
+            conn.execute("ROLLBACK")
+            raise ValueError(f"Você já tem {active} exportação(ões) em andamento. Aguarde a conclusão.")
+        conn.execute("INSERT INTO jobs (id, user_id, kind, params, status, progress, created_at) VALUES (?, ?, ?, ?, 'queued', 0, ?)",
+                     (job_id, user_id, kind, json.dumps(params), _now()))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    try:
+        _pool().submit(_run, job_id)
+    except Exception as e:
+        _set(job_id, status="failed", message=str(e), finished_at=_now())
+        raise
+    return job_id
+
+
+# --- Reading ---
+def get_job(user_id: int, job_id: str) -> Optional[Dict[str, Any]]:
+    """One of the user's jobs (None for other users' ids)."""
+    with db.get_conn() as conn:
+        row = conn.execute("SELECT id, kind, status, progress, message, filename, mimetype, created_at, started_at, finished_at, expires_at FROM jobs WHERE id = ? AND user_id = ?",
+                           (job_id, user_id)).fetchone()
+        return dict(row) if row else None
+
+
+def list_jobs(user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+    with db.get_conn() as conn:
+        rows = conn.execute("SELECT id, kind, status, progress, message, filename, created_at, finished_at, expires_at FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                            (user_id, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+
+def result_path(job: Dict[str, Any]) -> Optional[Path]:
+    """The result file of a finished, unexpired job."""
+    path = JOBS_DIR / job['id']
+    if job['status'] != "done" or (job['expires_at'] and job['expires_at'] < _now()) or not path.exists():
+        return None
+    return path
+
+
+def cleanup() -> int:
+    """Deletes expired result files and gives up on stuck jobs; returns the files removed."""
+    now = _now()
+    stuck = (datetime.now() - timedelta(seconds=JOB_TIMEOUT)).isoformat(timespec="seconds")
+    with db.get_conn() as conn:
+        expired = [r['id'] for r in conn.execute("SELECT id FROM jobs WHERE status = 'done' AND expires_at < ?", (now,))]
+        conn.execute("UPDATE jobs SET status = 'expired' WHERE status = 'done' AND expires_at < ?", (now,))
+        conn.execute(f"UPDATE jobs SET status = 'failed', message = 'Tempo esgotado', finished_at = ? WHERE status IN {_ACTIVE_IN} AND created_at < ?", (now, *ACTIVE, stuck))
+        # Finished jobs are kept a day for the listing, then dropped
+        conn.execute("DELETE FROM jobs WHERE status NOT IN ('queued', 'running', 'done') AND COALESCE(finished_at, created_at) < ?",
+                     ((datetime.now() - timedelta(days=1)).isoformat(timespec="seconds"),))
+        conn.commit()
+    for job_id in expired:
+        (JOBS_DIR / job_id).unlink(missing_ok=True)
+    return len(expired)
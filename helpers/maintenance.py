@@ -0,0 +1,210 @@
+"""
+Routine database maintenance for every shard: ANALYZE, incremental vacuum, WAL
+checkpoints and change-log compaction. `PRAGMA optimize` already runs whenever a connection closes (database.py).
+
+    python -m helpers.maintenance [analyze|vacuum|checkpoint|changelog|all]
+    python -m helpers.maintenance convert    # once, for files created before incremental vacuum
+
+Each run is recorded in the directory's `maintenance_runs` table with its duration and
+the bytes it gave back. create_app() starts the scheduler unless MAINTENANCE_ENABLED=0.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import database as db
+
+ANALYZE_INTERVAL = int(os.environ.get("MAINTENANCE_ANALYZE_INTERVAL", "86400"))
+VACUUM_INTERVAL = int(os.environ.get("MAINTENANCE_VACUUM_INTERVAL", "3600"))
+CHECKPOINT_IDLE = int(os.environ.get("MAINTENANCE_CHECKPOINT_IDLE", "30"))
+CHANGELOG_INTERVAL = int(os.environ.get("MAINTENANCE_CHANGELOG_INTERVAL", "86400"))
+# Change-log entries older than this are dropped; clients idle for longer resync in full.
+CHANGELOG_RETENTION_DAYS = int(os.environ.get("CHANGELOG_RETENTION_DAYS", "90"))
+# Pages freed per incremental_vacuum call; 0 frees them all.
+VACUUM_PAGES = int(os.environ.get("MAINTENANCE_VACUUM_PAGES", "2000"))
+
+_last_activity = time.monotonic()
+
+
+def mark_activity():
+    """Records that this process just served a request (checkpoints wait for idle time)."""
+    global _last_activity
+    _last_activity = time.monotonic()
+
+
+def _file_size(path: Path) -> int:
+    return path.stat().st_size if path.exists() else 0
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    # Short timeout: maintenance gives way to request handlers instead of queueing behind them.
+    return sqlite3.connect(path, isolation_level=None, timeout=1)
+
+
+def analyze(path: Path) -> int:
+    """Rebuilds the planner statistics of one database file."""
+    conn = _connect(path)
+    try:
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+    return 0
+
+
+def incremental_vacuum(path: Path, pages: int = VACUUM_PAGES) -> int:
+    """Returns free pages to the filesystem; returns the bytes freed.
+
+    Files created before incremental auto-vacuum was enabled are skipped: converting them
+    takes a full VACUUM that holds the write lock throughout, so it is left to `convert`.
+    """
+    conn = _connect(path)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print(f"Vacuum incremental ignorado em {path}: rode 'python -m helpers.maintenance convert' fora do horário de uso")
+            return 0
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (free_before - free_after) * page_size
+    finally:
+        conn.close()
+
+
+def convert(path: Path) -> int:
+    """Switches a file to incremental auto-vacuum with a full VACUUM; returns the bytes freed.
+
+    Holds the write lock for the whole rewrite, so it only runs from the command line.
+    """
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return 0
+        size_before = _file_size(path)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return max(0, size_before - _file_size(path))
+    finally:
+        conn.close()
+
+
+def checkpoint(path: Path) -> int:
+    """Copies the WAL back into the database and truncates it; returns the bytes freed."""
+    wal = path.with_name(path.name + "-wal")
+    before = _file_size(wal)
+    conn = _connect(path)
+    try:
+        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.close()
+    return 0 if busy else max(0, before - _file_size(wal))
+
+
+def compact_changelog(path: Path) -> int:
+    """Drops superseded and expired change-log entries (database.compact_change_log).
+
+    The space comes back with the next incremental vacuum, so this reports 0 bytes.
+    """
+    conn = _connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        removed = db.compact_change_log(conn, CHANGELOG_RETENTION_DAYS)
+    finally:
+        conn.close()
+    print(f"Change log de {path}: {removed} entradas removidas")
+    return 0
+
+
+JOBS: Dict[str, Callable[[Path], int]] = {
+    "analyze": analyze,
+    "vacuum": incremental_vacuum,
+    "checkpoint": checkpoint,
+    "changelog": compact_changelog,
+}
+# Not scheduled and not part of "all"
+MANUAL_JOBS: Dict[str, Callable[[Path], int]] = {
+    "convert": convert,
+}
+
+
+def _record(job: str, path: Path, seconds: float, reclaimed: int):
+    with db.get_conn() as conn:
+        conn.execute("INSERT INTO maintenance_runs (job, path, finished_at, seconds, bytes_reclaimed) VALUES (?, ?, ?, ?, ?)",
+                     (job, str(path), datetime.now().isoformat(timespec="seconds"), seconds, reclaimed))
+        conn.commit()
+
+
+def run_job(job: str, paths: Optional[List[Path]] = None) -> List[Dict[str, Any]]:
+    """Runs one job on every shard (or on `paths`) and returns what each run reported."""
+    reports = []
+    for path in paths or [db.shard_path(shard) for shard in range(db.SHARD_COUNT)]:
+        started = time.monotonic()
+        try:
+            reclaimed = {**JOBS, **MANUAL_JOBS}[job](path)
+        except sqlite3.OperationalError as e:
+            # Usually "database is locked": the job simply runs again next time.
+            print(f"Manutenção '{job}' adiada em {path}: {e}")
+            continue
+        seconds = time.monotonic() - started
+        # Idle checkpoints run every minute; only the ones that freed something are kept.
+        if reclaimed or job != "checkpoint":
+            _record(job, path, seconds, reclaimed)
+        reports.append({"job": job, "path": str(path), "seconds": seconds, "bytes_reclaimed": reclaimed})
+    return reports
+
+
+def _is_due(job: str, interval: int) -> bool:
+    since = (datetime.now() - timedelta(seconds=interval)).isoformat(timespec="seconds")
+    with db.get_conn() as conn:
+        return conn.execute("SELECT 1 FROM maintenance_runs WHERE job = ? AND finished_at > ? LIMIT 1", (job, since)).fetchone() is None
+
+
+def _tick():
+    for job, interval in (("analyze", ANALYZE_INTERVAL), ("vacuum", VACUUM_INTERVAL), ("changelog", CHANGELOG_INTERVAL)):
+        if _is_due(job, interval):
+            for report in run_job(job):
+                print(f"Manutenção {report['job']} em {report['path']}: {report['seconds']:.2f}s, {report['bytes_reclaimed']} bytes liberados")
+    if time.monotonic() - _last_activity >= CHECKPOINT_IDLE:
+        run_job("checkpoint")
+
+
+_scheduler: Optional[threading.Thread] = None
+
+
+def start_scheduler(poll: int = 60) -> threading.Thread:
+    """Starts the maintenance thread of this process, checking every `poll` seconds what is due."""
+    global _scheduler
+    if _scheduler is not None and _scheduler.is_alive():
+        return _scheduler
+
+    def loop():
+        while True:
+            time.sleep(poll)
+            try:
+                _tick()
+            except Exception as e:
+                print(f"Erro na manutenção agendada: {e}")
+
+    _scheduler = threading.Thread(target=loop, name="db-maintenance", daemon=True)
+    _scheduler.start()
+    return _scheduler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manutenção dos bancos SQLite.")
+    parser.add_argument("job", nargs="?", default="all", choices=[*JOBS, *MANUAL_JOBS, "all"])
+    args = parser.parse_args(argv)
+
+    for job in (JOBS if args.job == "all" else [args.job]):
+        for report in run_job(job):
+            print(f"{report['job']:<10} {report['path']}: {report['seconds']:.2f}s, {report['bytes_reclaimed']} bytes liberados")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Columnar Parquet datasets for analytics.
+
+    python -m helpers.parquet [--dest DIR] [--user ID] [--full]
+
+Writes transactions, receivables and budgets, for one user or for every user of every
+shard, as a dataset partitioned by month:
+
+    DEST/transactions/period=2026-03/shard-0.parquet             (every user of shard 0)
+    DEST/user-42/transactions/period=2026-03/user-42.parquet     (--user 42)
+
+`pd.read_parquet(DEST / "transactions")` loads a table back, with `period` as a column.
+Rows are streamed from a snapshot of each shard, PARQUET_CHUNK at a time, so memory stays
+flat however long the history. Archived years (helpers/archive.py) are included.
+
+Runs are incremental: DEST/_state.json keeps the last month written per table and file,
+and the next run rewrites from that month on, since it may have received rows since.
+Older months are left alone, so edits to them, and users moved between shards, need a
+--full run.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: only this export needs it
+    pa = pq = None
+
+import database as db
+
+PARQUET_DIR = Path(os.environ.get("PARQUET_DIR", db.DB.parent / "parquet"))
+PARQUET_CHUNK = int(os.environ.get("PARQUET_CHUNK", "50000"))
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "zstd")
+
+# table -> (date column, query); rows come out ordered by date, so months are contiguous
+TABLES = {
+    "transactions": ("date", "SELECT t.*, c.name AS category FROM {source} t LEFT JOIN categories c ON c.id = t.category_id"),
+    "receivables": ("date", "SELECT t.* FROM {source} t"),
+    "budgets": ("month", "SELECT t.*, c.name AS category FROM {source} t LEFT JOIN categories c ON c.id = t.category_id"),
+}
+PARTITION = "period"
+
+
+def _require():
+    if pa is None:
+        raise RuntimeError("A exportação Parquet precisa do pacote pyarrow (pip install pyarrow).")
+
+
+def _arrow_type(declared: str):
+    declared = (declared or "").upper()
+    if "INT" in declared:
+        return pa.int64()
+    if "REAL" in declared or "FLOA" in declared or "DOUB" in declared:
+        return pa.float64()
+    return pa.string()
+
+
+def _schema(conn, table: str, columns: List[str]):
+    declared = {r[1]: r[2] for r in conn.execute(f"PRAGMA main.table_info({table})")}
+    return pa.schema([(c, _arrow_type(declared.get(c))) for c in columns])
+
+
+def _load_state(dest: Path) -> Dict[str, Dict[str, str]]:
+    path = dest / "_state.json"
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def _save_state(dest: Path, state: Dict[str, Dict[str, str]]):
+    tmp = dest / "_state.json.tmp"
+    tmp.write_text(json.dumps(state, indent=1, sort_keys=True))
+    os.replace(tmp, dest / "_state.json")
+
+
+def export_table(conn, table: str, dest: Path, scope: str, user_id: int = None, since: str = None) -> Dict[str, int]:
+    """Writes one table's rows from month `since` on (all with None) into
+    DEST/table/period=YYYY-MM/<scope>.parquet. Returns the rows written per month.
+
+    Files of this scope for rewritten months that no longer have rows are removed.
+    """
+    _require()
+    date_col, select = TABLES[table]
+    source = db._source(conn, table, f"{since}-01" if since else None, None) if table != "budgets" else table
+    q = select.format(source=source)
+    where, params = [], []
+    if user_id is not None:
+        where.append("t.user_id = ?"); params.append(user_id)
+    if since:
+        where.append(f"t.{date_col} >= ?"); params.append(since if date_col == "month" else f"{since}-01")
+    q += (" WHERE " + " AND ".join(where) if where else "") + f" ORDER BY t.{date_col}, t.id"
+
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(q, params)
+    columns = [d[0] for d in cur.description]
+    schema = _schema(conn, table, columns)
+    date_idx = columns.index(date_col)
+    written: Dict[str, int] = {}
+    writer: Optional[Tuple[str, Path, "pq.ParquetWriter"]] = None
+
+    def close():
+        # Written under a temporary name and renamed, so readers never see half a file
+        if writer:
+            month, tmp, w = writer
+            w.close()
+            os.replace(tmp, tmp.parent / f"{scope}.parquet")
+
+    try:
+        while True:
+            chunk = cur.fetchmany(PARQUET_CHUNK)
+            if not chunk:
+                break
+            # Split the chunk where the month changes; each month goes to its own file
+            start = 0
+            while start < len(chunk):
+                month = str(chunk[start][date_idx])[:7]
+                end = start
+                while end < len(chunk) and str(chunk[end][date_idx])[:7] == month:
+                    end += 1
+                if writer is None or writer[0] != month:
+                    close()
+                    part = dest / table / f"{PARTITION}={month}"
+                    part.mkdir(parents=True, exist_ok=True)
+                    tmp = part / f"{scope}.parquet.tmp"
+                    writer = (month, tmp, pq.ParquetWriter(tmp, schema, compression=PARQUET_COMPRESSION))
+                rows = chunk[start:end]
+                arrays = [pa.array([r[i] for r in rows], type=field.type) for i, field in enumerate(schema)]
+                writer[2].write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                written[month] = written.get(month, 0) + len(rows)
+                start = end
+        close()
+        writer = None
+    finally:
+        if writer:
+            writer[2].close()
+            writer[1].unlink(missing_ok=True)
+
+    for stale in (dest / table).glob(f"{PARTITION}=*/{scope}.parquet") if (dest / table).exists() else ():
+        month = stale.parent.name.split("=", 1)[1]
+        if (since is None or month >= since) and month not in written:
+            stale.unlink()
+    return written
+
+
+def export_dataset(dest: Path = PARQUET_DIR, user_id: int = None, full: bool = False) -> Dict[str, Dict[str, Dict[str, int]]]:
+    """Exports every table for one user (or every shard), incrementally unless `full`.
+    Returns the rows written per table, file and month."""
+    _require()
+    if user_id is not None:
+        # A dataset of its own, so reading DEST never counts the user's rows twice
+        dest = dest / f"user-{user_id}"
+        targets = [(db.shard_path(db.shard_for_user(user_id)), f"user-{user_id}")]
+    else:
+        targets = [(db.shard_path(shard), f"shard-{shard}") for shard in range(db.SHARD_COUNT)]
+    dest.mkdir(parents=True, exist_ok=True)
+    state = {} if full else _load_state(dest)
+    report: Dict[str, Dict[str, Dict[str, int]]] = {}
+    for path, scope in targets:
+        # One read transaction per shard: every table comes from the same point in time
+        conn = db._open_snapshot(path, copy=False)
+        try:
+            for table in TABLES:
+                since = state.get(table, {}).get(scope)
+                written = export_table(conn, table, dest, scope, user_id, since)
+                report.setdefault(table, {})[scope] = written
+                if written:
+                    state.setdefault(table, {})[scope] = max(written)
+        finally:
+            conn.close()
+        _save_state(dest, state)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta transações, recebíveis e orçamentos em Parquet particionado por mês.")
+    parser.add_argument("--dest", type=Path, default=PARQUET_DIR, help=f"Pasta do dataset (padrão: {PARQUET_DIR}).")
+    parser.add_argument("--user", type=int, default=None, help="Só este usuário (padrão: todos os shards).")
+    parser.add_argument("--full", action="store_true", help="Reescreve tudo em vez de só os meses novos.")
+    args = parser.parse_args(argv)
+
+    for table, scopes in export_dataset(args.dest, args.user, args.full).items():
+        for scope, written in scopes.items():
+            months = f"{min(written)}..{max(written)}" if written else "nada novo"
+            print(f"{table:<12} {scope}: {sum(written.values())} linhas, {len(written)} mês(es) ({months})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Password hashing off the request thread.
+
+Hashing and checking a password is deliberately slow (tens of milliseconds of CPU), so a
+burst of logins run on the web workers' threads stalls every other request they serve.
+Here the work runs in a small pool of worker processes instead. At most PASSWORD_QUEUE
+hashes may be queued or running per web process; beyond that PasswordBusyError is raised
+at once rather than letting requests pile up behind the pool.
+
+PASSWORD_METHOD is werkzeug's method string ("scrypt:32768:8:1", "pbkdf2:sha256:600000",
+...). Stored hashes made with other parameters still verify, and are replaced with one
+made with the current method on the user's next successful login (verify()).
+
+    python -m helpers.passwords --seconds 5      # logins/s per core with this method
+
+PASSWORD_WORKERS=0 hashes in the calling thread (scripts, tests).
+"""
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, TimeoutError as FutureTimeout, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+PASSWORD_METHOD = os.environ.get("PASSWORD_METHOD", "scrypt")
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", "2"))
+PASSWORD_QUEUE = int(os.environ.get("PASSWORD_QUEUE", "32"))
+PASSWORD_TIMEOUT = float(os.environ.get("PASSWORD_TIMEOUT", "10"))
+
+
+class PasswordBusyError(RuntimeError):
+    """Too many hashes queued; the caller should ask the user to retry."""
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(1, PASSWORD_QUEUE))
+_prefixes = {}
+
+
+# --- Worker side ---
+def _hash(password: str, method: str) -> str:
+    return generate_password_hash(password, method=method)
+
+
+def _verify(pwhash: str, password: str, method: str, prefix: str) -> Tuple[bool, Optional[str]]:
+    """(matches, new hash when it matches but was made with other parameters)."""
+    if not check_password_hash(pwhash, password):
+        return False, None
+    return True, (None if pwhash.split("$", 1)[0] == prefix else generate_password_hash(password, method=method))
+
+
+# --- Caller side ---
+def _pool() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            # Spawned, not forked: see helpers/jobs.py
+            _executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def _reset_pool():
+    """Drops a pool whose worker died; the next call starts a fresh one."""
+    global _executor
+    with _lock:
+        _executor = None
+
+
+def _call(fn, *args):
+    if PASSWORD_WORKERS <= 0:
+        return fn(*args)
+    if not _slots.acquire(blocking=False):
+        raise PasswordBusyError("Muitas solicitações no momento. Tente novamente em instantes.")
+    try:
+        future = _pool().submit(fn, *args)
+    except BrokenProcessPool:
+        _slots.release()
+        _reset_pool()
+        raise PasswordBusyError("Serviço de senhas indisponível. Tente novamente.")
+    # The slot is held until the hash is done, even when the caller gave up waiting
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=PASSWORD_TIMEOUT)
+    except BrokenProcessPool:
+        _reset_pool()
+        raise PasswordBusyError("Serviço de senhas indisponível. Tente novamente.")
+    except FutureTimeout:
+        raise PasswordBusyError("Tempo esgotado ao verificar a senha. Tente novamente.")
+
+
+def method_prefix(method: str = None) -> str:
+    """The parameters part of hashes made with `method`, as werkzeug writes it
+    ("scrypt" -> "scrypt:32768:8:1"), worked out once from a sample hash."""
+    method = method or PASSWORD_METHOD
+    if method not in _prefixes:
+        _prefixes[method] = generate_password_hash("", method=method).split("$", 1)[0]
+    return _prefixes[method]
+
+
+def hash_password(password: str) -> str:
+    return _call(_hash, password, PASSWORD_METHOD)
+
+
+def verify(pwhash: str, password: str) -> Tuple[bool, Optional[str]]:
+    """Checks a password against its stored hash. Returns (matches, new_hash); new_hash
+    is set when the password matches but the hash uses outdated parameters, and should
+    replace the stored one."""
+    return _call(_verify, pwhash, password, PASSWORD_METHOD, method_prefix())
+
+
+def benchmark(seconds: float = 5.0, workers: int = None, method: str = None) -> dict:
+    """Verifications per second through the pool, kept saturated for `seconds`."""
+    method = method or PASSWORD_METHOD
+    workers = workers or PASSWORD_WORKERS or 1
+    pwhash, prefix = generate_password_hash("correct horse", method=method), method_prefix(method)
+
+    start = time.perf_counter()
+    _verify(pwhash, "correct horse", method, prefix)
+    single = time.perf_counter() - start
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        # Warm-up: start every worker before timing
+        for f in [pool.submit(_verify, pwhash, "correct horse", method, prefix) for _ in range(workers)]:
+            f.result()
+        done, pending = 0, set()
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            while len(pending) < workers * 2:
+                pending.add(pool.submit(_verify, pwhash, "correct horse", method, prefix))
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            done += len(finished)
+        elapsed = time.perf_counter() - start
+        for f in pending:
+            f.cancel()
+    rate = done / elapsed
+    return {
+        "method": prefix,
+        "workers": workers,
+        "ms_per_login": single * 1000,
+        "logins_per_second": rate,
+        "logins_per_second_per_core": rate / min(workers, os.cpu_count() or 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mede logins por segundo com o método de hash configurado.")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--method", default=None, help=f"método do werkzeug (padrão: {PASSWORD_METHOD})")
+    args = parser.parse_args(argv)
+    r = benchmark(args.seconds, args.workers, args.method)
+    print(f"{r['method']}: {r['ms_per_login']:.1f} ms por verificação; "
+          f"{r['logins_per_second']:.1f} logins/s com {r['workers']} processo(s), "
+          f"{r['logins_per_second_per_core']:.1f} logins/s por núcleo")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Shard maintenance: inspecting the user distribution and moving users between shards.
+
+    python -m helpers.shards list
+    python -m helpers.shards move <user_id> <shard>
+"""
+import argparse
+import sqlite3
+import time
+from typing import Dict, List
+
+import database as db
+from helpers.archive import ARCHIVED_ROWS
+
+
+def _copy_user_rows(source: sqlite3.Connection, target: sqlite3.Connection, user_id: int, id_maps: Dict[str, Dict[int, int]],
+                    tables=db.USER_TABLES, schema: str = "main") -> int:
+    """Copies a user's rows from `schema` on the source into `target`, with fresh ids there.
+
+    `id_maps` collects old -> new ids per table so that references (and rows copied by a
+    later pass) point at the target copies. Dangling references become NULL.
+    """
+    copied = 0
+    for table, refs in tables:
+        target_cols = {r[1] for r in target.execute(f"PRAGMA table_info({table})")}
+        cols = [r[1] for r in source.execute(f"PRAGMA {schema}.table_info({table})") if r[1] in target_cols]
+        insert_cols = [c for c in cols if c != "id"]
+        id_map = id_maps.setdefault(table, {})
+        sql = f"INSERT OR REPLACE INTO {table} ({', '.join(insert_cols)}) VALUES ({', '.join('?' * len(insert_cols))})"
+        for row in source.execute(f"SELECT {', '.join(cols)} FROM {schema}.{table} WHERE user_id = ?", (user_id,)).fetchall():
+            values = dict(zip(cols, row))
+            for col, parent in refs.items():
+                if values[col] is not None:
+                    values[col] = id_maps[parent].get(values[col])
+            cur = target.execute(sql, [values[c] for c in insert_cols])
+            if "id" in values:
+                id_map[values["id"]] = cur.lastrowid
+            copied += 1
+    return copied
+
+
+def _delete_user_rows(conn: sqlite3.Connection, user_id: int, archives=()):
+    for schema in archives:
+        for table in ARCHIVED_ROWS:
+            conn.execute(f"DELETE FROM {schema}.{table} WHERE user_id = ?", (user_id,))
+    for table, _ in reversed(db.USER_TABLES):
+        conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+    # Last: deleting the rows above bumps the user's data version again.
+    for table in db.DERIVED_USER_TABLES:
+        conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+
+
+def _attach_archives(conn: sqlite3.Connection) -> List[str]:
+    return [db._attach_archive(conn, year, path) for year, path in conn.execute("SELECT year, path FROM archives").fetchall()]
+
+
+def _move_pass(source: sqlite3.Connection, target: sqlite3.Connection, user_id: int, id_maps: Dict[str, Dict[int, int]],
+               archives: List[str], switch=None) -> int:
+    # Holding the source write lock keeps the user's rows stable until they are deleted.
+    source.execute("BEGIN IMMEDIATE")
+    try:
+        target.execute("BEGIN IMMEDIATE")
+        try:
+            copied = _copy_user_rows(source, target, user_id, id_maps)
+            # Archived rows land in the target's hot tables; the next archiving run
+            # moves them into the target's own archive files.
+            archived_tables = [(table, refs) for table, refs in db.USER_TABLES if table in ARCHIVED_ROWS]
+            for schema in archives:
+                copied += _copy_user_rows(source, target, user_id, id_maps, archived_tables, schema)
+            target.execute("COMMIT")
+        except Exception:
+            target.execute("ROLLBACK")
+            raise
+        if switch:
+            try:
+                switch()
+            except Exception:
+                # The directory still points at the source; drop the copies.
+                _delete_user_rows(target, user_id)
+                raise
+        _delete_user_rows(source, user_id, archives)
+        source.execute("COMMIT")
+    except Exception:
+        if source.in_transaction:
+            source.execute("ROLLBACK")
+        raise
+    return copied
+
+
+def move_user(user_id: int, shard: int, settle: float = 1.0) -> int:
+    """Moves a user's rows to another shard while the app keeps running.
+
+    Writers on the source shard wait only for the copy itself. The directory is switched
+    once the copy is committed, and a second pass after `settle` seconds sweeps up writes
+    from requests that had already resolved the old shard. Row ids change in the move,
+    archived rows return to the hot tables until the next archiving run, and derived
+    tables are dropped for rebuilding (budget counters and balance checkpoints are
+    rebuilt right away, and sync clients get a full reset from /api/changes). Returns
+    the number of rows moved.
+    """
+    if not 0 <= shard < db.SHARD_COUNT:
+        raise ValueError(f"Shard {shard} não existe (DATABASE_SHARDS={db.SHARD_COUNT}).")
+    current = db.shard_for_user(user_id)
+    if current == shard:
+        return 0
+
+    source = sqlite3.connect(db.shard_path(current), isolation_level=None, timeout=30)
+    target = sqlite3.connect(db.shard_path(shard), isolation_level=None, timeout=30)
+    directory = sqlite3.connect(db.DB, isolation_level=None, timeout=30)
+    try:
+        archives = _attach_archives(source)
+
+        def switch():
+            # Shard 0 is the directory file: while moving out of it, the source
+            # connection holds its write lock, so the switch goes through it and commits
+            # together with the deletion of the user's rows.
+            (source if current == 0 else directory).execute(
+                "INSERT INTO user_shards (user_id, shard) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET shard = excluded.shard",
+                (user_id, shard))
+
+        id_maps: Dict[str, Dict[int, int]] = {}
+        source_seq = source.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name = 'change_log'").fetchone()[0] or 0
+        moved = _move_pass(source, target, user_id, id_maps, archives, switch)
+        time.sleep(settle)
+        moved += _move_pass(source, target, user_id, id_maps, archives)
+        db.rebuild_budget_usage(user_id)
+        db.rebuild_balance_checkpoints(user_id)
+        db.reset_change_log(user_id, after=source_seq)
+        return moved
+    finally:
+        source.close()
+        target.close()
+        directory.close()
+
+
+def shard_distribution() -> Dict[int, int]:
+    """Returns the number of users per shard."""
+    counts = {shard: 0 for shard in range(db.SHARD_COUNT)}
+    with db.get_conn() as conn:
+        rows = conn.execute("SELECT COALESCE(s.shard, 0), COUNT(*) FROM users u LEFT JOIN user_shards s ON s.user_id = u.id GROUP BY 1").fetchall()
+    for shard, count in rows:
+        counts[shard] = count
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gerencia os shards do banco de dados.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="Mostra quantos usuários há em cada shard.")
+    move = sub.add_parser("move", help="Move um usuário para outro shard.")
+    move.add_argument("user_id", type=int)
+    move.add_argument("shard", type=int)
+    move.add_argument("--settle", type=float, default=1.0, help="Segundos antes da segunda passada (padrão: 1).")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for shard, count in shard_distribution().items():
+            print(f"shard {shard} ({db.shard_path(shard)}): {count} usuários")
+    else:
+        moved = move_user(args.user_id, args.shard, settle=args.settle)
+        print(f"Usuário {args.user_id} no shard {args.shard} ({moved} registros movidos).")
+
+
+if __name__ == "__main__":
+    main()
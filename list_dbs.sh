@@ -1 +1 @@
-find ~ -type f -name "finance.db" -ls
+find ~ -type f \( -name "finance.db" -o -name "finance-*.db" \) -ls
\ No newline at end of file
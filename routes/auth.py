@@ -6,9 +6,9 @@ from flask import (
 from flask_login import login_user, logout_user, current_user, login_required
 from itsdangerous import URLSafeTimedSerializer
 from datetime import datetime
-from werkzeug.security import check_password_hash, generate_password_hash
 
 import database as db
+from helpers.passwords import PasswordBusyError
 # --- CORREÇÃO AQUI ---
 # Trocado de 'from forms import' para 'from web.forms import'
 # --- ATUALIZADO ---
@@ -54,6 +54,12 @@ def send_reset_email(user):
 
 # --- Rotas de Autenticação (Movidas de web.py) ---
 
+@auth_bp.errorhandler(PasswordBusyError)
+def password_busy(error):
+    # O pool de hash está cheio (pico de logins): pede para tentar de novo em vez de enfileirar
+    flash(str(error), 'warning')
+    return redirect(request.url)
+
 @auth_bp.route("/register", methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
@@ -79,8 +85,13 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = db.get_user_by_email(form.email.data)
-        
-        if user and user.verify_password(form.password.data):
+        try:
+            valid = bool(user) and user.verify_password(form.password.data)
+        except PasswordBusyError as e:
+            flash(str(e), 'warning')
+            return render_template('login.html', title='Login', form=form, active_page="login",
+                                   datetime=datetime), 503, {'Retry-After': '5'}
+        if valid:
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('dashboard.index'))
@@ -1,39 +1,20 @@
 # src/web/routes/budgets.py
 from flask import (
-    Blueprint, render_template, request, redirect, url_for, flash
+    Blueprint, render_template, request, redirect, url_for, flash, jsonify
 )
 from flask_login import login_required, current_user
 from datetime import datetime, timezone
-import locale # Importado para formatar o mês
-from contextlib import contextmanager # Para gerenciar o locale
+from dateutil.relativedelta import relativedelta
 
 # --- CORREÇÃO: Import absoluto (sem '...') ---
 import database as db
+from formatting import month_label
 
 # Crie o Blueprint
 budgets_bp = Blueprint('budgets', 
                        __name__, 
                        template_folder='../templates')
 
-# --- MELHORIA: Context Manager para Locale ---
-# Isso garante que o mês (ex: "Novembro") apareça em Português
-# sem afetar o resto da aplicação de forma global.
-@contextmanager
-def set_locale(name):
-    saved = None
-    try:
-        # Tenta definir o locale. Pode falhar no Windows com 'pt_BR.UTF-8'
-        # 'Portuguese_Brazil.1252' é um fallback comum no Windows.
-        try:
-            saved = locale.setlocale(locale.LC_TIME, name)
-        except locale.Error:
-            saved = locale.setlocale(locale.LC_TIME, 'Portuguese_Brazil.1252')
-            
-        yield
-    finally:
-        if saved:
-            locale.setlocale(locale.LC_TIME, saved)
-
 @budgets_bp.route("/budgets", methods=["GET", "POST"])
 @login_required
 def index():
@@ -42,19 +23,18 @@ def index():
     if request.method == "POST":
         try:
             month_to_save = request.form.get("month")
-            categories = db.fetch_categories(current_user.id)
-            for cat_id, cat_name in categories:
-                budget_val_str = request.form.get(f"budget_{cat_id}")
-                if budget_val_str:
-                    # Permite salvar valores vazios como "remover orçamento"
-                    amount = 0.0
-                    # Remove R$ e espaços, depois troca vírgula por ponto
-                    cleaned_val = budget_val_str.replace("R$", "").strip()
-                    if cleaned_val:
-                        amount = float(cleaned_val.replace(",", "."))
-                        
-                    if amount >= 0:
-                        db.set_budget(current_user.id, cat_id, amount, month_to_save)
+            # Todos os campos budget_<id> do formulário, salvos numa única transação;
+            # campo vazio remove o orçamento da categoria no mês
+            amounts = {}
+            for field, budget_val_str in request.form.items():
+                if not field.startswith("budget_"):
+                    continue
+                # Remove R$ e espaços, depois troca vírgula por ponto
+                cleaned_val = budget_val_str.replace("R$", "").strip()
+                amount = float(cleaned_val.replace(",", ".")) if cleaned_val else None
+                if amount is None or amount >= 0:
+                    amounts[int(field[len("budget_"):])] = amount
+            db.set_budgets(current_user.id, month_to_save, amounts)
             flash("Orçamentos salvos com sucesso!", "success")
         except Exception as e:
             flash(f"Erro ao salvar orçamentos: {e}", "danger")
@@ -65,10 +45,8 @@ def index():
     
     current_month_str = current_month
     try:
-        month_dt = datetime.strptime(current_month, '%Y-%m')
-        # Usa o context manager para formatar o nome do mês em PT-BR
-        with set_locale('pt_BR.UTF-8'):
-            current_month_str = month_dt.strftime('%B de %Y').capitalize()
+        # Nome do mês em PT-BR sem mexer no locale do processo
+        current_month_str = month_label(datetime.strptime(current_month, '%Y-%m'), long=True)
     except ValueError:
         pass # Mantém o formato 'YYYY-MM' se a data for inválida
 
@@ -81,6 +59,61 @@ def index():
                            )
 
 
+@budgets_bp.route('/budgets/copy', methods=['POST'])
+@login_required
+def copy_forward():
+    month = request.form.get('month', datetime.now(timezone.utc).strftime('%Y-%m'))
+    try:
+        months = max(1, min(int(request.form.get('months', 1)), 24))
+        start = datetime.strptime(month, '%Y-%m')
+        targets = [(start + relativedelta(months=k)).strftime('%Y-%m') for k in range(1, months + 1)]
+        written = db.copy_budgets(current_user.id, month, targets, overwrite=bool(request.form.get('overwrite')))
+        flash(f'{written} orçamento(s) copiado(s) para os próximos {months} mês(es).', 'success')
+    except Exception as e:
+        flash(f'Erro ao copiar orçamentos: {e}', 'danger')
+    return redirect(url_for('.index', month=month))
+
+
+@budgets_bp.route('/budgets/plan')
+@login_required
+@db.snapshot_reads
+def plan():
+    """Planejamento anual: orçado x realizado de 12 meses por categoria."""
+    first_month = request.args.get('start', datetime.now(timezone.utc).strftime('%Y-01'))
+    try:
+        first_date = datetime.strptime(first_month, '%Y-%m')
+    except ValueError:
+        first_date = datetime.now(timezone.utc).replace(month=1)
+        first_month = first_date.strftime('%Y-%m')
+    return render_template("budget_plan.html",
+                           grid=db.get_budget_grid(current_user.id, first_month),
+                           first_month=first_month,
+                           prev_start=f"{first_date.year - 1}-{first_date.month:02d}",
+                           next_start=f"{first_date.year + 1}-{first_date.month:02d}",
+                           active_page="budgets")
+
+
+@budgets_bp.route('/api/notifications')
+@login_required
+def api_notifications():
+    """Alertas de orçamento não lidos (lidos dos contadores, sem agregar o mês)."""
+    return jsonify({'unread': db.count_unread_notifications(current_user.id),
+                    'items': db.get_notifications(current_user.id)})
+
+
+@budgets_bp.route('/api/notifications/read', methods=['POST'])
+@login_required
+def api_notifications_read():
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get('ids') if isinstance(payload, dict) else None
+    try:
+        ids = [int(i) for i in ids] if ids is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids deve ser uma lista de números'}), 400
+    db.mark_notifications_read(current_user.id, ids)
+    return jsonify({'status': 'ok'})
+
+
 @budgets_bp.route('/budgets/add_category', methods=['POST'])
 @login_required
 def add_category():
@@ -1,13 +1,21 @@
 from flask import Blueprint, render_template, jsonify, request
 from flask_login import login_required, current_user
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
+import os
 import database as db
+from formatting import format_currency
+from helpers import analytics
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+CALENDAR_MAX_DAYS = 366
+# Above this many transactions in the visible range the calendar gets per-day totals instead
+CALENDAR_MAX_EVENTS = int(os.environ.get("CALENDAR_MAX_EVENTS", "300"))
+
 @dashboard_bp.route("/dashboard")
 @login_required
+@db.snapshot_reads
 def index():
     current_month = datetime.now().strftime('%Y-%m')
     
@@ -22,16 +30,14 @@ def index():
     # --- 2. DADOS PARA OS CARDS INFERIORES ---
     budgets = db.get_budgets_with_spending(current_user.id, current_month)
     
-    recent_rows = db.fetch_transactions(current_user.id, limit=5)
-    recent_df = db.to_df(recent_rows)
-    recent_transactions_list = recent_df.to_dict(orient='records') if not recent_df.empty else []
+    recent_transactions_list = db.fetch_transactions(current_user.id, limit=5, mode="records")
 
     # --- 3. DADOS PARA OS GRÁFICOS (NOVO) ---
     expense_data = db.get_spending_by_category(user_id=current_user.id, date_from=f"{current_month}-01")
-    daily_summary = db.get_daily_summary(current_user.id, days=30)
+    today = datetime.now().date()
+    daily_summary = analytics.series(current_user.id, (today - timedelta(days=30)).isoformat(), today.isoformat())
 
-    savings = db.get_savings_for_user(current_user.id)
-    total_savings = sum(s['balance'] for s in savings)
+    total_savings = db.get_savings_total(current_user.id)
     
     return render_template('dashboard.html',
                             month_income=total_income,
@@ -48,7 +54,79 @@ def index():
 
 @dashboard_bp.route("/api/calendar")
 @login_required
+@db.snapshot_reads
 def calendar_events():
-    month = request.args.get('month', datetime.now().strftime('%Y-%m'))
-    events = db.get_month_transactions(current_user.id, month)
-    return jsonify(events)
\ No newline at end of file
+    """Eventos do calendário no intervalo visível (?start=&end=, fim exclusivo, ou ?month=AAAA-MM).
+
+    Com mode=days, ou mode=auto (padrão) quando o intervalo passa de CALENDAR_MAX_EVENTS
+    lançamentos, devolve um evento por dia e tipo com o total e a quantidade.
+    """
+    if request.args.get('start'):
+        date_from, date_to = request.args['start'][:10], request.args.get('end', '')[:10]
+    else:
+        month = request.args.get('month', datetime.now().strftime('%Y-%m'))
+        date_from, date_to = f"{month}-01", f"{db._next_month(month)}-01"
+    try:
+        start, end = datetime.strptime(date_from, '%Y-%m-%d'), datetime.strptime(date_to, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Intervalo inválido'}), 400
+    if start >= end or (end - start).days > CALENDAR_MAX_DAYS:
+        return jsonify({'error': f'O intervalo deve ter entre 1 e {CALENDAR_MAX_DAYS} dias'}), 400
+
+    mode = request.args.get('mode', 'auto')
+    if mode == 'events':
+        return jsonify(db.get_calendar_events(current_user.id, date_from, date_to))
+    days = db.get_calendar_days(current_user.id, date_from, date_to)
+    if mode == 'auto' and sum(d['count'] for d in days) <= CALENDAR_MAX_EVENTS:
+        return jsonify(db.get_calendar_events(current_user.id, date_from, date_to))
+    labels = {'income': ('receita', 'receitas'), 'expense': ('despesa', 'despesas')}
+    return jsonify([{
+        "start": d['day'], "allDay": True, "type": d['type'], "amount": d['total'], "count": d['count'], "aggregated": True,
+        "title": f"{d['count']} {labels.get(d['type'], (d['type'], d['type']))[d['count'] != 1]} · {format_currency(d['total'])}",
+    } for d in days])
+
+@dashboard_bp.route("/api/analytics/categories")
+@login_required
+@db.snapshot_reads
+def analytics_categories():
+    """Matrizes mês x categoria de receitas e despesas (?from=YYYY-MM&to=YYYY-MM&variant=raw|yoy|ma&window=3)."""
+    today = datetime.now()
+    month_to = request.args.get('to', today.strftime('%Y-%m'))
+    month_from = request.args.get('from', f"{today.year - 1}-{today.month:02d}")
+    try:
+        datetime.strptime(month_from, '%Y-%m'), datetime.strptime(month_to, '%Y-%m')
+    except ValueError:
+        return jsonify({'error': 'Meses devem estar no formato AAAA-MM'}), 400
+    if month_from > month_to:
+        return jsonify({'error': 'Período inválido'}), 400
+    if len(analytics.month_range(month_from, month_to, analytics.MAX_MONTHS + 1)) > analytics.MAX_MONTHS:
+        return jsonify({'error': f'Período máximo de {analytics.MAX_MONTHS} meses'}), 400
+    try:
+        data = analytics.category_matrix(current_user.id, month_from, month_to,
+                                         request.args.get('variant', 'raw'), request.args.get('window', 3, type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(data)
+
+
+@dashboard_bp.route("/api/analytics/series")
+@login_required
+@db.snapshot_reads
+def analytics_series():
+    """Série de receitas/despesas com dias vazios zerados e acumulados (?from=AAAA-MM-DD&to=AAAA-MM-DD&bucket=day|week|month)."""
+    today = datetime.now().date()
+    date_to = request.args.get('to', today.isoformat())
+    date_from = request.args.get('from', (today - timedelta(days=30)).isoformat())
+    try:
+        start, end = datetime.strptime(date_from, '%Y-%m-%d'), datetime.strptime(date_to, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Datas devem estar no formato AAAA-MM-DD'}), 400
+    if start > end:
+        return jsonify({'error': 'Período inválido'}), 400
+    if (end - start).days > analytics.MAX_MONTHS * 31:
+        return jsonify({'error': f'Período máximo de {analytics.MAX_MONTHS} meses'}), 400
+    try:
+        data = analytics.series(current_user.id, date_from, date_to, request.args.get('bucket', 'day'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(data)
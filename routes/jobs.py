@@ -0,0 +1,35 @@
+from flask import Blueprint, jsonify, send_file, url_for
+from flask_login import login_required, current_user
+from helpers import jobs
+
+jobs_bp = Blueprint('jobs', __name__)
+
+def _describe(job):
+    data = dict(job)
+    if job['status'] == 'done':
+        data['download_url'] = url_for('.download', job_id=job['id'])
+    return data
+
+@jobs_bp.route("/jobs")
+@login_required
+def index():
+    """Tarefas recentes do usuário (exportações em andamento e concluídas)."""
+    return jsonify([_describe(j) for j in jobs.list_jobs(current_user.id)])
+
+@jobs_bp.route("/jobs/<job_id>")
+@login_required
+def status(job_id):
+    """Status e progresso (0 a 1) de uma tarefa; com status 'done' inclui download_url."""
+    job = jobs.get_job(current_user.id, job_id)
+    if job is None:
+        return jsonify({'error': 'Tarefa não encontrada'}), 404
+    return jsonify(_describe(job))
+
+@jobs_bp.route("/jobs/<job_id>/download")
+@login_required
+def download(job_id):
+    job = jobs.get_job(current_user.id, job_id)
+    path = jobs.result_path(job) if job else None
+    if path is None:
+        return jsonify({'error': 'Arquivo indisponível ou expirado'}), 404
+    return send_file(path, as_attachment=True, download_name=job['filename'], mimetype=job['mimetype'])
@@ -1,17 +1,20 @@
 # routes/receivables.py
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file
 from flask_login import login_required, current_user
 from datetime import datetime
 import database as db
 import utils
+from formatting import format_currency, format_date
+from helpers.export import export_aging_csv
+from web.fragments import render_fragment
 
 receivables_bp = Blueprint('receivables', __name__)
 
 @receivables_bp.route("/receivables")
 @login_required
+@db.snapshot_reads
 def index():
     try:
-        utils.setup_locale()
         # O mês alvo (target) agora será tratado como o Mês de Referência (trabalho/competência)
         m = utils.get_month_range(request.args.get('month'))
         
@@ -19,33 +22,23 @@ def index():
         payment_month_str = m['next_month']
         payment_month_display = m['next_month_display']
 
-        recurring_rules = db.get_recurring_receivables_by_user(current_user.id)
+        recurring_rules = db.get_recurring_receivables_by_user(current_user.id, mode="records")
         # Recorrentes pagas neste mês de recebimento alvo
         paid_in_month_ids = db.get_paid_recurring_ids_for_month(current_user.id, payment_month_str)
         
         pending_recurring = [r for r in recurring_rules if r['id'] not in paid_in_month_ids]
-        pending_manual = db.get_receivables_by_user(current_user.id, status='pending')
+        pending_manual = db.get_receivables_by_user(current_user.id, status='pending', mode="records")
         
-        # --- Cálculo do Ciclo Atual (Dinheiro que entra no mês seguinte referente a este mês) ---
-        # 1. Recorrentes que vencem no mês de pagamento alvo
-        total_cycle = sum(float(r['amount']) for r in pending_recurring)
-        # 2. Manuais cujo Mês de Referência é o mês alvo OU cujo Vencimento é o mês de pagamento alvo
-        for r in pending_manual:
-            ref = r.get('reference_month') or r['date'][:7]
-            payout = r['date'][:7]
-            if ref == m['month_str'] or payout == payment_month_str:
-                total_cycle += float(r['amount'])
-        
-        # --- Atrasados + Próximos ---
-        total_all_time = sum(float(r['amount']) for r in pending_manual) + sum(float(r['amount']) for r in pending_recurring)
+        # Ciclo atual (recorrentes não pagas no mês de recebimento + manuais do mês de referência
+        # ou que vencem no mês de recebimento) e total pendente geral, somados no SQL
+        totals = db.get_receivables_totals(current_user.id, m['month_str'], payment_month_str)
 
         return render_template('receivables.html', 
                                pending_manual_receivables=pending_manual,
                                pending_recurring=pending_recurring,
-                               all_recurring_rules=recurring_rules,
-                               paid_history=db.get_paid_receivables_history(current_user.id),
-                               total_pending_cycle=total_cycle,
-                               total_pending_all_time=total_all_time,
+                               recurring_rules_rows=render_fragment("partials/recurring_receivables.html", recurring_rules=lambda: recurring_rules),
+                               total_pending_cycle=totals['cycle'],
+                               total_pending_all_time=totals['all_time'],
                                target_month_display=m['display'],
                                target_month_str=m['month_str'],
                                payment_month_display=payment_month_display,
@@ -58,6 +51,25 @@ def index():
         flash(f"Erro ao carregar recebíveis: {e}", "danger")
         return redirect(url_for('dashboard.index'))
 
+def _as_of():
+    """Aging reference date from the query string (YYYY-MM-DD), defaulting to today."""
+    try:
+        return datetime.strptime(request.args.get('as_of', ''), '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return datetime.now().strftime('%Y-%m-%d')
+
+@receivables_bp.route("/receivables/aging")
+@login_required
+def aging():
+    return render_template('aging.html', aging=db.get_receivables_aging(current_user.id, _as_of()), buckets=db.AGING_BUCKETS)
+
+@receivables_bp.route("/receivables/aging/export")
+@login_required
+def aging_export():
+    as_of = _as_of()
+    buf = export_aging_csv(current_user.id, as_of)
+    return send_file(buf, mimetype="text/csv", as_attachment=True, download_name=f"atrasos_{as_of}.csv")
+
 @receivables_bp.route("/receivables/add_manual", methods=["POST"])
 @login_required
 def add_manual():
@@ -116,6 +128,17 @@ def delete_recurring(recurring_id):
     flash("Regra removida!", "success")
     return redirect(url_for('receivables.index'))
 
+@receivables_bp.route("/api/receivables/paid")
+@login_required
+def api_paid_history():
+    """Paid history page by page (keyset): pass back `next` to get the following page."""
+    limit = min(max(request.args.get('limit', 30, type=int), 1), 100)
+    rows = db.get_paid_receivables_page(current_user.id, limit, request.args.get('before_date'), request.args.get('before_id', type=int),
+                                        request.args.get('before_src', type=int))
+    items = [dict(r, amount_display=format_currency(r['amount']), date_display=format_date(r['date'])) for r in rows]
+    cursor = {'before_date': rows[-1]['date'], 'before_src': rows[-1]['src'], 'before_id': rows[-1]['id']} if len(rows) == limit else None
+    return jsonify({'items': items, 'next': cursor})
+
 @receivables_bp.route("/api/receivable/<int:receivable_id>")
 @login_required
 def api_get_receivable(receivable_id):
@@ -9,7 +9,7 @@ savings_bp = Blueprint('savings', __name__)
 @savings_bp.route("/savings")
 @login_required
 def index():
-    savings_list = db.get_savings_for_user(current_user.id)
+    savings_list = db.get_savings_for_user(current_user.id, mode="records")
     return render_template('cofrinho.html',
                         savings=savings_list,
                         has_api=bool(os.getenv('CDI_API_URL')),
@@ -0,0 +1,23 @@
+from flask import Blueprint, jsonify, request
+from flask_login import login_required, current_user
+import database as db
+
+sync_bp = Blueprint('sync', __name__)
+
+CHANGES_MAX_LIMIT = 5000
+
+@sync_bp.route("/api/changes")
+@login_required
+@db.snapshot_reads
+def changes():
+    """Alterações desde a posição `since` do change log (?since=0&limit=500).
+
+    O cliente guarda o `cursor` devolvido e o envia como `since` na próxima chamada,
+    repetindo enquanto `more` for verdadeiro. Com `reset`, `changes` traz todos os
+    registros e a cópia local deve ser substituída.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', 500, type=int)
+    if limit < 1 or limit > CHANGES_MAX_LIMIT:
+        return jsonify({'error': f'limit deve estar entre 1 e {CHANGES_MAX_LIMIT}'}), 400
+    return jsonify(db.get_changes(current_user.id, since, limit))
@@ -1,17 +1,35 @@
 # routes/transactions.py
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
-from datetime import datetime, timedelta
+from datetime import datetime
+import calendar
 import database as db
 import utils
+from helpers import categorize, jobs
+from web.fragments import render_fragment
 
 transactions_bp = Blueprint('transactions', __name__)
 
+BATCH_MAX_OPERATIONS = 1000
+
+def _filter_args(m):
+    """Builds the fetch/count/summary filters from the query string (defaults to month `m`)."""
+    date_from = request.args.get("date_from", m['target_date'].replace(day=1).strftime('%Y-%m-%d'))
+    _, last_day = calendar.monthrange(m['target_date'].year, m['target_date'].month)
+    date_to = request.args.get("date_to", f"{m['month_str']}-{last_day}")
+    return {
+        "user_id": current_user.id, 
+        "filter_category": request.args.get("category", "") or None, 
+        "date_from": date_from, 
+        "date_to": date_to, 
+        "search": request.args.get("search", "") or None
+    }
+
 @transactions_bp.route("/", methods=["GET"])
 @login_required
+@db.snapshot_reads
 def index():
-    # Setup locale and common date variables
-    utils.setup_locale()
+    # Common date variables
     m = utils.get_month_range(request.args.get('month'))
     
     # Pagination & Filters
@@ -19,27 +37,16 @@ def index():
     per_page = int(request.args.get("per_page", 25))
     search = request.args.get("search", "")
     category = request.args.get("category", "")
-    date_from = request.args.get("date_from", m['target_date'].replace(day=1).strftime('%Y-%m-%d'))
-    date_to = request.args.get("date_to", (m['target_date'].replace(day=28) + timedelta(days=4)).replace(day=1).replace(day=1).strftime('%Y-%m-%d')) # Simplified later
-    
-    # Actual proper end of month
-    import calendar
-    _, last_day = calendar.monthrange(m['target_date'].year, m['target_date'].month)
-    date_to = request.args.get("date_to", f"{m['month_str']}-{last_day}")
-
-    filter_args = {
-        "user_id": current_user.id, 
-        "filter_category": category or None, 
-        "date_from": date_from, 
-        "date_to": date_to, 
-        "search": search or None
-    }
+    filter_args = _filter_args(m)
+    date_from, date_to = filter_args["date_from"], filter_args["date_to"]
 
     # Fetch Data
     total = db.count_transactions(**filter_args)
     pages = max(1, (total + per_page - 1) // per_page)
     offset = (page - 1) * per_page
-    rows = db.fetch_transactions(**filter_args, limit=per_page, offset=offset)
+    # Saldo acumulado só faz sentido na listagem completa (sem filtro de categoria/busca)
+    show_balance = not category and not search
+    rows = db.fetch_transactions(**filter_args, limit=per_page, offset=offset, with_balance=show_balance, mode="records")
     
     # Summary & Salary Integration
     summary = db.calculate_filtered_summary(**filter_args)
@@ -55,28 +62,58 @@ def index():
         paid_bal += fixed
         total_income += fixed
         total_bal += fixed
-    
+
+    # Cached fragments: the queries only run when the user's data changed
+    category_names = lambda: db.fetch_categories(current_user.id, mode="columns")["name"]
     return render_template("index.html",
                            rows=rows,
                            income=paid_income, expense=summary['paid_expense'], bal=paid_bal,
                            total_income=total_income, total_expense=summary['total_expense'], total_bal=total_bal,
-                           categories=[c['name'] for c in db.fetch_categories(current_user.id)], 
-                           recurring_rules=db.fetch_recurring_expenses(current_user.id),
+                           category_options=render_fragment("partials/category_options.html", categories=category_names, selected=None),
+                           category_filter_options=render_fragment("partials/category_options.html", categories=category_names, selected=category),
+                           recurring_rules_rows=render_fragment("partials/recurring_expenses.html",
+                                                                recurring_rules=lambda: db.fetch_recurring_expenses(current_user.id, mode="records")),
                            page=page, pages=pages, per_page=per_page, total=total,
                            target_month_str=m['month_str'], target_month_display=m['display'],
                            prev_month=m['prev_month'], next_month=m['next_month'],
-                           date_from=date_from, date_to=date_to, search=search, category=category,
+                           date_from=date_from, date_to=date_to, search=search, category=category, show_balance=show_balance,
                            datetime=datetime, active_page="transactions")
 
+@transactions_bp.route("/export/<fmt>", methods=["POST"])
+@login_required
+def export(fmt):
+    """Enfileira a exportação (helpers/jobs.py) e responde 202 com os links de status e download.
+    Só POST: enfileirar consome a cota de tarefas do usuário, então links pré-carregados
+    ou robôs não podem disparar exportações."""
+    if fmt not in jobs.MIMETYPES:
+        return {'error': 'Formato inválido'}, 400
+    m = utils.get_month_range(request.args.get('month'))
+    filters = {k: v for k, v in _filter_args(m).items() if k != "user_id"}
+    try:
+        job_id = jobs.submit(current_user.id, "transactions", {"fmt": fmt, "name": f"transacoes_{m['month_str']}", **filters})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 429
+    status_url = url_for('jobs.status', job_id=job_id)
+    return jsonify({'id': job_id, 'status_url': status_url,
+                    'download_url': url_for('jobs.download', job_id=job_id)}), 202, {'Location': status_url}
+
 @transactions_bp.route("/add", methods=["POST"])
 @login_required
 def add():
     try:
         amount = utils.parse_amount(request.form.get("amount"))
         cat_id = db.get_category_id(request.form.get("category"), current_user.id)
+        if cat_id is None or request.form.get("category") == db.FALLBACK_CATEGORY:
+            cat_id = categorize.suggest_category(current_user.id, request.form.get("description"), amount, request.form.get("type")) or cat_id
+        similar = db.find_duplicates(current_user.id, [{"date": request.form.get("date"), "amount": amount, "description": request.form.get("description")}])[0]["similar"]
         db.add_transaction(current_user.id, request.form.get("date"), request.form.get("description"), 
-                          cat_id, amount, request.form.get("type"), status=request.form.get("status", "paid"))
+                          cat_id, amount, request.form.get("type"), status=request.form.get("status", "paid"),
+                          allow_duplicate=bool(request.form.get("allow_duplicate")), currency=request.form.get("currency"))
         flash("Transação adicionada!", "success")
+        if similar:
+            flash(f"Atenção: {len(similar)} lançamento(s) com o mesmo valor em até {db.DUPLICATE_WINDOW_DAYS} dias desta data.", "warning")
+    except db.DuplicateTransactionError as e:
+        flash(f"{e} Marque \"Permitir lançamento repetido\" para salvar mesmo assim.", "warning")
     except Exception as e: flash(f"Erro: {e}", "danger")
     return redirect(url_for(".index"))
 
@@ -87,7 +124,8 @@ def edit(trans_id):
         amount = utils.parse_amount(request.form.get("amount"))
         cat_id = db.get_category_id(request.form.get("category"), current_user.id)
         db.update_transaction(trans_id, current_user.id, request.form.get("date"), request.form.get("description"), 
-                             cat_id, amount, request.form.get("type"), status=request.form.get("status", "paid"))
+                             cat_id, amount, request.form.get("type"), status=request.form.get("status", "paid"),
+                             currency=request.form.get("currency"))
         flash("Transação atualizada!", "success")
     except Exception as e: flash(f"Erro: {e}", "danger")
     return redirect(url_for(".index"))
@@ -105,6 +143,81 @@ def api_get_transaction(trans_id):
     t = db.get_transaction_by_id(trans_id, current_user.id)
     return jsonify(t) if t else ({'error': 'Not found'}, 404)
 
+@transactions_bp.route("/api/transactions/batch", methods=["POST"])
+@login_required
+def api_batch():
+    """Aplica várias criações/edições/exclusões de uma vez: {"operations": [{"op": ..., ...}],
+    "duplicates": "skip"|"flag"|"error"}.
+
+    Valores vão como número (ou texto numérico, "1234.56"). Tudo ou nada: com qualquer
+    operação inválida nada é gravado e a resposta (400) traz o erro de cada item.
+    Criações idênticas a transações existentes são puladas (skip, padrão), gravadas e
+    marcadas (flag) ou recusadas (error).
+    """
+    payload = request.get_json(silent=True)
+    ops = payload.get("operations") if isinstance(payload, dict) else payload
+    if not isinstance(ops, list) or not ops:
+        return jsonify({'error': 'Envie uma lista de operações em "operations"'}), 400
+    if len(ops) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'Máximo de {BATCH_MAX_OPERATIONS} operações por lote'}), 400
+    matcher = None
+    for op in ops:
+        if not isinstance(op, dict):
+            continue
+        if "amount" in op:
+            # Coerced once, so rules and fingerprints see the value that is stored;
+            # invalid amounts are left for apply_transaction_batch to report per item
+            try:
+                op["amount"] = db.parse_batch_amount(op["amount"])
+            except ValueError:
+                pass
+        # New rows without a category (or in "Outros") go through the user's rules
+        if (op.get("op") == "create" and op.get("category_id") is None and op.get("category") in (None, "", db.FALLBACK_CATEGORY)
+                and isinstance(op.get("description") or "", str) and isinstance(op.get("amount"), float)):
+            matcher = matcher or categorize.matcher_for(current_user.id)
+            category_id = matcher.match(op.get("description") or "", op["amount"], op.get("type"))
+            if category_id is not None:
+                op.pop("category", None)
+                op["category_id"] = category_id
+    try:
+        result = db.apply_transaction_batch(current_user.id, ops, payload.get("duplicates", "skip") if isinstance(payload, dict) else "skip")
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result), 200 if result["applied"] else 400
+
+@transactions_bp.route("/api/rules", methods=["GET", "POST"])
+@login_required
+def api_rules():
+    """Regras de categorização automática. POST: {"category", "kind": keyword|regex|amount,
+    "pattern", "min_amount", "max_amount", "type", "priority"}."""
+    if request.method == "GET":
+        return jsonify(db.fetch_category_rules(current_user.id))
+    data = request.get_json(silent=True) or {}
+    try:
+        amounts = [None if data.get(k) in (None, "") else float(data[k]) for k in ("min_amount", "max_amount")]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Valor inválido'}), 400
+    try:
+        cat_id = data.get("category_id") or db.get_category_id(data.get("category"), current_user.id)
+        rule_id = db.add_category_rule(current_user.id, cat_id, data.get("kind"), data.get("pattern", ""), *amounts,
+                                       typ=data.get("type") or None, priority=int(data.get("priority") or 0))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'id': rule_id}), 201
+
+@transactions_bp.route("/api/rules/<int:rule_id>", methods=["DELETE"])
+@login_required
+def api_delete_rule(rule_id):
+    if not db.delete_category_rule(current_user.id, rule_id):
+        return jsonify({'error': 'Regra não encontrada'}), 404
+    return jsonify({'ok': True})
+
+@transactions_bp.route("/api/rules/apply", methods=["POST"])
+@login_required
+def api_apply_rules():
+    """Recategoriza o histórico sem categoria (ou em "Outros") com as regras atuais."""
+    return jsonify({'updated': categorize.recategorize_history(current_user.id)})
+
 @transactions_bp.route("/settle/<month_str>", methods=["POST"])
 @login_required
 def settle_month(month_str):
@@ -8,13 +8,16 @@ PROJECT_ROOT = os.path.abspath(os.path.dirname(__file__))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-# 2. Inicializa o banco de dados
-db.init_db()
+if __name__ == '__main__':
+    # Só aqui: os processos de trabalho (helpers/jobs.py, helpers/passwords.py) são
+    # iniciados com spawn e reexecutam este arquivo como __mp_main__; fora deste bloco,
+    # cada um refaria as migrações e subiria seus próprios agendadores.
+    # 2. Inicializa o banco de dados
+    db.init_db()
 
-# 3. Cria a aplicação
-app = create_app()
+    # 3. Cria a aplicação
+    app = create_app()
 
-if __name__ == '__main__':
     # Rodar com debug=True localmente
     print("Iniciando servidor de desenvolvimento...")
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
@@ -0,0 +1,39 @@
+"""
+Every test runs against throwaway SQLite files: two shards, so moves can be exercised,
+and passwords hashed in-process instead of in a worker pool.
+"""
+import itertools
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+_DATA = Path(tempfile.mkdtemp(prefix="finance-tests-"))
+os.environ["DATABASE_PATH"] = str(_DATA / "finance.db")
+os.environ["DATABASE_SHARDS"] = "2"
+os.environ["PASSWORD_WORKERS"] = "0"
+os.environ["PASSWORD_METHOD"] = "pbkdf2:sha256:1000"
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import database as db  # noqa: E402
+
+_emails = itertools.count()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    db.init_db()
+
+
+@pytest.fixture
+def user_id() -> int:
+    """A fresh user with the default categories."""
+    return db.create_user(f"user{next(_emails)}@example.com", "senha-de-teste")
+
+
+@pytest.fixture
+def category(user_id) -> int:
+    return db.create_category(user_id, "Mercado")
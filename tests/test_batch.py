@@ -0,0 +1,66 @@
+import pytest
+
+import database as db
+
+VALID = {"op": "create", "date": "2026-03-02", "description": "feira", "amount": 12.5, "type": "expense"}
+
+
+def _descriptions(user_id: int):
+    return sorted(r['description'] for r in db.fetch_transactions(user_id))
+
+
+@pytest.mark.parametrize("fields, error", [
+    ({"amount": "nan"}, "Valor inválido"),
+    ({"amount": "inf"}, "Valor inválido"),
+    ({"amount": 1e400}, "Valor inválido"),
+    ({"amount": True}, "Valor inválido"),
+    ({"amount": "12,50"}, "Valor inválido"),
+    ({"amount": None}, "Valor inválido"),
+    ({"date": "2026-10-12junk"}, "Data deve estar no formato AAAA-MM-DD"),
+    ({"date": "2026-3-2"}, "Data deve estar no formato AAAA-MM-DD"),
+    ({"date": 20260302}, "Data deve estar no formato AAAA-MM-DD"),
+    ({"description": 5}, "Campo description deve ser texto"),
+    ({"note": ["a"]}, "Campo note deve ser texto"),
+    ({"source_ref": {}}, "Campo source_ref deve ser texto"),
+    ({"type": "transfer"}, "Tipo deve ser income ou expense"),
+    ({"op": "update", "id": [1]}, "Transação não encontrada"),
+    ({"op": "delete", "id": True}, "Transação não encontrada"),
+])
+def test_invalid_op_fails_the_whole_batch(user_id, fields, error):
+    result = db.apply_transaction_batch(user_id, [dict(VALID, description="ok"), dict(VALID, **fields)])
+
+    assert result["applied"] is False
+    assert result["results"][0]["ok"] is True
+    assert result["results"][1] == {"index": 1, "op": fields.get("op", "create"), "ok": False, "error": error}
+    assert _descriptions(user_id) == []
+
+
+def test_numeric_strings_are_stored_as_numbers(user_id):
+    result = db.apply_transaction_batch(user_id, [dict(VALID, amount="1234.5")])
+
+    assert result["applied"] is True
+    assert db.get_transaction_by_id(result["results"][0]["id"], user_id)["amount"] == 1234.5
+
+
+def test_ops_see_the_rows_earlier_ops_leave(user_id):
+    trans_id = db.add_transaction(user_id, "2026-03-01", "antiga", None, 10.0, "expense")
+
+    result = db.apply_transaction_batch(user_id, [
+        {"op": "update", "id": trans_id, "amount": 20},
+        {"op": "delete", "id": trans_id},
+        {"op": "update", "id": trans_id, "amount": 30},
+    ])
+
+    assert result["applied"] is False
+    assert [r["ok"] for r in result["results"]] == [True, True, False]
+    assert db.get_transaction_by_id(trans_id, user_id)["amount"] == 10.0
+
+
+def test_duplicate_creates_are_skipped_by_default(user_id):
+    db.add_transaction(user_id, "2026-03-02", "Feira", None, 12.5, "expense")
+
+    result = db.apply_transaction_batch(user_id, [VALID, dict(VALID, description="outra")])
+
+    assert result["applied"] is True
+    assert result["results"][0]["skipped"] is True
+    assert _descriptions(user_id) == ["Feira", "outra"]
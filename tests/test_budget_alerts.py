@@ -0,0 +1,41 @@
+import database as db
+
+
+def _alerts(user_id: int):
+    return sorted(n['threshold'] for n in db.get_notifications(user_id, unread_only=False))
+
+
+def test_alerts_fire_once_when_crossing_80_and_100_percent(user_id, category):
+    db.set_budgets(user_id, "2026-04", {category: 100.0})
+
+    db.add_transaction(user_id, "2026-04-01", "a", category, 70.0, "expense")
+    assert _alerts(user_id) == []
+    second = db.add_transaction(user_id, "2026-04-02", "b", category, 15.0, "expense")
+    assert _alerts(user_id) == [0.8]
+    db.add_transaction(user_id, "2026-04-03", "c", category, 20.0, "expense")
+    assert _alerts(user_id) == [0.8, 1.0]
+
+    # Dipping under and crossing again does not repeat the alerts
+    db.delete_transaction(second, user_id)
+    db.add_transaction(user_id, "2026-04-04", "d", category, 15.0, "expense")
+    assert _alerts(user_id) == [0.8, 1.0]
+    assert db.count_unread_notifications(user_id) == 2
+
+
+def test_counters_follow_edits_across_categories(user_id, category):
+    other = db.create_category(user_id, "Lazer")
+    db.set_budgets(user_id, "2026-05", {category: 100.0, other: 100.0})
+    trans_id = db.add_transaction(user_id, "2026-05-01", "cinema", category, 50.0, "expense")
+
+    db.update_transaction(trans_id, user_id, "2026-05-01", "cinema", other, 90.0, "expense")
+
+    spent = {b['category_id']: b['spent'] for b in db.get_budgets_with_spending(user_id, "2026-05")}
+    assert (spent[category], spent[other]) == (0.0, 90.0)
+    assert [n['category_id'] for n in db.get_notifications(user_id)] == [other]
+
+
+def test_no_alert_without_budget_or_for_income(user_id, category):
+    db.add_transaction(user_id, "2026-06-01", "sem orçamento", category, 500.0, "expense")
+    db.set_budgets(user_id, "2026-07", {category: 100.0})
+    db.add_transaction(user_id, "2026-07-01", "reembolso", category, 500.0, "income")
+    assert _alerts(user_id) == []
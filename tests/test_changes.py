@@ -0,0 +1,56 @@
+import database as db
+
+
+def _upserted(feed, table="transactions"):
+    return sorted(r['description'] for r in feed["changes"][table]["upserts"])
+
+
+def test_first_sync_is_a_full_reset(user_id):
+    db.add_transaction(user_id, "2026-03-01", "a", None, 1.0, "expense")
+
+    feed = db.get_changes(user_id)
+
+    assert feed["reset"] is True
+    assert _upserted(feed) == ["a"]
+
+
+def test_deltas_return_each_row_once_with_tombstones(user_id):
+    keep = db.add_transaction(user_id, "2026-03-01", "a", None, 1.0, "expense")
+    gone = db.add_transaction(user_id, "2026-03-02", "b", None, 1.0, "expense")
+    cursor = db.get_changes(user_id)["cursor"]
+
+    db.update_transaction(keep, user_id, "2026-03-01", "a2", None, 2.0, "expense")
+    db.update_transaction(keep, user_id, "2026-03-01", "a3", None, 3.0, "expense")
+    db.delete_transaction(gone, user_id)
+    feed = db.get_changes(user_id, since=cursor)
+
+    assert feed["reset"] is False
+    assert _upserted(feed) == ["a3"]
+    assert feed["changes"]["transactions"]["deletes"] == [gone]
+    assert db.get_changes(user_id, since=feed["cursor"])["changes"]["transactions"] == {"upserts": [], "deletes": []}
+
+
+def test_reset_invalidates_old_cursors(user_id):
+    db.add_transaction(user_id, "2026-03-01", "a", None, 1.0, "expense")
+    cursor = db.get_changes(user_id)["cursor"]
+
+    db.reset_change_log(user_id)
+    db.add_transaction(user_id, "2026-03-02", "b", None, 1.0, "expense")
+    feed = db.get_changes(user_id, since=cursor)
+
+    assert feed["reset"] is True
+    assert _upserted(feed) == ["a", "b"]
+    assert db.get_changes(user_id, since=feed["cursor"])["reset"] is False
+
+
+def test_compaction_past_a_cursor_forces_a_reset(user_id):
+    db.add_transaction(user_id, "2026-03-01", "a", None, 1.0, "expense")
+    cursor = db.get_changes(user_id)["cursor"]
+    db.add_transaction(user_id, "2026-03-02", "b", None, 1.0, "expense")
+
+    with db.get_conn(user_id) as conn:
+        conn.execute("UPDATE change_log SET changed_at = datetime('now', '-100 days') WHERE user_id = ?", (user_id,))
+        conn.commit()
+        db.compact_change_log(conn, retention_days=90)
+
+    assert db.get_changes(user_id, since=cursor)["reset"] is True
@@ -0,0 +1,53 @@
+import sqlite3
+
+import database as db
+from helpers import archive
+
+
+def _archive(user_id: int, year: int):
+    shard_file = db.shard_path(db.shard_for_user(user_id))
+    conn = sqlite3.connect(shard_file, isolation_level=None)
+    try:
+        archive.archive_year(conn, shard_file, year)
+    finally:
+        conn.close()
+
+
+def _walk(user_id: int, limit: int):
+    """Every page of the paid history, following the cursor like the page does."""
+    seen, cursor = [], {}
+    while True:
+        rows = db.get_paid_receivables_page(user_id, limit, **cursor)
+        seen += rows
+        if len(rows) < limit:
+            return seen
+        last = rows[-1]
+        cursor = {"before_date": last['date'], "before_id": last['id'], "before_src": last['src']}
+
+
+def test_paid_history_merges_hot_rows_with_archives(user_id):
+    for day in ("2019-03-01", "2019-06-01", "2019-09-01"):
+        db.add_receivable(user_id, "Ana", day, 10.0, day, status="paid")
+    _archive(user_id, 2019)
+    # Paid after the archiving run, some back-dated between archived rows
+    for day in ("2020-01-01", "2019-07-01", "2018-06-01"):
+        db.add_receivable(user_id, "Bia", day, 10.0, day, status="paid")
+    db.add_receivable(user_id, "Bia", "pendente", 10.0, "2019-08-01")
+
+    for limit in (1, 2, 4, 100):
+        dates = [r['date'] for r in _walk(user_id, limit)]
+        assert dates == ["2020-01-01", "2019-09-01", "2019-07-01", "2019-06-01", "2019-03-01", "2018-06-01"]
+
+
+def test_paid_history_cursor_tells_colliding_ids_apart(user_id):
+    db.add_receivable(user_id, "Ana", "arquivado", 10.0, "2017-05-01", status="paid")
+    _archive(user_id, 2017)
+    archived = db.get_paid_receivables_page(user_id, 1)[0]
+    # A hot row with the same id and date as the archived one
+    with db.get_conn(user_id) as conn:
+        conn.execute("INSERT INTO receivables (id, user_id, debtor_name, description, amount, date, status) VALUES (?, ?, 'Bia', 'quente', 10, '2017-05-01', 'paid')",
+                      (archived['id'], user_id))
+        conn.commit()
+
+    pages = _walk(user_id, 1)
+    assert sorted(r['description'] for r in pages) == ["arquivado", "quente"]
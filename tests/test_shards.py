@@ -0,0 +1,53 @@
+import sqlite3
+
+import database as db
+from helpers import shards
+
+
+def _count(shard: int, table: str, user_id: int) -> int:
+    conn = sqlite3.connect(db.shard_path(shard))
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id = ?", (user_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_move_user_keeps_rows_and_references(user_id, category):
+    db.set_budgets(user_id, "2026-03", {category: 100.0})
+    db.add_transaction(user_id, "2026-03-02", "feira", category, 40.0, "expense")
+    db.add_transaction(user_id, "2026-03-05", "salário", None, 1000.0, "income")
+    db.add_receivable(user_id, "Ana", "almoço", 25.0, "2026-03-10")
+    cursor = db.get_changes(user_id)["cursor"]
+    source = db.shard_for_user(user_id)
+    target = 1 - source
+
+    moved = shards.move_user(user_id, target, settle=0)
+
+    assert moved > 0
+    assert db.shard_for_user(user_id) == target
+    for table in ("transactions", "categories", "budgets", "receivables"):
+        assert _count(source, table, user_id) == 0
+    rows = {r['description']: r for r in db.fetch_transactions(user_id)}
+    assert set(rows) == {"feira", "salário"}
+    assert rows["feira"]["category"] == "Mercado"
+    budget = next(b for b in db.get_budgets_with_spending(user_id, "2026-03") if b['category_name'] == "Mercado")
+    assert (budget['budgeted'], budget['spent']) == (100.0, 40.0)
+    assert db.get_month_summary(user_id, "2026-03")["balance"] == 960.0
+    assert db.get_changes(user_id, since=cursor)["reset"] is True
+
+
+def test_move_there_and_back(user_id, category):
+    # One of the two moves leaves shard 0, which also holds the directory
+    db.add_transaction(user_id, "2026-03-02", "feira", category, 40.0, "expense")
+    home = db.shard_for_user(user_id)
+
+    shards.move_user(user_id, 1 - home, settle=0)
+    shards.move_user(user_id, home, settle=0)
+
+    assert db.shard_for_user(user_id) == home
+    assert [(r['description'], r['category']) for r in db.fetch_transactions(user_id)] == [("feira", "Mercado")]
+    assert _count(1 - home, "transactions", user_id) == 0
+
+
+def test_move_to_the_current_shard_is_a_no_op(user_id):
+    assert shards.move_user(user_id, db.shard_for_user(user_id), settle=0) == 0
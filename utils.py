@@ -3,21 +3,7 @@ Utility functions for currency formatting, date manipulation, and common UI help
 """
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-import locale
-
-def setup_locale():
-    """Sets the locale to Portuguese (Brazil) for date and currency formatting."""
-    try:
-        locale.setlocale(locale.LC_ALL, 'pt_BR.UTF-8')
-    except locale.Error:
-        try:
-            locale.setlocale(locale.LC_ALL, 'pt_BR')
-        except locale.Error:
-            locale.setlocale(locale.LC_ALL, '')
-
-def format_currency(value: float) -> str:
-    """Formats a float as BRL currency string."""
-    return f"R$ {value:,.2f}".replace(',', 'X').replace('.', ',').replace('X', '.')
+from formatting import format_currency, month_label
 
 def get_month_range(month_str: str = None):
     """
@@ -33,14 +19,11 @@ def get_month_range(month_str: str = None):
         target_date = datetime.now()
 
     target_month_str = target_date.strftime('%Y-%m')
-    
-    # We use a trick to get localized month name without global locale side effects if possible
-    # but for simplicity in this project we rely on the setup_locale() call.
-    target_month_display = target_date.strftime('%b/%Y').capitalize()
+    target_month_display = month_label(target_date)
     
     prev_month = (target_date - relativedelta(months=1)).strftime('%Y-%m')
     next_month = (target_date + relativedelta(months=1)).strftime('%Y-%m')
-    next_month_display = (target_date + relativedelta(months=1)).strftime('%b/%Y').capitalize()
+    next_month_display = month_label(target_date + relativedelta(months=1))
 
     return {
         'target_date': target_date,
@@ -2,12 +2,15 @@
 Main Flask application entry point.
 """
 import os
-import time
 from datetime import datetime
 from flask import Flask
 from flask_login import LoginManager
 from dotenv import load_dotenv
 
+import formatting
+from web.assets import init_assets
+from web.compression import init_compression
+
 # --- IMPORTAÇÕES DAS ROTAS ---
 from routes.auth import auth_bp
 from routes.dashboard import dashboard_bp
@@ -16,6 +19,8 @@ from routes.budgets import budgets_bp
 from routes.salary import salary_bp
 from routes.transactions import transactions_bp
 from routes.receivables import receivables_bp
+from routes.sync import sync_bp
+from routes.jobs import jobs_bp
 
 def create_app():
     """Factory function to create and configure Flask app."""
@@ -47,19 +52,27 @@ def create_app():
     def load_user(user_id):
         return db.get_user_by_id(int(user_id))
     
+    # Filtros de formatação pt-BR (moeda, mês, data) sem setlocale
+    formatting.register_filters(app)
+
+    # Assets estáticos com hash no nome (cache longo + gzip/brotli pré-gerados)
+    init_assets(app)
+
+    # gzip de respostas HTML/JSON grandes
+    init_compression(app)
+
     # Injeta variáveis globais nos templates
     @app.context_processor
     def inject_globals():
         return {
-            'datetime': datetime,
-            'cache_buster': int(time.time())
+            'datetime': datetime
         }
     
     # --- REGISTRO DOS BLUEPRINTS ---
     # Garantimos que não há colisões ou registros duplicados
     blueprints = [
         auth_bp, dashboard_bp, savings_bp, budgets_bp, 
-        salary_bp, transactions_bp, receivables_bp
+        salary_bp, transactions_bp, receivables_bp, sync_bp, jobs_bp
     ]
     
     for bp in blueprints:
@@ -68,5 +81,17 @@ def create_app():
         # Mas aqui, estamos registrando na inicialização limpa.
         if bp.name not in app.blueprints:
             app.register_blueprint(bp)
+
+    # Manutenção do banco (ANALYZE, vacuum incremental, checkpoint do WAL)
+    if os.environ.get("MAINTENANCE_ENABLED", "1") != "0":
+        from helpers import maintenance
+        app.before_request(maintenance.mark_activity)
+        maintenance.start_scheduler()
+
+    # Backup online agendado (opcional)
+    backup_interval = os.environ.get("BACKUP_INTERVAL")
+    if backup_interval:
+        from helpers.backup import start_scheduler
+        start_scheduler(int(backup_interval))
     
     return app
\ No newline at end of file
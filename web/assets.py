@@ -0,0 +1,102 @@
+"""
+Fingerprinted static assets.
+
+At startup every file under static/ is hashed and templates link to it through
+asset_url('style.css') -> /assets/style.3f2a9c1b7d.css. Those URLs change whenever the
+content does, so they are served with a one-year immutable Cache-Control. Text assets
+also get gzip (and brotli, when the package is installed) variants, generated once and
+chosen according to Accept-Encoding.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+from typing import Dict
+
+from flask import Blueprint, abort, current_app, request, send_file, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+assets_bp = Blueprint('assets', __name__)
+
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".map", ".html"}
+MIN_COMPRESS_SIZE = 512
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# logical name -> fingerprinted name, and back
+_manifest: Dict[str, str] = {}
+_originals: Dict[str, str] = {}
+_static_dir: Path = None
+_cache_dir: Path = None
+
+
+def _precompress(data: bytes, hashed: str):
+    variants = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((".br", lambda d: brotli.compress(d, quality=11)))
+    for ext, compress in variants:
+        target = _cache_dir / (hashed + ext)
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                target.write_bytes(compressed)
+
+
+def build_manifest(static_dir: Path, cache_dir: Path) -> Dict[str, str]:
+    """Hashes every static file and writes the compressed variants that are missing."""
+    global _static_dir, _cache_dir
+    _static_dir, _cache_dir = Path(static_dir), Path(cache_dir)
+    _manifest.clear()
+    _originals.clear()
+    for path in sorted(_static_dir.rglob("*")):
+        if not path.is_file():
+            continue
+        data = path.read_bytes()
+        rel = path.relative_to(_static_dir).as_posix()
+        digest = hashlib.sha256(data).hexdigest()[:10]
+        hashed = f"{rel[:-len(path.suffix)] if path.suffix else rel}.{digest}{path.suffix}"
+        _manifest[rel] = hashed
+        _originals[hashed] = rel
+        if path.suffix in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+            _precompress(data, hashed)
+    return dict(_manifest)
+
+
+def asset_url(filename: str) -> str:
+    """URL of a static file for templates. In debug mode, where files change under the
+    running server, falls back to the plain static URL with an mtime query string."""
+    if current_app.debug or filename not in _manifest:
+        mtime = int(os.path.getmtime(_static_dir / filename)) if (_static_dir / filename).exists() else 0
+        return url_for('static', filename=filename, v=mtime)
+    return url_for('assets.serve', filename=_manifest[filename])
+
+
+@assets_bp.route("/assets/<path:filename>")
+def serve(filename):
+    original = _originals.get(filename)
+    if original is None:
+        abort(404)
+    response = None
+    for encoding, ext in (("br", ".br"), ("gzip", ".gz")):
+        variant = _cache_dir / (filename + ext)
+        if request.accept_encodings[encoding] and variant.exists():
+            response = send_file(variant, mimetype=mimetypes.guess_type(original)[0] or "application/octet-stream", conditional=True, etag=True)
+            response.headers["Content-Encoding"] = encoding
+            break
+    if response is None:
+        response = send_from_directory(_static_dir, original)
+    response.headers["Cache-Control"] = IMMUTABLE
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def init_assets(app):
+    """Builds the manifest, registers the /assets route and the asset_url() template global."""
+    build_manifest(app.static_folder, os.path.join(app.instance_path, "assets"))
+    app.register_blueprint(assets_bp)
+    app.add_template_global(asset_url)
@@ -0,0 +1,53 @@
+"""
+gzip for dynamic responses.
+
+HTML and JSON bodies of at least COMPRESS_MIN_SIZE bytes are gzipped when the client
+accepts it. Streamed responses are compressed chunk by chunk as they are produced, so
+nothing gets buffered. Static files are left alone: web/assets.py serves pre-compressed
+variants of them.
+"""
+import gzip
+import os
+import zlib
+from typing import Iterable, Iterator
+
+from flask import request
+
+COMPRESS_MIMETYPES = {"text/html", "application/json"}
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+
+
+def _gzip_stream(chunks: Iterable, level: int) -> Iterator[bytes]:
+    # wbits=31 writes the gzip container instead of a raw zlib stream.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response):
+    """after_request hook compressing eligible responses."""
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or not request.accept_encodings["gzip"]):
+        return response
+    if response.is_streamed:
+        response.response = _gzip_stream(response.response, COMPRESS_LEVEL)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,42 @@
+"""
+Cached template fragments.
+
+Heavy, rarely changing blocks (recurring-rule tables, category lists, paid history) are
+rendered from partial templates and kept per user and data version, so a page view only
+re-renders them, and only runs their queries, after the user's data changed.
+"""
+import os
+
+from flask import g, render_template
+from flask_login import current_user
+from markupsafe import Markup
+
+import database as db
+from helpers.cache import LRUCache
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", "512"))
+
+_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
+
+def data_version() -> int:
+    """The current user's data version, read once per request."""
+    if "data_version" not in g:
+        g.data_version = db.get_data_version(current_user.id)
+    return g.data_version
+
+
+def render_fragment(template: str, **context) -> Markup:
+    """Renders a partial template for the current user, reusing the previous rendering
+    while their data is unchanged.
+
+    Callable context values are loaders and only run on a cache miss; the other values
+    are part of the cache key, so they must be hashable.
+    """
+    params = tuple(sorted((k, v) for k, v in context.items() if not callable(v)))
+    key = (current_user.id, data_version(), template, params)
+
+    def render():
+        return render_template(template, **{k: v() if callable(v) else v for k, v in context.items()})
+
+    return Markup(_cache.get_or_set(key, render))